@@ -0,0 +1,86 @@
+import bisect
+import hashlib
+import logging
+
+try:
+    from .reactor import frame_bytes
+except ImportError:
+    from reactor import frame_bytes
+
+logger = logging.getLogger(__file__)
+
+
+def hash32(value):
+    return int.from_bytes(hashlib.md5(value).digest()[:4], "big")
+
+
+class RoundRobinBalancer(object):
+    name = "round-robin"
+
+    def __init__(self):
+        self.counter = 0
+
+    def select(self, entries, frames):
+        self.counter += 1
+        return entries[self.counter % len(entries)]
+
+
+class LeastOutstandingBalancer(object):
+    # picks the dealer with the fewest requests still waiting for a reply
+    name = "least-outstanding"
+
+    def select(self, entries, frames):
+        return min(entries, key=lambda entry: entry.outstanding)
+
+
+class ConsistentHashBalancer(object):
+    # sticky sessions: the same frame value keeps going to the same dealer
+    # and adding or removing a dealer only moves the keys it owned
+    name = "consistent-hash"
+
+    def __init__(self, frame_index=1, replicas=64):
+        self.frame_index = frame_index
+        self.replicas = replicas
+        self.rings = {}
+
+    def ring(self, entries):
+        key = frozenset(entries)
+        ring = self.rings.get(key)
+        if ring is None:
+            if len(self.rings) > 64:
+                self.rings.clear()
+            points = []
+            for entry in entries:
+                for n in range(self.replicas):
+                    point = hash32(entry.address + b"#" + str(n).encode("utf8"))
+                    points.append((point, entry.address, entry))
+            points.sort(key=lambda point: point[:2])
+            ring = self.rings[key] = ([point[0] for point in points],
+                                      [point[2] for point in points])
+        return ring
+
+    def select(self, entries, frames):
+        if len(entries) == 1:
+            return entries[0]
+        value = b""
+        if len(frames) > self.frame_index:
+            value = frame_bytes(frames[self.frame_index])
+        hashes, ring_entries = self.ring(entries)
+        index = bisect.bisect(hashes, hash32(value)) % len(hashes)
+        return ring_entries[index]
+
+
+def make_balancer(name, args):
+    # None means broadcast to every matching dealer
+    if name == b"broadcast":
+        return None
+    if name == b"round-robin":
+        return RoundRobinBalancer()
+    if name == b"least-outstanding":
+        return LeastOutstandingBalancer()
+    if name == b"consistent-hash":
+        frame_index = 1
+        if args:
+            frame_index = int(args[0])
+        return ConsistentHashBalancer(frame_index)
+    raise Exception("Unknown balancer: %s" % name.decode("utf8", "replace"))
@@ -0,0 +1,522 @@
+import sys
+import os
+import zmq
+import json
+import time
+import struct
+import argparse
+import logging
+import platform
+import shutil
+import tempfile
+import threading
+import msgpack
+
+try:
+    from . import pubsub
+    from . import dealerrouter
+except ImportError:
+    import pubsub
+    import dealerrouter
+
+# the bridges live in zmq_sub_to_kafka and are imported as scripts
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             "zmq_sub_to_kafka"))
+
+logger = logging.getLogger(__file__)
+
+CASES = ["pubsub-fanout", "pubsub-fanin", "dealerrouter", "subscriber",
+         "kafka-bridge"]
+# the cases that run once per hub engine, subscriber runs per SUBSCRIBER_ENGINES
+ENGINE_CASES = ["pubsub-fanout", "pubsub-fanin", "dealerrouter"]
+SUBSCRIBER_ENGINES = ["threads", "loop"]
+
+TIMESTAMP = struct.Struct("!Q")
+
+
+def get_options():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--cases', default=",".join(CASES),
+                        help='comma separated, from %s' % ", ".join(CASES))
+    parser.add_argument('--transports', default="inproc,ipc,tcp",
+                        help='comma separated, from inproc, ipc, tcp')
+    parser.add_argument('--sizes', default="16,256,4096,65536,1048576",
+                        help='comma separated message sizes in bytes')
+    parser.add_argument('--fans', default="1,4",
+                        help='comma separated fan-out/fan-in counts')
+    parser.add_argument('--engines', default="loop,proxy",
+                        help='comma separated hub engines')
+    parser.add_argument('--count', type=int, default=20000,
+                        help='messages per throughput run')
+    parser.add_argument('--latency_count', type=int, default=1000,
+                        help='messages per latency run, sent one at a time')
+    parser.add_argument('--max_bytes', type=int, default=64 * 1024 * 1024,
+                        help='caps count * size for large messages')
+    parser.add_argument('--output',
+                        help='write the results to this json file')
+    parser.add_argument('--compare',
+                        help='json results of an earlier run to compare with')
+
+    parsed = parser.parse_args()
+
+    for name in parsed.cases.split(","):
+        if name not in CASES:
+            raise Exception("Unknown case: %s" % name)
+
+    return parsed
+
+
+class Addresses(object):
+    # a fresh address per call, so runs never trip over each other
+    def __init__(self, transport, port=19950):
+        self.transport = transport
+        self.port = port
+        self.counter = 0
+
+    def next(self):
+        self.counter += 1
+        if self.transport == "tcp":
+            self.port += 1
+            return "tcp://127.0.0.1:%d" % self.port
+        if self.transport == "ipc":
+            return "ipc:///tmp/zmqpatterns-bench-%d-%d" % (os.getpid(),
+                                                           self.counter)
+        return "inproc://bench-%d" % self.counter
+
+
+def stamp(padding):
+    return TIMESTAMP.pack(time.perf_counter_ns()) + padding
+
+
+def latency_ns(payload):
+    return time.perf_counter_ns() - TIMESTAMP.unpack_from(payload)[0]
+
+
+def percentiles(samples):
+    if not samples:
+        return {}
+    samples = sorted(samples)
+    result = {}
+    for name, fraction in (("p50", 0.5), ("p90", 0.9), ("p99", 0.99),
+                           ("p999", 0.999)):
+        result[name] = samples[min(len(samples) - 1,
+                                   int(len(samples) * fraction))] / 1000.0
+    result["max"] = samples[-1] / 1000.0
+    return result
+
+
+def command(socket, *frames):
+    socket.send_multipart([frame if isinstance(frame, bytes)
+                           else frame.encode("utf8") for frame in frames])
+    if not socket.poll(timeout=5000):
+        raise Exception("No reply to %s" % (frames,))
+    return socket.recv_multipart()
+
+
+class OneWay(object):
+    # senders each publish, every receiver gets every message; extract
+    # finds the payload in what a receiver gets
+    def __init__(self, senders, receivers, extract=None, teardown=None):
+        self.senders = senders
+        self.receivers = receivers
+        self.extract = extract
+        if extract is None:
+            self.extract = lambda frames: frames[-1]
+        self.teardown = teardown
+
+    def warmup(self):
+        # slow joiners: keep sending until each receiver heard each sender
+        missing = set((r, s) for r in range(len(self.receivers))
+                      for s in range(len(self.senders)))
+        deadline = time.monotonic() + 10
+        while missing:
+            if time.monotonic() > deadline:
+                raise Exception("warmup timed out, missing %s" % missing)
+            for index, sender in enumerate(self.senders):
+                sender.send(b"warmup-%d" % index)
+            for index, receiver in enumerate(self.receivers):
+                while receiver.poll(timeout=20):
+                    payload = self.extract(receiver.recv_multipart())
+                    if payload.startswith(b"warmup-"):
+                        missing.discard((index, int(payload[7:])))
+        for receiver in self.receivers:
+            while receiver.poll(timeout=200):
+                receiver.recv_multipart()
+
+    def throughput(self, count, size):
+        per_sender = max(1, count // len(self.senders))
+        expected = per_sender * len(self.senders)
+        finished = [None] * len(self.receivers)
+        received = [0] * len(self.receivers)
+
+        def receive(index, receiver):
+            finished[index] = time.perf_counter()
+            while received[index] < expected:
+                if not receiver.poll(timeout=2000):
+                    break
+                receiver.recv_multipart(copy=False)
+                received[index] += 1
+                finished[index] = time.perf_counter()
+
+        threads = [threading.Thread(target=receive, args=(index, receiver))
+                   for index, receiver in enumerate(self.receivers)]
+        payload = b"x" * size
+        started = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for n in range(per_sender):
+            for sender in self.senders:
+                sender.send(payload, copy=size < 65536)
+        for thread in threads:
+            thread.join()
+        elapsed = max(finished) - started
+        delivered = sum(received)
+        return dict(sent=expected, delivered=delivered,
+                    lost=expected * len(self.receivers) - delivered,
+                    seconds=elapsed,
+                    msgs_per_sec=delivered / elapsed,
+                    mb_per_sec=delivered * size / elapsed / 1e6)
+
+    def latency(self, count, size):
+        padding = b"x" * (size - TIMESTAMP.size)
+        samples = []
+        for n in range(count):
+            self.senders[n % len(self.senders)].send(stamp(padding))
+            for receiver in self.receivers:
+                if not receiver.poll(timeout=2000):
+                    break
+                samples.append(latency_ns(self.extract(receiver.recv_multipart())))
+        return samples
+
+
+class RequestReply(object):
+    # one client, replies come back to it; window bounds the outstanding ones
+    def __init__(self, client, teardown=None, window=1000):
+        self.client = client
+        self.teardown = teardown
+        self.window = window
+
+    def warmup(self):
+        command(self.client, b"warmup")
+
+    def throughput(self, count, size):
+        payload = b"x" * size
+        sent = received = 0
+        started = time.perf_counter()
+        while received < count:
+            while sent < count and sent - received < self.window:
+                self.client.send(payload, copy=size < 65536)
+                sent += 1
+            if not self.client.poll(timeout=2000):
+                break
+            while received < sent:
+                try:
+                    self.client.recv_multipart(flags=zmq.NOBLOCK, copy=False)
+                except zmq.Again:
+                    break
+                received += 1
+        elapsed = time.perf_counter() - started
+        return dict(sent=sent, delivered=received, lost=sent - received,
+                    seconds=elapsed,
+                    msgs_per_sec=received / elapsed,
+                    mb_per_sec=received * size / elapsed / 1e6)
+
+    def latency(self, count, size):
+        padding = b"x" * (size - TIMESTAMP.size)
+        samples = []
+        for n in range(count):
+            self.client.send(stamp(padding))
+            if not self.client.poll(timeout=2000):
+                break
+            samples.append(latency_ns(self.client.recv_multipart()[-1]))
+        return samples
+
+
+def start_thread(target, *args, **kwargs):
+    thread = threading.Thread(target=target, args=args, kwargs=kwargs)
+    thread.daemon = True
+    thread.start()
+    return thread
+
+
+def setup_pubsub(context, addresses, engine, fan, fan_in):
+    control_address = addresses.next()
+    hub = pubsub.PubSubHub(context, control_address, engine=engine)
+    for socket in (hub.sub_socket, hub.pub_socket):
+        socket.set_hwm(0)
+    thread = start_thread(hub.run)
+
+    control = context.socket(zmq.DEALER)
+    control.connect(control_address)
+
+    publishers = []
+    for n in range(fan if fan_in else 1):
+        address = addresses.next()
+        publisher = context.socket(zmq.PUB)
+        publisher.set_hwm(0)
+        publisher.bind(address)
+        publishers.append(publisher)
+        command(control, "sub-connect", address)
+
+    down_address = addresses.next()
+    command(control, "pub-bind", down_address)
+    subscribers = []
+    for n in range(1 if fan_in else fan):
+        subscriber = context.socket(zmq.SUB)
+        subscriber.set_hwm(0)
+        subscriber.setsockopt(zmq.SUBSCRIBE, b"")
+        subscriber.connect(down_address)
+        subscribers.append(subscriber)
+
+    def teardown():
+        command(control, "quit", "now")
+        thread.join()
+
+    return OneWay(publishers, subscribers, teardown=teardown)
+
+
+def setup_dealerrouter(context, addresses, engine, fan):
+    control_address = addresses.next()
+    hub = dealerrouter.DealerRouterHub(context, control_address, None, None,
+                                       engine=engine)
+    hub.router_socket.set_hwm(0)
+    thread = start_thread(hub.run)
+    control = context.socket(zmq.DEALER)
+    control.connect(control_address)
+
+    running = [True]
+
+    def echo(worker):
+        while running[0]:
+            if worker.poll(timeout=100):
+                worker.send_multipart(worker.recv_multipart(copy=False),
+                                      copy=False)
+
+    workers = []
+    for n in range(fan):
+        address = addresses.next()
+        worker = context.socket(zmq.ROUTER)
+        worker.set_hwm(0)
+        worker.bind(address)
+        workers.append(start_thread(echo, worker))
+        command(control, "d-connect", address)
+    if fan > 1 and engine == "loop":
+        # the default broadcasts, which would multiply the replies
+        command(control, "balance", "round-robin")
+
+    front_address = addresses.next()
+    command(control, "r-bind", front_address)
+    client = context.socket(zmq.DEALER)
+    client.set_hwm(0)
+    client.connect(front_address)
+
+    def teardown():
+        command(control, "quit", "now")
+        thread.join()
+        running[0] = False
+        for worker in workers:
+            worker.join()
+
+    return RequestReply(client, teardown=teardown)
+
+
+def setup_subscriber(context, addresses, engine, fan):
+    import zmq_sub_to_kafka
+
+    sink_address = addresses.next()
+    sink = context.socket(zmq.ROUTER)
+    sink.set_hwm(0)
+    sink.bind(sink_address)
+
+    controller_address = addresses.next()
+    controller = zmq_sub_to_kafka.ZmqPrimaryController(
+        context, controller_address, sink_address, None, engine=engine)
+    thread = start_thread(controller.run)
+    control = context.socket(zmq.DEALER)
+    control.connect(controller_address)
+
+    publishers = []
+    names = []
+    for n in range(fan):
+        address = addresses.next()
+        publisher = context.socket(zmq.PUB)
+        publisher.set_hwm(0)
+        publisher.bind(address)
+        publishers.append(publisher)
+        name = "bench-%d" % n
+        names.append((name, address))
+        reply = command(control, "1", "cmd", "subscribe", name, address)
+        if reply[2] != b"subscribed":
+            raise Exception("subscribe failed: %s" % reply)
+
+    def teardown():
+        threads = [entry[0] for entry in controller._subscriptions.values()
+                   if entry[0] is not None]
+        for name, address in names:
+            command(control, "1", "cmd", "unsubscribe", name, address)
+        for subscriber_thread in threads:
+            subscriber_thread.join()
+        controller.request_quit()
+        thread.join()
+
+    return OneWay(publishers, [sink], teardown=teardown)
+
+
+def setup_kafka_bridge(context, addresses, fan):
+    import simple_zmq_to_kafka
+    import simple_kafka_to_zmq
+    import log_backend
+
+    # the local partition logs stand in for kafka
+    log_dir = tempfile.mkdtemp(prefix="zmqpatterns-bench-")
+    backend = log_backend.LocalLogBackend(log_dir)
+    running = [True]
+    continue_running = lambda: running[0]
+
+    sink_address = addresses.next()
+    sink = context.socket(zmq.ROUTER)
+    sink.set_hwm(0)
+    sink.bind(sink_address)
+
+    listener_address = addresses.next()
+    threads = [
+        start_thread(simple_zmq_to_kafka.from_zmq_to_kafka,
+                     listener_address, None, "bench",
+                     continue_running=continue_running,
+                     zmq_context=context, backend=backend),
+        start_thread(simple_kafka_to_zmq.from_kafka_to_zmq,
+                     None, "bench", "bench", None, sink_address,
+                     continue_running=continue_running,
+                     zmq_context=context, backend=backend),
+    ]
+
+    senders = []
+    for n in range(fan):
+        sender = context.socket(zmq.DEALER)
+        sender.set_hwm(0)
+        sender.connect(listener_address)
+        senders.append(sender)
+
+    def teardown():
+        running[0] = False
+        for thread in threads:
+            thread.join()
+        backend.close()
+        shutil.rmtree(log_dir)
+
+    # [identity, offset, msgpack [identity, payload]]
+    extract = lambda frames: msgpack.unpackb(frames[-1])[-1]
+    return OneWay(senders, [sink], extract=extract, teardown=teardown)
+
+
+def setup(case, context, addresses, engine, fan):
+    if case == "pubsub-fanout":
+        return setup_pubsub(context, addresses, engine, fan, False)
+    if case == "pubsub-fanin":
+        return setup_pubsub(context, addresses, engine, fan, True)
+    if case == "dealerrouter":
+        return setup_dealerrouter(context, addresses, engine, fan)
+    if case == "subscriber":
+        return setup_subscriber(context, addresses, engine, fan)
+    return setup_kafka_bridge(context, addresses, fan)
+
+
+def measure(case, transport, engine, size, fan, options, addresses):
+    count = max(1, min(options.count, options.max_bytes // size))
+    latency_count = max(1, min(options.latency_count,
+                               options.max_bytes // size))
+    context = zmq.Context()
+    bench = setup(case, context, addresses, engine, fan)
+    try:
+        bench.warmup()
+        result = bench.throughput(count, size)
+        result["latency_us"] = percentiles(bench.latency(latency_count,
+                                                         max(size,
+                                                             TIMESTAMP.size)))
+    finally:
+        bench.teardown()
+        context.destroy(linger=0)
+    result.update(case=case, transport=transport, engine=engine, size=size,
+                  fan=fan, count=count)
+    return result
+
+
+def result_key(result):
+    return (result["case"], result["engine"], result["transport"],
+            result["size"], result["fan"])
+
+
+def describe(result):
+    return "%-14s %-7s %-6s %8d %3d" % (result["case"], result["engine"],
+                                         result["transport"], result["size"],
+                                         result["fan"])
+
+
+def compare(results, filename):
+    with open(filename, "r") as hFile:
+        baseline = dict((result_key(result), result)
+                        for result in json.load(hFile)["results"])
+    print("%-44s %12s %12s" % ("compared with " + filename, "msgs/s",
+                               "p99 latency"))
+    for result in results:
+        old = baseline.get(result_key(result))
+        if old is None:
+            continue
+        old_p99 = old["latency_us"].get("p99")
+        new_p99 = result["latency_us"].get("p99")
+        print("%s %11.2fx %11.2fx" % (
+            describe(result),
+            result["msgs_per_sec"] / max(old["msgs_per_sec"], 1e-9),
+            (new_p99 or 0) / max(old_p99 or 0, 1e-9)))
+
+
+def run():
+    options = get_options()
+    cases = options.cases.split(",")
+    transports = options.transports.split(",")
+    sizes = [int(size) for size in options.sizes.split(",")]
+    fans = [int(fan) for fan in options.fans.split(",")]
+    engines = options.engines.split(",")
+
+    results = []
+    print("%-14s %-7s %-6s %8s %3s %10s %9s %5s %9s %9s" % (
+        "case", "engine", "trans", "size", "fan", "msgs/s", "MB/s", "lost",
+        "p50 us", "p99 us"))
+    for case in cases:
+        for transport in transports:
+            addresses = Addresses(transport)
+            case_engines = ["-"]
+            if case in ENGINE_CASES:
+                case_engines = engines
+            elif case == "subscriber":
+                case_engines = SUBSCRIBER_ENGINES
+            for engine in case_engines:
+                for fan in fans:
+                    for size in sizes:
+                        result = measure(case, transport, engine, size, fan,
+                                         options, addresses)
+                        results.append(result)
+                        latency = result["latency_us"]
+                        print("%s %10.0f %9.1f %5d %9.1f %9.1f" % (
+                            describe(result), result["msgs_per_sec"],
+                            result["mb_per_sec"], result["lost"],
+                            latency.get("p50", 0), latency.get("p99", 0)))
+                        sys.stdout.flush()
+
+    if options.output is not None:
+        with open(options.output, "w") as hFile:
+            json.dump({"started": time.strftime("%Y-%m-%dT%H:%M:%S"),
+                       "host": platform.node(),
+                       "python": platform.python_version(),
+                       "pyzmq": zmq.__version__,
+                       "libzmq": zmq.zmq_version(),
+                       "options": vars(options),
+                       "results": results}, hFile, indent=1)
+
+    if options.compare is not None:
+        compare(results, options.compare)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.WARN)
+    run()
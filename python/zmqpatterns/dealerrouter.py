@@ -1,64 +1,169 @@
 import zmq
+import time
 import logging
 
+try:
+    from . import proxy
+    from . import routing
+    from . import balancing
+    from . import reactor
+    from . import tracing
+    from . import metrics
+except ImportError:
+    import proxy
+    import routing
+    import balancing
+    import reactor
+    import tracing
+    import metrics
+
 logger = logging.getLogger(__file__)
 
 class DealerRouterHub(object):
     def __init__(self, context, control_address,
-                 dealer_selector_func, dealer_key_func):
+                 dealer_selector_func, dealer_key_func, engine="loop",
+                 route_key_func=None, copy=None, inflight_timeout=30.0):
         self.context = context
+        # "loop" forwards in python, "proxy" hands the data sockets to libzmq.
+        # The proxy engine has a single DEALER connected to every d-connect
+        # address, so requests are round-robined by libzmq rather than
+        # routed by dealer_selector_func.
+        self.engine = engine
+        self.proxy_engine = None
+        self.proxy_dealer_socket = None
+        self.capture_socket = None
         self.dealer_selector_func = dealer_selector_func
         if dealer_selector_func is None:
             self.dealer_selector_func = self.default_dealer_selector
+        # zero-copy passes zmq.Frame objects between sockets; hand written
+        # selectors keep getting bytes unless they ask for frames
+        self.copy = copy
+        if copy is None:
+            self.copy = dealer_selector_func is not None
         self.dealer_key_func = dealer_key_func
-        self.dealer_sockets = {}
+        # picks the bytes matched against the d-connect route prefixes,
+        # defaults to the first frame after the ROUTER identity
+        self.route_key_func = route_key_func
+        if route_key_func is None:
+            self.route_key_func = routing.frame_selector(1)
+        self.dealers = routing.DealerRegistry()
+        # None broadcasts to every matching dealer, see the balance action
+        self.balancer = None
+        # requests unanswered this long stop counting as outstanding
+        self.inflight_timeout = inflight_timeout
+        self.next_expire = 0.0
         self.router_socket = self.context.socket(zmq.ROUTER)
         self.control_socket = self.context.socket(zmq.ROUTER)
         self.control_socket.bind(control_address)
-        self.poller = zmq.Poller()
+        self.reactor = reactor.Reactor()
+        self.tracer = tracing.Tracer()
+        self.metrics = metrics.Metrics()
+        self.reactor.loop_timer = self.metrics.timer("loop")
+        self.router_counters = self.metrics.socket("router")
+        self.selector_timer = self.metrics.timer("selector")
 
-        self.poller.register(self.router_socket, zmq.POLLIN)
-        self.poller.register(self.control_socket, zmq.POLLIN)
+        self.reactor.register(self.router_socket, self.handle_router_frames,
+                              copy=self.copy)
+        self.reactor.register(self.control_socket, self.handle_control)
 
         self.quit = False
 
         self.actions = {
             b"d-connect": self.handle_connect_dealer,
+            b"route-add": self.handle_add_route,
+            b"route-remove": self.handle_remove_route,
+            b"balance": self.handle_balance,
+            b"inflight": self.handle_inflight,
             b"r-bind": self.handle_bind_router,
             b"ping": self.handle_ping,
             b"quit": self.handle_quit_request,
+            b"capture-bind": self.handle_bind_capture,
+            b"proxy-stats": self.handle_proxy_stats,
+            b"trace-dump": self.handle_trace_dump,
+            b"trace-config": self.handle_trace_config,
+            b"stats": self.handle_stats,
         }
 
         self.log_ping = False
 
+    @property
+    def dealer_sockets(self):
+        return dict((entry.address, entry.socket)
+                    for entry in self.dealers.entries)
+
     def default_dealer_selector(self, hub, frames):
-        return self.dealer_sockets.items()
+        entries = self.dealers.match(self.route_key_func(frames))
+        if self.balancer is not None and entries:
+            entry = self.balancer.select(entries, frames)
+            return [(entry.address, entry.socket)]
+        return [(entry.address, entry.socket) for entry in entries]
 
     def run(self):
-        while not self.quit:
-            for socket, event in self.poller.poll(timeout=1000):
-                if socket == self.router_socket:
-                    frames = self.router_socket.recv_multipart()
-                    # fire to all upstreams - be more selective by inspecting the frames
-                    # i.e. have the content provide where to deliver to.
-                    dealer_sockets = self.dealer_selector_func(self, frames)
-                    for address, dealer_socket in dealer_sockets:
-                        dealer_socket.send_multipart(frames)
-                    logger.info("< %s", frames)
-                    continue
-
-                if socket == self.control_socket:
-                    frames = socket.recv_multipart()
-                    self.handle_control(socket, frames)
-                    continue
-
-                if True: # must be a dealer socket
-                    dealer_socket = socket
-                    frames = dealer_socket.recv_multipart()
-                    self.router_socket.send_multipart(frames)
-                    logger.info("> %s", frames)
-                    continue
+        if self.engine == "proxy":
+            return self.run_proxy()
+
+        while self.continue_running():
+            self.reactor.poll_once()
+            self.expire_inflight()
+
+    def expire_inflight(self):
+        if not self.inflight_timeout:
+            return
+        now = time.monotonic()
+        if now < self.next_expire:
+            return
+        self.next_expire = now + min(self.inflight_timeout / 4, 1.0)
+        for entry in self.dealers.entries:
+            expired = entry.expire(now - self.inflight_timeout)
+            if expired:
+                logger.warn("Dealer [%s] %s requests without a reply",
+                            entry.address, expired)
 
+    def continue_running(self):
+        return not self.quit
+
+    def handle_router_frames(self, socket, frames):
+        size = self.router_counters.received(frames)
+        # fire to the dealers whose route prefixes match
+        started = time.perf_counter()
+        dealer_sockets = self.dealer_selector_func(self, frames)
+        self.selector_timer.add(time.perf_counter() - started)
+        identity = None
+        for address, dealer_socket in dealer_sockets:
+            dealer_socket.send_multipart(frames, copy=False)
+            entry = self.dealers.get_by_socket(dealer_socket)
+            if entry is not None:
+                if identity is None:
+                    identity = reactor.frame_bytes(frames[0])
+                entry.request_sent(identity)
+                entry.counters.sent(frames, size)
+        self.tracer.sample("router", frames)
+
+    def handle_dealer_frames(self, dealer_socket, frames):
+        self.router_socket.send_multipart(frames, copy=False)
+        size = self.router_counters.sent(frames)
+        entry = self.dealers.get_by_socket(dealer_socket)
+        if entry is not None:
+            entry.reply_received(reactor.frame_bytes(frames[0]))
+            entry.counters.received(frames, size)
+        self.tracer.sample("dealer", frames)
+
+    def run_proxy(self):
+        if self.proxy_dealer_socket is None:
+            self.proxy_dealer_socket = self.context.socket(zmq.DEALER)
+        self.proxy_engine = proxy.SteerableProxy(self.context,
+                                                 self.router_socket,
+                                                 self.proxy_dealer_socket,
+                                                 self.capture_socket)
+        self.proxy_engine.start()
+        try:
+            while not self.quit:
+                if self.control_socket.poll(timeout=1000):
+                    frames = self.control_socket.recv_multipart()
+                    self.handle_control(self.control_socket, frames)
+        finally:
+            self.proxy_engine.close()
+            self.proxy_engine = None
 
     def handle_control(self, socket, frames):
         if len(frames) < 3:
@@ -79,7 +184,8 @@ class DealerRouterHub(object):
         if action is not None:
             try:
                 response = action(socket, sender, frames[2:])
-                response = [str(n).encode("utf8") for n in response]
+                response = [n if isinstance(n, bytes) else str(n).encode("utf8")
+                            for n in response]
             except Exception as ex:
                 logger.error(ex)
                 response = [b"error", str(ex).encode("utf8")]
@@ -94,38 +200,123 @@ class DealerRouterHub(object):
         self.quit = True
         return True, "ok"
 
+    def handle_stats(self, socket, sender, frames):
+        # msgpack {"uptime", "sockets", "peers", "timers"}
+        return True, self.metrics.pack()
+
+    def handle_trace_dump(self, socket, sender, frames):
+        # msgpack {"seen", "recorded", "records": [[time, name, sizes, prefix]]}
+        return True, self.tracer.pack()
+
+    def handle_trace_config(self, socket, sender, frames):
+        self.tracer.handle_config(frames)
+        return True, "ok"
+
     def handle_ping(self, socket, sender, frames):
         if self.log_ping:
             logger.debug("ping")
         return [True, "pong"] + frames
 
     def handle_connect_dealer(self, socket, sender, frames):
+        # d-connect <address> [route-prefix ...] - no prefixes routes everything
         address = frames[0]
+        prefixes = frames[1:] or [b""]
         key = None
         if self.dealer_key_func is not None:
             key = self.dealer_key_func(frames)
-        logger.info("Dealer Connect [%s]", address)
-        if address in self.dealer_sockets:
+        logger.info("Dealer Connect [%s] %s", address, prefixes)
+        if address in self.dealers:
             return True, "duplicate"
 
         if key is not None:
-            if key in self.dealer_sockets:
+            if key in self.dealers:
                 return True, "duplicate"
 
+        if self.engine == "proxy":
+            if self.proxy_dealer_socket is None:
+                self.proxy_dealer_socket = self.context.socket(zmq.DEALER)
+            with proxy.suspended(self.proxy_engine):
+                self.proxy_dealer_socket.connect(address)
+            self.dealers.add(address, key, self.proxy_dealer_socket, [])
+            return True, "ok"
+
         socket = self.context.socket(zmq.DEALER)
-        self.dealer_sockets[address] = socket
-        if key is not None:
-            self.dealer_sockets[key] = socket
+        entry = self.dealers.add(address, key, socket, prefixes)
+        entry.counters = self.metrics.peer(address.decode("utf8", "replace"))
 
-        self.poller.register(socket, zmq.POLLIN)
+        self.reactor.register(socket, self.handle_dealer_frames,
+                              copy=self.copy)
         socket.connect(address)
 
         return True, "ok"
 
+    def handle_add_route(self, socket, sender, frames):
+        # route-add <address or key> <route-prefix> [route-prefix ...]
+        entry = self.dealers.get(frames[0])
+        if entry is None:
+            raise Exception("Unknown dealer")
+        added = 0
+        for prefix in frames[1:]:
+            if self.dealers.add_route(entry, prefix):
+                added += 1
+        return True, added
+
+    def handle_remove_route(self, socket, sender, frames):
+        # route-remove <address or key> <route-prefix> [route-prefix ...]
+        entry = self.dealers.get(frames[0])
+        if entry is None:
+            raise Exception("Unknown dealer")
+        removed = 0
+        for prefix in frames[1:]:
+            if self.dealers.remove_route(entry, prefix):
+                removed += 1
+        return True, removed
+
+    def handle_balance(self, socket, sender, frames):
+        # balance broadcast|round-robin|least-outstanding|consistent-hash [frame-index]
+        self.balancer = balancing.make_balancer(frames[0], frames[1:])
+        logger.info("Balancer [%s]", frames[0])
+        return True, "ok"
+
+    def handle_inflight(self, socket, sender, frames):
+        # inflight [timeout <seconds>] - 0 keeps unanswered requests forever
+        if len(frames) > 1 and frames[0] == b"timeout":
+            self.inflight_timeout = float(frames[1])
+            self.next_expire = 0.0
+        response = [True, len(self.dealers)]
+        for entry in self.dealers.entries:
+            response.append(entry.address.decode("utf8", "replace"))
+            response.append(entry.outstanding)
+        return response
+
     def handle_bind_router(self, socket, sender, frames):
         address = frames[0]
         logger.info("Router Bind [%s]", address)
-        self.router_socket.bind(address)
+        with proxy.suspended(self.proxy_engine):
+            self.router_socket.bind(address)
+        return True, "ok"
+
+    def handle_bind_capture(self, socket, sender, frames):
+        address = frames[0]
+        if self.engine != "proxy":
+            raise Exception("capture needs the proxy engine")
+        logger.info("Capture Bind [%s]", address)
+        with proxy.suspended(self.proxy_engine):
+            if self.capture_socket is None:
+                self.capture_socket = self.context.socket(zmq.PUB)
+            self.capture_socket.bind(address)
+            if self.proxy_engine is not None:
+                self.proxy_engine.capture = self.capture_socket
         return True, "ok"
 
+    def handle_proxy_stats(self, socket, sender, frames):
+        if self.proxy_engine is None:
+            raise Exception("proxy engine not running")
+        response = [True]
+        for name, value in zip(proxy.STATISTICS_NAMES,
+                               self.proxy_engine.statistics()):
+            response.append(name)
+            response.append(value)
+        return response
+
 
@@ -0,0 +1,139 @@
+import time
+import logging
+import msgpack
+
+logger = logging.getLogger(__file__)
+
+
+class Counters(object):
+    # message, frame and byte counts in each direction for one socket or peer
+    __slots__ = ("msgs_in", "frames_in", "bytes_in",
+                 "msgs_out", "frames_out", "bytes_out")
+
+    def __init__(self):
+        self.msgs_in = self.frames_in = self.bytes_in = 0
+        self.msgs_out = self.frames_out = self.bytes_out = 0
+
+    def received(self, frames, size=None):
+        # size can be passed in when the same frames were already counted
+        if size is None:
+            size = 0
+            for frame in frames:
+                size += len(frame)
+        self.msgs_in += 1
+        self.frames_in += len(frames)
+        self.bytes_in += size
+        return size
+
+    def sent(self, frames, size=None):
+        if size is None:
+            size = 0
+            for frame in frames:
+                size += len(frame)
+        self.msgs_out += 1
+        self.frames_out += len(frames)
+        self.bytes_out += size
+        return size
+
+    def as_dict(self):
+        return dict((name, getattr(self, name)) for name in self.__slots__)
+
+
+class Timer(object):
+    # count, total and max of timed sections, in seconds
+    __slots__ = ("count", "total", "max")
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, elapsed):
+        self.count += 1
+        self.total += elapsed
+        if elapsed > self.max:
+            self.max = elapsed
+
+    def as_dict(self):
+        return {"count": self.count, "total": self.total, "max": self.max}
+
+
+class Histogram(Timer):
+    # a Timer that also counts into power of two buckets of microseconds,
+    # bucket n holding times below 2**n us, for percentiles
+    __slots__ = ("buckets",)
+
+    def __init__(self, size=32):
+        Timer.__init__(self)
+        self.buckets = [0] * size
+
+    def add(self, elapsed):
+        Timer.add(self, elapsed)
+        bucket = min(int(elapsed * 1e6).bit_length(), len(self.buckets) - 1)
+        self.buckets[bucket] += 1
+
+    def percentile(self, fraction):
+        # upper bound of the bucket it falls in, in seconds
+        rank = fraction * self.count
+        seen = 0
+        for bucket, count in enumerate(self.buckets):
+            seen += count
+            if count and seen >= rank:
+                return (1 << bucket) / 1e6
+        return 0.0
+
+    def as_dict(self):
+        values = Timer.as_dict(self)
+        values["buckets_us"] = dict((str(1 << bucket), count)
+                                    for bucket, count in enumerate(self.buckets)
+                                    if count)
+        for name, fraction in (("p50", 0.5), ("p99", 0.99), ("p999", 0.999)):
+            values[name] = self.percentile(fraction)
+        return values
+
+
+class Metrics(object):
+    def __init__(self):
+        self.started = time.time()
+        self.sockets = {}
+        self.peers = {}
+        self.timers = {}
+
+    def socket(self, name):
+        counters = self.sockets.get(name)
+        if counters is None:
+            counters = self.sockets[name] = Counters()
+        return counters
+
+    def peer(self, name):
+        counters = self.peers.get(name)
+        if counters is None:
+            counters = self.peers[name] = Counters()
+        return counters
+
+    def timer(self, name):
+        timer = self.timers.get(name)
+        if timer is None:
+            timer = self.timers[name] = Timer()
+        return timer
+
+    def histogram(self, name):
+        # kept with the timers
+        timer = self.timers.get(name)
+        if timer is None:
+            timer = self.timers[name] = Histogram()
+        return timer
+
+    def as_dict(self):
+        return {
+            "uptime": time.time() - self.started,
+            "sockets": dict((name, counters.as_dict())
+                            for name, counters in list(self.sockets.items())),
+            "peers": dict((name, counters.as_dict())
+                          for name, counters in list(self.peers.items())),
+            "timers": dict((name, timer.as_dict())
+                           for name, timer in list(self.timers.items())),
+        }
+
+    def pack(self):
+        return msgpack.packb(self.as_dict())
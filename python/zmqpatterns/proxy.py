@@ -0,0 +1,99 @@
+import zmq
+import struct
+import logging
+import threading
+import contextlib
+
+logger = logging.getLogger(__file__)
+
+STATISTICS_NAMES = [
+    "frontend_msgs_in", "frontend_bytes_in",
+    "frontend_msgs_out", "frontend_bytes_out",
+    "backend_msgs_in", "backend_bytes_in",
+    "backend_msgs_out", "backend_bytes_out",
+]
+
+
+class SteerableProxy(object):
+    # Runs libzmq's steerable proxy on a pair of data sockets in a background
+    # thread so messages never enter the Python interpreter. The sockets must
+    # not be touched by other threads while the proxy runs - use stopped()
+    # around connect/bind calls.
+    def __init__(self, context, frontend, backend, capture=None):
+        self.context = context
+        self.frontend = frontend
+        self.backend = backend
+        self.capture = capture
+        self.steering_socket = None
+        self._starts = 0
+        self._thread = None
+        self._totals = [0] * len(STATISTICS_NAMES)
+
+    def running(self):
+        return self._thread is not None
+
+    def start(self):
+        assert self._thread is None, (self, self._thread)
+        # fresh steering pair for every run, PAIR only accepts one peer
+        self._starts += 1
+        steering_address = "inproc://proxy-steering-%x-%d" % (id(self),
+                                                              self._starts)
+        self.steering_socket = self.context.socket(zmq.PAIR)
+        self.steering_socket.bind(steering_address)
+        control_socket = self.context.socket(zmq.PAIR)
+        control_socket.connect(steering_address)
+
+        def run():
+            try:
+                zmq.proxy_steerable(self.frontend, self.backend,
+                                    self.capture, control_socket)
+            except zmq.ContextTerminated:
+                pass
+            finally:
+                control_socket.close()
+
+        self._thread = threading.Thread(target=run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        if self._thread is None:
+            return
+        statistics = self.statistics()
+        self._totals = [a + b for a, b in zip(self._totals, statistics)]
+        self.steering_socket.send(b"TERMINATE")
+        self._thread.join()
+        self._thread = None
+        self.steering_socket.close(linger=0)
+        self.steering_socket = None
+
+    def statistics(self):
+        if self._thread is None:
+            return list(self._totals)
+        self.steering_socket.send(b"STATISTICS")
+        frames = self.steering_socket.recv_multipart()
+        values = [struct.unpack("=Q", frame)[0] for frame in frames]
+        return [a + b for a, b in zip(self._totals, values)]
+
+    @contextlib.contextmanager
+    def stopped(self):
+        was_running = self.running()
+        self.stop()
+        try:
+            yield self
+        finally:
+            if was_running:
+                self.start()
+
+    def close(self):
+        self.stop()
+
+
+@contextlib.contextmanager
+def suspended(proxy):
+    # no-op when the hub is running its own python loop
+    if proxy is None:
+        yield None
+        return
+    with proxy.stopped():
+        yield proxy
@@ -0,0 +1,105 @@
+import sys
+import zmq
+import time
+import argparse
+import logging
+import threading
+
+try:
+    from . import pubsub
+except ImportError:
+    import pubsub
+
+logger = logging.getLogger(__file__)
+
+
+def get_options():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--count', type=int, default=200000,
+                        help='messages to send per run')
+    parser.add_argument('--size', type=int, default=64,
+                        help='message size in bytes')
+    parser.add_argument('--transport', default="tcp",
+                        help='tcp, ipc or inproc')
+
+    return parser.parse_args()
+
+
+def make_addresses(transport, name):
+    if transport == "tcp":
+        return ["tcp://127.0.0.1:%d" % port for port in (19901, 19902, 19903)]
+    if transport == "ipc":
+        return ["ipc:///tmp/zmqpatterns-%s-%s" % (name, n)
+                for n in ("control", "up", "down")]
+    return ["inproc://%s-%s" % (name, n) for n in ("control", "up", "down")]
+
+
+def measure(engine, count, size, transport):
+    context = zmq.Context()
+    control_address, up_address, down_address = make_addresses(transport, engine)
+
+    hub = pubsub.PubSubHub(context, control_address, engine=engine)
+    for socket in (hub.sub_socket, hub.pub_socket):
+        socket.set_hwm(0)
+    thread = threading.Thread(target=hub.run)
+    thread.start()
+
+    publisher = context.socket(zmq.PUB)
+    publisher.set_hwm(0)
+    publisher.bind(up_address)
+
+    control = context.socket(zmq.DEALER)
+    control.connect(control_address)
+    for frames in ([b"sub-connect", up_address.encode("utf8")],
+                   [b"pub-bind", down_address.encode("utf8")]):
+        control.send_multipart(frames)
+        control.recv_multipart()
+
+    subscriber = context.socket(zmq.SUB)
+    subscriber.set_hwm(0)
+    subscriber.setsockopt(zmq.SUBSCRIBE, b"")
+    subscriber.connect(down_address)
+
+    # wait for the subscription to make it through both hops
+    while True:
+        publisher.send(b"warmup")
+        if subscriber.poll(timeout=100):
+            subscriber.recv()
+            break
+    while subscriber.poll(timeout=100):
+        subscriber.recv()
+
+    payload = b"x" * size
+    started = time.time()
+    for n in range(count):
+        publisher.send(payload)
+    for n in range(count):
+        subscriber.recv()
+    elapsed = time.time() - started
+
+    control.send_multipart([b"quit", b"now"])
+    control.recv_multipart()
+    thread.join()
+
+    for socket in (publisher, subscriber, control, hub.sub_socket,
+                   hub.pub_socket, hub.control_socket):
+        socket.close(linger=0)
+    context.term()
+
+    return count / elapsed
+
+
+def run():
+    options = get_options()
+    results = {}
+    for engine in ("loop", "proxy"):
+        results[engine] = measure(engine, options.count, options.size,
+                                  options.transport)
+        print("%-6s %12.0f msgs/s" % (engine, results[engine]))
+    print("proxy/loop: %.1fx" % (results["proxy"] / results["loop"]))
+    sys.stdout.flush()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.WARN)
+    run()
@@ -1,21 +1,41 @@
 import zmq
 import logging
 
+try:
+    from . import proxy
+    from . import reactor
+    from . import tracing
+    from . import metrics
+except ImportError:
+    import proxy
+    import reactor
+    import tracing
+    import metrics
+
 logger = logging.getLogger(__file__)
 
 class PubSubHub(object):
-    def __init__(self, context, control_address):
+    def __init__(self, context, control_address, engine="loop"):
         self.context = context
-        # TODO: Maybe another that uses XPUB/XSUB?
-        self.sub_socket = self.context.socket(zmq.SUB)
-        self.sub_socket.setsockopt(zmq.SUBSCRIBE, b"")
-        self.pub_socket = self.context.socket(zmq.PUB)
+        # "loop" forwards in python, "proxy" hands the data sockets to libzmq
+        self.engine = engine
+        self.proxy_engine = None
+        self.capture_socket = None
+        self.sub_socket = self.create_sub_socket()
+        self.pub_socket = self.create_pub_socket()
         self.control_socket = self.context.socket(zmq.ROUTER)
         self.control_socket.bind(control_address)
-        self.poller = zmq.Poller()
-
-        self.poller.register(self.sub_socket, zmq.POLLIN)
-        self.poller.register(self.control_socket, zmq.POLLIN)
+        self.reactor = reactor.Reactor()
+        self.tracer = tracing.Tracer()
+        self.metrics = metrics.Metrics()
+        self.reactor.loop_timer = self.metrics.timer("loop")
+        self.sub_counters = self.metrics.socket("sub")
+        self.pub_counters = self.metrics.socket("pub")
+
+        # frames are passed through untouched, so skip copying them to bytes
+        self.reactor.register(self.sub_socket, self.handle_sub_frames,
+                              copy=False)
+        self.reactor.register(self.control_socket, self.handle_control)
 
         self.quit = False
 
@@ -24,20 +44,50 @@ class PubSubHub(object):
             b"pub-bind": self.handle_bind_pub,
             b"ping": self.handle_ping,
             b"quit": self.handle_quit_request,
+            b"capture-bind": self.handle_bind_capture,
+            b"proxy-stats": self.handle_proxy_stats,
+            b"trace-dump": self.handle_trace_dump,
+            b"trace-config": self.handle_trace_config,
+            b"stats": self.handle_stats,
         }
 
+    def create_sub_socket(self):
+        socket = self.context.socket(zmq.SUB)
+        socket.setsockopt(zmq.SUBSCRIBE, b"")
+        return socket
+
+    def create_pub_socket(self):
+        return self.context.socket(zmq.PUB)
+
     def run(self):
-        while not self.quit:
-            for socket, event in self.poller.poll(timeout=1000):
-                if socket == self.sub_socket:
-                    frames = self.sub_socket.recv_multipart()
-                    self.pub_socket.send_multipart(frames)
-                    continue
-
-                if socket == self.control_socket:
-                    frames = socket.recv_multipart()
-                    self.handle_control(socket, frames)
-                    continue
+        if self.engine == "proxy":
+            return self.run_proxy()
+
+        self.reactor.run(self.continue_running)
+
+    def continue_running(self):
+        return not self.quit
+
+    def handle_sub_frames(self, socket, frames):
+        self.pub_socket.send_multipart(frames, copy=False)
+        size = self.sub_counters.received(frames)
+        self.pub_counters.sent(frames, size)
+        self.tracer.sample("sub", frames)
+
+    def run_proxy(self):
+        self.proxy_engine = proxy.SteerableProxy(self.context,
+                                                 self.sub_socket,
+                                                 self.pub_socket,
+                                                 self.capture_socket)
+        self.proxy_engine.start()
+        try:
+            while not self.quit:
+                if self.control_socket.poll(timeout=1000):
+                    frames = self.control_socket.recv_multipart()
+                    self.handle_control(self.control_socket, frames)
+        finally:
+            self.proxy_engine.close()
+            self.proxy_engine = None
 
     def handle_control(self, socket, frames):
         if len(frames) < 3:
@@ -54,7 +104,8 @@ class PubSubHub(object):
         if action is not None:
             try:
                 response = action(socket, sender, frames[2:])
-                response = [str(n).encode("utf8") for n in response]
+                response = [n if isinstance(n, bytes) else str(n).encode("utf8")
+                            for n in response]
             except Exception as ex:
                 logger.error(ex)
                 response = [b"error", str(ex).encode("utf8")]
@@ -69,6 +120,18 @@ class PubSubHub(object):
         self.quit = True
         return True, "ok"
 
+    def handle_stats(self, socket, sender, frames):
+        # msgpack {"uptime", "sockets", "peers", "timers"}
+        return True, self.metrics.pack()
+
+    def handle_trace_dump(self, socket, sender, frames):
+        # msgpack {"seen", "recorded", "records": [[time, name, sizes, prefix]]}
+        return True, self.tracer.pack()
+
+    def handle_trace_config(self, socket, sender, frames):
+        self.tracer.handle_config(frames)
+        return True, "ok"
+
     def handle_ping(self, socket, sender, frames):
         logger.debug("ping")
         return [True, "pong"] + frames
@@ -76,13 +139,90 @@ class PubSubHub(object):
     def handle_connect_sub(self, socket, sender, frames):
         address = frames[0]
         logger.info("SUB Connect [%s]", address)
-        self.sub_socket.connect(address)
+        with proxy.suspended(self.proxy_engine):
+            self.sub_socket.connect(address)
         return True, "ok"
 
     def handle_bind_pub(self, socket, sender, frames):
         address = frames[0]
         logger.info("PUB Bind [%s]", address)
-        self.pub_socket.bind(address)
+        with proxy.suspended(self.proxy_engine):
+            self.pub_socket.bind(address)
+        return True, "ok"
+
+    def handle_bind_capture(self, socket, sender, frames):
+        address = frames[0]
+        if self.engine != "proxy":
+            raise Exception("capture needs the proxy engine")
+        logger.info("Capture Bind [%s]", address)
+        with proxy.suspended(self.proxy_engine):
+            if self.capture_socket is None:
+                self.capture_socket = self.context.socket(zmq.PUB)
+            self.capture_socket.bind(address)
+            if self.proxy_engine is not None:
+                self.proxy_engine.capture = self.capture_socket
         return True, "ok"
 
+    def handle_proxy_stats(self, socket, sender, frames):
+        if self.proxy_engine is None:
+            raise Exception("proxy engine not running")
+        response = [True]
+        for name, value in zip(proxy.STATISTICS_NAMES,
+                               self.proxy_engine.statistics()):
+            response.append(name)
+            response.append(value)
+        return response
+
+
+# Only forwards what downstream subscribers asked for: subscribe and
+# unsubscribe messages from the XPUB side are passed on to every upstream
+# connected via sub-connect, so unwanted topics are filtered at the source
+# publishers. XSUB replays current subscriptions to upstreams connected later.
+class XPubXSubHub(PubSubHub):
+    def __init__(self, context, control_address, engine="loop"):
+        # topic -> number of downstream subscriptions, only kept by the
+        # loop engine - the proxy engine forwards subscriptions in libzmq
+        self.subscriptions = {}
+        super(XPubXSubHub, self).__init__(context, control_address, engine)
+        self.reactor.register(self.pub_socket, self.handle_subscription)
+        self.actions[b"subscriptions"] = self.handle_list_subscriptions
+
+    def create_sub_socket(self):
+        return self.context.socket(zmq.XSUB)
+
+    def create_pub_socket(self):
+        socket = self.context.socket(zmq.XPUB)
+        # see every subscribe and unsubscribe so the table can be ref counted
+        socket.setsockopt(zmq.XPUB_VERBOSER, 1)
+        return socket
+
+    def handle_subscription(self, socket, frames):
+        self.pub_counters.received(frames)
+        message = frames[0]
+        if len(message) < 1 or message[0] not in (0, 1):
+            # not a subscription message - pass it on as is
+            self.sub_socket.send_multipart(frames)
+            return
 
+        topic = message[1:]
+        count = self.subscriptions.get(topic, 0)
+        if message[0] == 1:
+            self.subscriptions[topic] = count + 1
+            if count == 0:
+                logger.debug("subscribe upstream [%s]", topic)
+                self.sub_socket.send(message)
+        elif count > 0:
+            count -= 1
+            if count == 0:
+                del self.subscriptions[topic]
+                logger.debug("unsubscribe upstream [%s]", topic)
+                self.sub_socket.send(message)
+            else:
+                self.subscriptions[topic] = count
+
+    def handle_list_subscriptions(self, socket, sender, frames):
+        response = [True, len(self.subscriptions)]
+        for topic, count in sorted(self.subscriptions.items()):
+            response.append(topic.decode("utf8", "replace"))
+            response.append(count)
+        return response
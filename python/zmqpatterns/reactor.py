@@ -0,0 +1,86 @@
+import zmq
+import time
+import logging
+
+logger = logging.getLogger(__file__)
+
+
+def frame_bytes(frame):
+    # handlers registered with copy=False get zmq.Frame objects, only turn
+    # them into bytes where the content is actually looked at
+    if isinstance(frame, zmq.Frame):
+        return frame.bytes
+    return frame
+
+
+class Reactor(object):
+    # Poll loop shared by the hubs and bridges. Every readable socket is
+    # drained with NOBLOCK, up to batch_size messages or time_budget seconds,
+    # before polling again, so a burst costs one poll instead of one per
+    # message. Handlers are called as handler(socket, frames), with zmq.Frame
+    # objects instead of bytes when registered with copy=False.
+    def __init__(self, batch_size=256, time_budget=0.01, timeout=1000):
+        self.batch_size = batch_size
+        self.time_budget = time_budget
+        self.timeout = timeout
+        self.poller = zmq.Poller()
+        self.handlers = {}
+        # optional metrics.Timer fed with the time spent handling each poll
+        self.loop_timer = None
+
+    def register(self, socket, handler, copy=True):
+        self.handlers[socket] = (handler, copy)
+        self.poller.register(socket, zmq.POLLIN)
+
+    def unregister(self, socket):
+        if socket not in self.handlers:
+            return
+        del self.handlers[socket]
+        self.poller.unregister(socket)
+
+    def registered(self, socket):
+        return socket in self.handlers
+
+    def poll_once(self, timeout=None):
+        # returns the number of messages handled
+        if timeout is None:
+            timeout = self.timeout
+        handled = 0
+        events = self.poller.poll(timeout=timeout)
+        if self.loop_timer is None:
+            for socket, event in events:
+                handled += self.drain(socket)
+            return handled
+        started = time.perf_counter()
+        for socket, event in events:
+            handled += self.drain(socket)
+        if events:
+            self.loop_timer.add(time.perf_counter() - started)
+        return handled
+
+    def drain(self, socket):
+        handler = self.handlers.get(socket)
+        if handler is None:
+            # unregistered by an earlier handler in this poll
+            return 0
+        handler, copy = handler
+        deadline = None
+        if self.time_budget:
+            deadline = time.monotonic() + self.time_budget
+        handled = 0
+        while handled < self.batch_size:
+            try:
+                frames = socket.recv_multipart(zmq.NOBLOCK, copy=copy)
+            except zmq.Again:
+                break
+            handler(socket, frames)
+            handled += 1
+            if socket not in self.handlers:
+                break
+            if deadline is not None and time.monotonic() > deadline:
+                break
+        return handled
+
+    def run(self, continue_running):
+        while continue_running():
+            self.poll_once()
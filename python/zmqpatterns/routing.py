@@ -0,0 +1,188 @@
+import time
+import logging
+
+try:
+    from .reactor import frame_bytes
+except ImportError:
+    from reactor import frame_bytes
+
+logger = logging.getLogger(__file__)
+
+
+def frame_selector(index):
+    # route on a whole frame, index 1 is the first frame after the
+    # ROUTER identity
+    def select(frames):
+        if len(frames) > index:
+            return frame_bytes(frames[index])
+        return b""
+    return select
+
+
+def field_selector(index, field, separator=b" "):
+    # route on one field of a frame, e.g. b"orders.eu some-payload"
+    def select(frames):
+        if len(frames) <= index:
+            return b""
+        fields = frame_bytes(frames[index]).split(separator, field + 1)
+        if len(fields) <= field:
+            return b""
+        return fields[field]
+    return select
+
+
+class PrefixIndex(object):
+    # Byte trie mapping prefixes to sets of values. A lookup walks the key
+    # once and collects the values stored on the way, so the cost depends on
+    # the key length and the number of matches, not on how many values are
+    # stored.
+    def __init__(self):
+        self.root = ({}, set())
+
+    def add(self, prefix, value):
+        children, values = self.root
+        for byte in prefix:
+            node = children.get(byte)
+            if node is None:
+                node = children[byte] = ({}, set())
+            children, values = node
+        values.add(value)
+
+    def remove(self, prefix, value):
+        path = []
+        node = self.root
+        for byte in prefix:
+            child = node[0].get(byte)
+            if child is None:
+                return False
+            path.append((node, byte))
+            node = child
+        if value not in node[1]:
+            return False
+        node[1].discard(value)
+        # prune branches that no longer hold anything
+        while path and not node[0] and not node[1]:
+            parent, byte = path.pop()
+            del parent[0][byte]
+            node = parent
+        return True
+
+    def match(self, key):
+        children, values = self.root
+        matched = list(values)
+        for byte in key:
+            node = children.get(byte)
+            if node is None:
+                break
+            children, values = node
+            if values:
+                matched.extend(values)
+        return matched
+
+
+class DealerEntry(object):
+    def __init__(self, address, key, socket):
+        self.address = address
+        self.key = key
+        self.socket = socket
+        self.prefixes = set()
+        # requests sent and not yet answered, per ROUTER identity, as
+        # [count, time of the last request or reply]
+        self.inflight = {}
+        self.outstanding = 0
+        # metrics.Counters, set by the hub
+        self.counters = None
+
+    def request_sent(self, identity, now=None):
+        if now is None:
+            now = time.monotonic()
+        pending = self.inflight.get(identity)
+        if pending is None:
+            self.inflight[identity] = [1, now]
+        else:
+            pending[0] += 1
+            pending[1] = now
+        self.outstanding += 1
+
+    def reply_received(self, identity, now=None):
+        pending = self.inflight.get(identity)
+        if pending is None:
+            # not a reply to anything we sent, e.g. a dealer pushing data
+            return
+        if pending[0] == 1:
+            del self.inflight[identity]
+        else:
+            pending[0] -= 1
+            pending[1] = now if now is not None else time.monotonic()
+        self.outstanding -= 1
+
+    def expire(self, before):
+        # forgets the requests of identities with no request or reply
+        # since before: dropped, one way, or their caller went away
+        expired = 0
+        for identity, pending in list(self.inflight.items()):
+            if pending[1] < before:
+                del self.inflight[identity]
+                expired += pending[0]
+        self.outstanding -= expired
+        return expired
+
+
+class DealerRegistry(object):
+    # One entry per dealer socket, reachable by address or key, plus the
+    # prefix index used to pick dealers for a message.
+    def __init__(self):
+        self.entries = []
+        self.by_name = {}
+        self.by_socket = {}
+        self.routes = PrefixIndex()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, name):
+        return name in self.by_name
+
+    def get(self, name):
+        return self.by_name.get(name, None)
+
+    def get_by_socket(self, socket):
+        return self.by_socket.get(socket, None)
+
+    def add(self, address, key, socket, prefixes):
+        entry = DealerEntry(address, key, socket)
+        self.entries.append(entry)
+        self.by_name[address] = entry
+        if key is not None:
+            self.by_name[key] = entry
+        self.by_socket[socket] = entry
+        for prefix in prefixes:
+            self.add_route(entry, prefix)
+        return entry
+
+    def add_route(self, entry, prefix):
+        if prefix in entry.prefixes:
+            return False
+        entry.prefixes.add(prefix)
+        self.routes.add(prefix, entry)
+        return True
+
+    def remove_route(self, entry, prefix):
+        if prefix not in entry.prefixes:
+            return False
+        entry.prefixes.discard(prefix)
+        self.routes.remove(prefix, entry)
+        return True
+
+    def match(self, key):
+        entries = self.routes.match(key)
+        if len(entries) < 2:
+            return entries
+        # a dealer routed on both b"a" and b"ab" gets a message only once
+        seen = set()
+        unique = []
+        for entry in entries:
+            if entry not in seen:
+                seen.add(entry)
+                unique.append(entry)
+        return unique
@@ -0,0 +1,85 @@
+import zmq
+import time
+import logging
+import msgpack
+
+logger = logging.getLogger(__file__)
+
+
+class Tracer(object):
+    # Sampled message tracing for the data paths. Sampled messages are kept
+    # as compact (timestamp, socket name, frame sizes, payload prefix)
+    # records in a fixed size ring, nothing is formatted until dump() is
+    # asked for. Sample 1-in-sample_every messages, or at most per_second
+    # messages a second when per_second is set; sample_every=0 disables it.
+    def __init__(self, capacity=1024, sample_every=1000, per_second=None,
+                 prefix_size=16):
+        self.capacity = capacity
+        self.prefix_size = prefix_size
+        self.records = [None] * capacity
+        self.recorded = 0
+        self.seen = 0
+        self.configure(sample_every, per_second)
+
+    def configure(self, sample_every=None, per_second=None):
+        self.sample_every = sample_every or 0
+        self.per_second = per_second
+        self.second = 0
+        self.second_used = 0
+
+    def sample(self, name, frames):
+        self.seen += 1
+        if self.per_second is not None:
+            now = int(time.time())
+            if now != self.second:
+                self.second = now
+                self.second_used = 0
+            if self.second_used >= self.per_second:
+                return
+            self.second_used += 1
+        elif not self.sample_every or self.seen % self.sample_every:
+            return
+        self.record(name, frames)
+
+    def record(self, name, frames):
+        sizes = [len(frame) for frame in frames]
+        prefix = b""
+        if frames:
+            last = frames[-1]
+            if isinstance(last, zmq.Frame):
+                prefix = last.buffer[:self.prefix_size].tobytes()
+            else:
+                prefix = bytes(last[:self.prefix_size])
+        self.records[self.recorded % self.capacity] = (time.time(), name,
+                                                       sizes, prefix)
+        self.recorded += 1
+
+    def dump(self):
+        # oldest first
+        if self.recorded <= self.capacity:
+            records = self.records[:self.recorded]
+        else:
+            start = self.recorded % self.capacity
+            records = self.records[start:] + self.records[:start]
+        return [list(record) for record in records]
+
+    def pack(self):
+        return msgpack.packb({"seen": self.seen,
+                              "recorded": self.recorded,
+                              "records": self.dump()})
+
+    def handle_config(self, frames):
+        # trace-config sample-every <n> | per-second <n> | off
+        mode = frames[0]
+        if mode == b"off":
+            self.configure(0, None)
+        elif mode == b"sample-every":
+            self.configure(int(frames[1]), None)
+        elif mode == b"per-second":
+            self.configure(None, int(frames[1]))
+        else:
+            raise Exception("Unknown trace mode: %s" % mode.decode("utf8", "replace"))
+
+    def log_dump(self):
+        for timestamp, name, sizes, prefix in self.dump():
+            logger.info("%.6f %s %s %s", timestamp, name, sizes, prefix)
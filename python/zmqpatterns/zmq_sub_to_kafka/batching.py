@@ -0,0 +1,130 @@
+import time
+import logging
+import collections
+import msgpack
+
+logger = logging.getLogger(__file__)
+
+# A batch is one Kafka record holding many msgpack packed ZMQ messages:
+#   msgpack ExtType(BATCH_EXT_TYPE, msgpack.packb([packed_frames, ...]))
+# An unbatched record is a plain msgpack.packb(frames) list, which never
+# starts with an ext type byte, so both can share a topic.
+
+BATCH_EXT_TYPE = 66
+# marks a batch sent over ZMQ by a sink_pool.SinkPool, as
+# [SINK_BATCH, batch] after the ROUTER identity
+SINK_BATCH = b"ZSB\x01"
+EXT_TYPE_BYTES = frozenset(b"\xc7\xc8\xc9\xd4\xd5\xd6\xd7\xd8")
+
+
+def is_batch(value):
+    return len(value) > 0 and value[0] in EXT_TYPE_BYTES
+
+
+def pack_batch(records):
+    return msgpack.packb(msgpack.ExtType(BATCH_EXT_TYPE,
+                                         msgpack.packb(records)))
+
+
+def unpack_records(value):
+    # the packed ZMQ messages carried by one Kafka record
+    if not is_batch(value):
+        return [value]
+    ext = msgpack.unpackb(value)
+    if ext.code != BATCH_EXT_TYPE:
+        raise ValueError("unknown ext type: %s" % ext.code)
+    return msgpack.unpackb(ext.data)
+
+
+class Batcher(object):
+    # collects packed messages until max_count, max_bytes or linger seconds
+    # since the first one is reached
+    def __init__(self, max_count=100, max_bytes=65536, linger=0.005):
+        self.max_count = max_count
+        self.max_bytes = max_bytes
+        self.linger = linger
+        self.records = []
+        self.size = 0
+        self.deadline = None
+
+    def __len__(self):
+        return len(self.records)
+
+    def add(self, record):
+        if not self.records:
+            self.deadline = time.monotonic() + self.linger
+        self.records.append(record)
+        self.size += len(record)
+        return self.full()
+
+    def full(self):
+        return len(self.records) >= self.max_count or self.size >= self.max_bytes
+
+    def expired(self):
+        return self.deadline is not None and time.monotonic() >= self.deadline
+
+    def remaining(self):
+        # seconds until the linger time is up, None when empty
+        if self.deadline is None:
+            return None
+        return max(0.0, self.deadline - time.monotonic())
+
+    def flush(self):
+        records = self.records
+        self.records = []
+        self.size = 0
+        self.deadline = None
+        if len(records) == 1:
+            # not worth the batch wrapper
+            return records[0]
+        return pack_batch(records)
+
+
+class KeyedBatcher(object):
+    # a Batcher per partition key, so a batch only holds messages of one key
+    # and goes to that key's partition. They are kept oldest first, which
+    # is also the order they expire in.
+    def __init__(self, max_count=100, max_bytes=65536, linger=0.005):
+        self.max_count = max_count
+        self.max_bytes = max_bytes
+        self.linger = linger
+        self.batchers = collections.OrderedDict()
+        self.count = 0
+
+    def __len__(self):
+        return self.count
+
+    def add(self, record, key=None):
+        # True when the batch for key is full
+        batcher = self.batchers.get(key)
+        if batcher is None:
+            batcher = self.batchers[key] = Batcher(self.max_count,
+                                                   self.max_bytes,
+                                                   self.linger)
+        self.count += 1
+        return batcher.add(record)
+
+    def oldest(self):
+        for key, batcher in self.batchers.items():
+            return batcher
+        return None
+
+    def expired(self):
+        batcher = self.oldest()
+        return batcher is not None and batcher.expired()
+
+    def remaining(self):
+        batcher = self.oldest()
+        if batcher is None:
+            return None
+        return batcher.remaining()
+
+    def flush(self, key):
+        # (record value, key)
+        batcher = self.batchers.pop(key)
+        self.count -= len(batcher)
+        return batcher.flush(), key
+
+    def flush_oldest(self):
+        for key in self.batchers:
+            return self.flush(key)
@@ -0,0 +1,274 @@
+import sys
+import zmq
+import mmap
+import time
+import struct
+import argparse
+import binascii
+import logging
+import msgpack
+
+logger = logging.getLogger(__file__)
+
+# Binary capture format, network byte order:
+#   file header  4s magic b"ZCAP", B version
+#   per message  Q receive time, nanoseconds since the epoch
+#                I number of frames
+#   per frame    I length, then the frame bytes
+
+MAGIC = b"ZCAP"
+VERSION = 1
+FILE_HEADER = struct.Struct("!4sB")
+MESSAGE_HEADER = struct.Struct("!QI")
+FRAME_LENGTH = struct.Struct("!I")
+
+
+class CaptureWriter(object):
+    def __init__(self, filename):
+        self.hFile = open(filename, "wb")
+        self.hFile.write(FILE_HEADER.pack(MAGIC, VERSION))
+        self.count = 0
+
+    def write(self, time_ns, frames):
+        parts = [MESSAGE_HEADER.pack(time_ns, len(frames))]
+        for frame in frames:
+            parts.append(FRAME_LENGTH.pack(len(frame)))
+            parts.append(frame)
+        self.hFile.write(b"".join(parts))
+        self.count += 1
+
+    def close(self):
+        self.hFile.close()
+
+
+class CaptureReader(object):
+    # frames are memoryviews into the mapped file, valid until close()
+    def __init__(self, filename):
+        self.hFile = open(filename, "rb")
+        self.map = mmap.mmap(self.hFile.fileno(), 0, access=mmap.ACCESS_READ)
+        self.view = memoryview(self.map)
+        magic, version = FILE_HEADER.unpack_from(self.map)
+        if magic != MAGIC:
+            raise Exception("%s is not a capture file" % filename)
+        if version != VERSION:
+            raise Exception("Unknown capture version: %s" % version)
+
+    def __iter__(self):
+        view = self.view
+        size = len(view)
+        offset = FILE_HEADER.size
+        while offset + MESSAGE_HEADER.size <= size:
+            time_ns, count = MESSAGE_HEADER.unpack_from(view, offset)
+            offset += MESSAGE_HEADER.size
+            frames = []
+            for n in range(count):
+                (length,) = FRAME_LENGTH.unpack_from(view, offset)
+                offset += FRAME_LENGTH.size
+                frames.append(view[offset:offset + length])
+                offset += length
+            if offset > size:
+                logger.warn("Capture ends in a partial message")
+                break
+            yield time_ns, frames
+
+    def close(self):
+        self.view.release()
+        self.map.close()
+        self.hFile.close()
+
+
+def convert(filenames, output, interval_ms):
+    # the hex .log files carry no times, so messages are spaced interval_ms
+    # apart, which is how dummy_publishers.run2 played them
+    writer = CaptureWriter(output)
+    time_ns = time.time_ns()
+    step = int(interval_ms * 1e6)
+    for filename in filenames:
+        with open(filename, "r") as hFile:
+            for line in hFile:
+                line = line.strip()
+                if line == "":
+                    continue
+                frames = msgpack.unpackb(binascii.unhexlify(line))
+                writer.write(time_ns, frames)
+                time_ns += step
+    writer.close()
+    logger.info("Converted %s messages into %s", writer.count, output)
+
+
+def record(addresses, output, count=None, duration=None):
+    context = zmq.Context()
+    socket = context.socket(zmq.SUB)
+    socket.setsockopt(zmq.SUBSCRIBE, b"")
+    for address in addresses:
+        socket.connect(address)
+
+    writer = CaptureWriter(output)
+    end = None
+    if duration is not None:
+        end = time.monotonic() + duration
+    try:
+        while count is None or writer.count < count:
+            if end is not None:
+                remaining = end - time.monotonic()
+                if remaining <= 0:
+                    break
+                if not socket.poll(remaining * 1000):
+                    continue
+            frames = socket.recv_multipart()
+            writer.write(time.time_ns(), frames)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        writer.close()
+        socket.close()
+        context.term()
+    logger.info("Recorded %s messages into %s", writer.count, output)
+
+
+class RateReport(object):
+    def __init__(self, interval=1.0):
+        self.interval = interval
+        self.start = time.monotonic()
+        self.next_report = self.start + interval
+        self.messages = 0
+        self.size = 0
+        self.lag = 0.0
+
+    def add(self, size, now):
+        self.messages += 1
+        self.size += size
+        if now >= self.next_report:
+            self.next_report = now + self.interval
+            self.log(now)
+
+    def log(self, now):
+        elapsed = max(now - self.start, 1e-9)
+        logger.info("%s msgs %.0f msgs/s %.1f MB/s lag %.3fs", self.messages,
+                    self.messages / elapsed, self.size / elapsed / 1e6,
+                    self.lag)
+
+
+def replay(filename, addresses, speed=1.0, loops=1, wait=1.0, hwm=None,
+           report_interval=1.0):
+    # speed 1 is real time, N is N times faster and 0 as fast as possible
+    context = zmq.Context()
+    socket = context.socket(zmq.PUB)
+    if hwm is not None:
+        socket.set_hwm(hwm)
+    for address in addresses:
+        socket.bind(address)
+    # give subscribers the chance to connect before anything is dropped
+    time.sleep(wait)
+
+    reader = CaptureReader(filename)
+    report = RateReport(report_interval)
+    first_ns = None
+    recorded_ns = 0
+    try:
+        for n in range(loops):
+            start = time.monotonic()
+            for time_ns, frames in reader:
+                if first_ns is None:
+                    first_ns = time_ns
+                now = time.monotonic()
+                if speed > 0:
+                    due = start + (time_ns - first_ns) / 1e9 / speed
+                    if due > now:
+                        time.sleep(due - now)
+                        now = time.monotonic()
+                    else:
+                        report.lag = now - due
+                socket.send_multipart(frames)
+                report.add(sum(map(len, frames)), now)
+                last_ns = time_ns
+            if first_ns is not None:
+                recorded_ns += last_ns - first_ns
+            first_ns = None
+    except KeyboardInterrupt:
+        pass
+    finally:
+        # the frames point into the mapped file, which cannot be closed
+        # while they are still around
+        frames = None
+        report.log(time.monotonic())
+        if report.messages and recorded_ns:
+            logger.info("recorded rate %.0f msgs/s",
+                        report.messages / (recorded_ns / 1e9))
+        reader.close()
+        socket.close(linger=0)
+        context.term()
+    return report
+
+
+def get_options():
+    parser = argparse.ArgumentParser()
+    commands = parser.add_subparsers(dest="command")
+
+    parser_convert = commands.add_parser("convert",
+                                         help='convert hex .log files')
+    parser_convert.add_argument('filenames', nargs='+')
+    parser_convert.add_argument('--output',
+                                help='capture file to write')
+    parser_convert.add_argument('--interval_ms', type=float, default=10,
+                                help='time between converted messages')
+
+    parser_record = commands.add_parser("record",
+                                        help='record from PUB sockets')
+    parser_record.add_argument('--connect', action='append',
+                               help='address to subscribe to, may be repeated')
+    parser_record.add_argument('--output',
+                               help='capture file to write')
+    parser_record.add_argument('--count', type=int,
+                               help='stop after this many messages')
+    parser_record.add_argument('--duration', type=float,
+                               help='stop after this many seconds')
+
+    parser_replay = commands.add_parser("replay",
+                                        help='replay a capture file')
+    parser_replay.add_argument('filename')
+    parser_replay.add_argument('--bind', action='append',
+                               help='PUB address to bind, may be repeated')
+    parser_replay.add_argument('--speed', type=float, default=1.0,
+                               help='1 for real time, N for N times faster, '
+                               '0 for as fast as possible')
+    parser_replay.add_argument('--loops', type=int, default=1,
+                               help='times to play the capture')
+    parser_replay.add_argument('--wait', type=float, default=1.0,
+                               help='seconds to wait for subscribers')
+    parser_replay.add_argument('--hwm', type=int,
+                               help='PUB send high water mark')
+    parser_replay.add_argument('--report_interval', type=float, default=1.0,
+                               help='seconds between rate reports')
+
+    parsed = parser.parse_args()
+
+    if parsed.command is None:
+        raise Exception("Please specify convert, record or replay")
+    if parsed.command in ("convert", "record") and parsed.output is None:
+        raise Exception("Please specify --output")
+    if parsed.command == "record" and parsed.connect is None:
+        raise Exception("Please specify --connect")
+    if parsed.command == "replay" and parsed.bind is None:
+        raise Exception("Please specify --bind")
+
+    return parsed
+
+
+def run():
+    options = get_options()
+
+    if options.command == "convert":
+        convert(options.filenames, options.output, options.interval_ms)
+    elif options.command == "record":
+        record(options.connect, options.output, options.count,
+               options.duration)
+    else:
+        replay(options.filename, options.bind, speed=options.speed,
+               loops=options.loops, wait=options.wait, hwm=options.hwm,
+               report_interval=options.report_interval)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    run()
@@ -0,0 +1,115 @@
+import zlib
+import logging
+
+try:
+    import lz4.frame as lz4_frame
+except ImportError:
+    lz4_frame = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+logger = logging.getLogger(__file__)
+
+# Compressed Kafka values start with two header bytes: MARKER and the codec
+# id. MARKER (0xc1) is never produced by msgpack, so values without it are
+# passed through as is - consumers can be upgraded before producers.
+
+MARKER = 0xc1
+
+
+class ZlibCodec(object):
+    id = 1
+    name = "zlib"
+
+    def __init__(self, level=1):
+        self.level = level
+
+    def compress(self, value):
+        return zlib.compress(value, self.level)
+
+    def decompress(self, value):
+        return zlib.decompress(value)
+
+
+class Lz4Codec(object):
+    id = 2
+    name = "lz4"
+
+    def __init__(self, level=0):
+        self.level = level
+
+    def compress(self, value):
+        return lz4_frame.compress(value, compression_level=self.level)
+
+    def decompress(self, value):
+        return lz4_frame.decompress(value)
+
+
+class ZstdCodec(object):
+    id = 3
+    name = "zstd"
+
+    def __init__(self, level=3):
+        self.level = level
+        self.compressor = zstandard.ZstdCompressor(level=level)
+        self.decompressor = zstandard.ZstdDecompressor()
+
+    def compress(self, value):
+        return self.compressor.compress(value)
+
+    def decompress(self, value):
+        return self.decompressor.decompress(value)
+
+
+CODECS = [ZlibCodec]
+if lz4_frame is not None:
+    CODECS.append(Lz4Codec)
+if zstandard is not None:
+    CODECS.append(ZstdCodec)
+
+KNOWN_CODECS = {"none": None, "zlib": 1, "lz4": 2, "zstd": 3}
+
+
+def available():
+    return ["none"] + [codec.name for codec in CODECS]
+
+
+def get_codec(name, level=None):
+    # None for "none", so callers can pass the result straight to encode()
+    if name is None or name == "none":
+        return None
+    for codec in CODECS:
+        if codec.name == name:
+            if level is None:
+                return codec()
+            return codec(level)
+    if name in KNOWN_CODECS:
+        raise Exception("Codec %s is not installed" % name)
+    raise Exception("Unknown codec: %s" % name)
+
+
+_decoders = {}
+
+
+def encode(value, codec):
+    if codec is None:
+        return value
+    return bytes((MARKER, codec.id)) + codec.compress(value)
+
+
+def decode(value):
+    if len(value) < 2 or value[0] != MARKER:
+        return value
+    codec_id = value[1]
+    codec = _decoders.get(codec_id)
+    if codec is None:
+        for codec_class in CODECS:
+            if codec_class.id == codec_id:
+                codec = _decoders[codec_id] = codec_class()
+                break
+        else:
+            raise Exception("Unknown or uninstalled codec id: %s" % codec_id)
+    return codec.decompress(value[2:])
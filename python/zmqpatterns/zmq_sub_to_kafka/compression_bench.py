@@ -0,0 +1,94 @@
+import sys
+import time
+import argparse
+import binascii
+import logging
+
+try:
+    from . import batching
+    from . import compression
+except ImportError:
+    import batching
+    import compression
+
+logger = logging.getLogger(__file__)
+
+def get_options():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('filenames', nargs='*',
+                        default=["../data1.log", "../data2.log"],
+                        help='hex encoded msgpack captures, one message per line')
+    parser.add_argument('--batch_count', type=int, action='append',
+                        help='messages per kafka record, may be repeated')
+    parser.add_argument('--repeat', type=int, default=5,
+                        help='passes over the records per codec')
+    parser.add_argument('--level', type=int,
+                        help='codec specific compression level')
+
+    return parser.parse_args()
+
+
+def load_messages(filenames):
+    # the same lines dummy_publishers.py sends, already msgpack packed frames
+    messages = []
+    for filename in filenames:
+        with open(filename, "r") as hFile:
+            for line in hFile:
+                line = line.strip()
+                if line == "":
+                    continue
+                messages.append(binascii.unhexlify(line))
+    return messages
+
+
+def make_records(messages, batch_count):
+    if batch_count <= 1:
+        return messages
+    return [batching.pack_batch(messages[n:n + batch_count])
+            for n in range(0, len(messages), batch_count)]
+
+
+def measure(records, codec, repeat):
+    raw_size = sum(len(record) for record in records)
+
+    start = time.perf_counter()
+    for n in range(repeat):
+        encoded = [compression.encode(record, codec) for record in records]
+    encode_time = (time.perf_counter() - start) / repeat
+
+    start = time.perf_counter()
+    for n in range(repeat):
+        for value in encoded:
+            compression.decode(value)
+    decode_time = (time.perf_counter() - start) / repeat
+
+    encoded_size = sum(len(value) for value in encoded)
+    return raw_size, encoded_size, encode_time, decode_time
+
+
+def run():
+    options = get_options()
+    messages = load_messages(options.filenames)
+    if not messages:
+        raise Exception("No messages in %s" % ", ".join(options.filenames))
+
+    print("%d messages, %d bytes" % (len(messages), sum(map(len, messages))))
+    print("%-6s %6s %8s %7s %12s %12s" % ("codec", "batch", "records",
+                                          "ratio", "encode MB/s",
+                                          "decode MB/s"))
+    for batch_count in options.batch_count or [1, 100]:
+        records = make_records(messages, batch_count)
+        for name in compression.available():
+            codec = compression.get_codec(name, options.level)
+            raw_size, encoded_size, encode_time, decode_time = measure(
+                records, codec, options.repeat)
+            print("%-6s %6d %8d %7.2f %12.1f %12.1f" % (
+                name, batch_count, len(records), raw_size / float(encoded_size),
+                raw_size / 1e6 / max(encode_time, 1e-9),
+                raw_size / 1e6 / max(decode_time, 1e-9)))
+            sys.stdout.flush()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.WARN)
+    run()
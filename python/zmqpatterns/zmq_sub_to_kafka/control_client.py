@@ -0,0 +1,163 @@
+import zmq
+import time
+import heapq
+import logging
+
+logger = logging.getLogger(__file__)
+
+# Client for the ZmqPrimaryController control socket. Requests are
+#   [request_id, b"cmd", cmd, args...]
+# and many of them can be in flight on the one DEALER, matched to their
+# reply by request id. A request without a reply after timeout seconds is
+# sent again, with the same request id, after an exponential backoff; once
+# retries are used up its callback gets None.
+
+
+class Request(object):
+    __slots__ = ("request_id", "frames", "callback", "attempts", "deadline")
+
+    def __init__(self, request_id, frames, callback):
+        self.request_id = request_id
+        self.frames = frames
+        self.callback = callback
+        self.attempts = 0
+        # reply due by, or when to send again while backing off
+        self.deadline = None
+
+
+class ControlClient(object):
+    def __init__(self, server_address, zmq_context=None, timeout=10.0,
+                 retries=3, backoff=0.5, max_backoff=5.0):
+        if zmq_context is None:
+            zmq_context = zmq.Context.instance()
+        self.socket = zmq_context.socket(zmq.DEALER)
+        self.socket.connect(server_address)
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.counter = 0
+        self.requests = {}
+        # (time, request_id), stale entries are skipped
+        self.timers = []
+        # requests waiting out their backoff
+        self.backing_off = set()
+
+    def __len__(self):
+        return len(self.requests)
+
+    def request(self, frames, callback):
+        # callback(reply frames after the request id, or None)
+        self.counter += 1
+        request_id = b"%d" % self.counter
+        request = self.requests[request_id] = Request(request_id, frames,
+                                                      callback)
+        self.send(request, time.monotonic())
+        return request_id
+
+    def send(self, request, now):
+        request.attempts += 1
+        request.deadline = now + self.timeout
+        heapq.heappush(self.timers, (request.deadline, request.request_id))
+        self.socket.send_multipart([request.request_id] + request.frames)
+
+    def poll(self, timeout=None):
+        # handles the replies and timers due within timeout seconds
+        now = time.monotonic()
+        if self.timers:
+            wait = max(0.0, self.timers[0][0] - now)
+            if timeout is None or wait < timeout:
+                timeout = wait
+        if timeout is None:
+            timeout = self.timeout
+        if self.socket.poll(timeout * 1000):
+            while True:
+                try:
+                    frames = self.socket.recv_multipart(zmq.NOBLOCK)
+                except zmq.Again:
+                    break
+                request = self.requests.pop(frames[0], None)
+                if request is None:
+                    # a late reply to a request already answered or failed
+                    continue
+                self.backing_off.discard(request.request_id)
+                request.callback(frames[1:])
+        self.run_timers(time.monotonic())
+
+    def run_timers(self, now):
+        timers = self.timers
+        while timers and timers[0][0] <= now:
+            due, request_id = heapq.heappop(timers)
+            request = self.requests.get(request_id)
+            if request is None or request.deadline != due:
+                continue
+            if request_id in self.backing_off:
+                self.backing_off.discard(request_id)
+                self.send(request, now)
+            elif request.attempts > self.retries:
+                del self.requests[request_id]
+                logger.warn("no reply to %s after %s attempts",
+                            request.frames, request.attempts)
+                request.callback(None)
+            else:
+                delay = min(self.backoff * 2 ** (request.attempts - 1),
+                            self.max_backoff)
+                request.deadline = now + delay
+                self.backing_off.add(request_id)
+                heapq.heappush(timers, (request.deadline, request_id))
+
+    def wait(self):
+        while self.requests:
+            self.poll()
+
+    def call(self, frames):
+        # one request, waited for
+        replies = []
+        self.request(frames, replies.append)
+        while not replies:
+            self.poll()
+        return replies[0]
+
+    def close(self):
+        self.socket.close(linger=0)
+
+
+def read_manifest(hFile):
+    # (name, address) per line, blank lines and # comments skipped
+    for line in hFile:
+        line = line.split("#", 1)[0].strip()
+        if line == "":
+            continue
+        fields = line.split()
+        if len(fields) != 2:
+            raise Exception("Expected 'name address', got: %s" % line)
+        yield fields[0].encode("utf8"), fields[1].encode("utf8")
+
+
+def run_bulk(client, cmd, entries, concurrency=100, report=None):
+    # sends cmd for every (name, address) with at most concurrency in
+    # flight, calls report(name, address, reply or None) for each, and
+    # returns the number of entries that failed
+    entries = iter(entries)
+    failures = [0]
+    expected = {b"subscribe": b"subscribed",
+                b"unsubscribe": b"unsubscribed"}.get(cmd)
+
+    def send_next():
+        for name, address in entries:
+            def on_reply(reply, name=name, address=address):
+                if reply is None or reply[1:2] != [expected]:
+                    failures[0] += 1
+                if report is not None:
+                    report(name, address, reply)
+            client.request([b"cmd", cmd, name, address], on_reply)
+            return True
+        return False
+
+    while True:
+        while len(client) < concurrency and send_next():
+            pass
+        if not len(client):
+            break
+        client.poll()
+    return failures[0]
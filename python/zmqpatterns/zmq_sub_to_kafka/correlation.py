@@ -0,0 +1,164 @@
+import sys
+import os
+import time
+import heapq
+import struct
+import logging
+
+try:
+    from .. import metrics
+except ImportError:
+    sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+    import metrics
+
+logger = logging.getLogger(__file__)
+
+# Requests sent over Kafka that wait for a response, by request id.
+#
+# A request id is 8 random bytes for this table, so responses meant for
+# another bridge on the same response topic are told apart, then a Q
+# counter. Deadlines are kept in a heap; an answered request stays in it
+# until its deadline comes up, so adding and expiring are both O(log n).
+# The heap is rebuilt from the table once it is mostly answered requests.
+
+INSTANCE_SIZE = 8
+REQUEST_NUMBER = struct.Struct("!Q")
+
+
+class Outstanding(object):
+    __slots__ = ("identity", "tag", "started", "deadline")
+
+    def __init__(self, identity, tag, started, deadline):
+        self.identity = identity
+        # the first request frame, returned with a timeout error
+        self.tag = tag
+        self.started = started
+        self.deadline = deadline
+
+
+class CorrelationTable(object):
+    def __init__(self, timeout=30.0, max_outstanding=100000, histogram=None):
+        self.timeout = timeout
+        self.max_outstanding = max_outstanding
+        self.instance = os.urandom(INSTANCE_SIZE)
+        self.counter = 0
+        self.requests = {}
+        self.deadlines = []
+        if histogram is None:
+            histogram = metrics.Histogram()
+        # round trip times of answered requests
+        self.histogram = histogram
+        self.answered = 0
+        self.timed_out = 0
+        self.unknown = 0
+        self.foreign = 0
+        self.rejected = 0
+
+    def __len__(self):
+        return len(self.requests)
+
+    def full(self):
+        return len(self.requests) >= self.max_outstanding
+
+    def add(self, identity, tag=b"", now=None):
+        # the request id, or None when max_outstanding are waiting
+        if self.full():
+            self.rejected += 1
+            return None
+        if now is None:
+            now = time.monotonic()
+        self.counter += 1
+        request_id = self.instance + REQUEST_NUMBER.pack(self.counter)
+        deadline = now + self.timeout
+        self.requests[request_id] = Outstanding(identity, tag, now, deadline)
+        heapq.heappush(self.deadlines, (deadline, request_id))
+        return request_id
+
+    def match(self, request_id, now=None):
+        # the Outstanding request a response is for, None for a late,
+        # duplicate or foreign response
+        request = self.requests.pop(request_id, None)
+        if request is None:
+            if request_id[:INSTANCE_SIZE] == self.instance:
+                self.unknown += 1
+            else:
+                self.foreign += 1
+            return None
+        if now is None:
+            now = time.monotonic()
+        self.answered += 1
+        self.histogram.add(now - request.started)
+        if len(self.deadlines) > 4 * max(len(self.requests), 1024):
+            self.deadlines = [(waiting.deadline, waiting_id)
+                              for waiting_id, waiting in self.requests.items()]
+            heapq.heapify(self.deadlines)
+        return request
+
+    def expire(self, now=None):
+        # the requests past their deadline, removed from the table
+        if now is None:
+            now = time.monotonic()
+        expired = []
+        deadlines = self.deadlines
+        while deadlines and deadlines[0][0] <= now:
+            deadline, request_id = heapq.heappop(deadlines)
+            request = self.requests.pop(request_id, None)
+            if request is not None:
+                expired.append(request)
+        self.timed_out += len(expired)
+        return expired
+
+    def next_deadline(self, now=None):
+        # seconds until the next expire() has something to do, None if never
+        if not self.deadlines:
+            return None
+        if now is None:
+            now = time.monotonic()
+        return max(0.0, self.deadlines[0][0] - now)
+
+    def as_dict(self):
+        return {"outstanding": len(self.requests),
+                "answered": self.answered,
+                "timed_out": self.timed_out,
+                "unknown": self.unknown,
+                "foreign": self.foreign,
+                "rejected": self.rejected,
+                "round_trip": self.histogram.as_dict()}
+
+    def log_stats(self):
+        logger.info("correlation %s", self.as_dict())
+
+
+# A bridge with its own reply partition or topic puts
+#   b"reply-to:" topic [b":" partition]
+# after the request id, and responders send the response there.
+
+REPLY_TO = b"reply-to:"
+
+
+def make_reply_to(topic_name, partition_id=None):
+    reply_to = REPLY_TO + topic_name.encode("utf8")
+    if partition_id is not None:
+        reply_to += b":%d" % partition_id
+    return reply_to
+
+
+def is_reply_to(frame):
+    return frame.startswith(REPLY_TO)
+
+
+def parse_reply_to(frame):
+    # (topic name, partition id or None)
+    topic_name, sep, partition_id = frame[len(REPLY_TO):].partition(b":")
+    if sep:
+        return topic_name.decode("utf8"), int(partition_id)
+    return topic_name.decode("utf8"), None
+
+
+def find_reply_to(frames):
+    # the (topic name, partition id) a request read from Kafka asks for,
+    # None for the default response topic. The frames are
+    #   [dispatch identity, caller identity, request id, reply-to, ...]
+    if len(frames) > 3 and is_reply_to(frames[3]):
+        return parse_reply_to(frames[3])
+    return None
@@ -15,6 +15,9 @@ def run():
         frames = socket.recv_multipart()
         print(frames)
         sys.stdout.flush()
+        if len(frames) >= 3 and frames[1] == b"batch":
+            # from simple_kafka_to_zmq --batch_size
+            socket.send_multipart([frames[0], b"ack", frames[2]])
 
 
 if __name__ == "__main__":
@@ -7,38 +7,93 @@ import logging
 import msgpack
 import datetime
 import queue
-import pykafka
+
+try:
+    from . import batching
+    from . import compression
+    from . import log_backend
+    from . import correlation
+except ImportError:
+    import batching
+    import compression
+    import log_backend
+    import correlation
 
 logger = logging.getLogger(__file__)
 
+def get_options():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--kafka_server', default="127.0.0.1:9092",
+                        help='kafka server to connect to')
+    parser.add_argument('--kafka_request_topic', default="abc-request",
+                        help='kafka topic to read requests from')
+    parser.add_argument('--kafka_response_topic', default="abc-response",
+                        help='kafka topic to send responses to')
+    parser.add_argument('--kafka_consumer_group', default="dummy-test1",
+                        help='kafka consumer group')
+    parser.add_argument('--zknodes', default="127.0.0.1:2181",
+                        help='zookeeper nodes')
+    parser.add_argument('--log_dir',
+                        help='use local partition logs in this directory '
+                        'instead of kafka')
+    parser.add_argument('--partitions', type=int, default=1,
+                        help='partitions of each new topic in --log_dir, '
+                        'kafka topics keep their own')
+    parser.add_argument('--log_retention_mb', type=int, default=1024,
+                        help='keep at most this much of each partition in '
+                        '--log_dir, 0 to keep what a consumer group has '
+                        'not committed')
+
+    return parser.parse_args()
+
+
 def run():
-    kafka_server_hosts = "127.0.0.1:9092"
-    kafka_request_topic_name = "abc-request"
-    kafka_response_topic_name = "abc-response"
-    kafka_consumer_group = "dummy-test1"
-    zknodes = "127.0.0.1:2181"
-
-    kafka_client = pykafka.KafkaClient(hosts=kafka_server_hosts)
-    request_topic = kafka_client.topics[kafka_request_topic_name.encode("utf8")]
-    response_topic = kafka_client.topics[kafka_response_topic_name.encode("utf8")]
-
-    balanced_consumer = request_topic.get_balanced_consumer(
-        consumer_group=kafka_consumer_group.encode("utf8"),
-        auto_commit_enable=True,
-        zookeeper_connect=zknodes
-        )
-
-    with response_topic.get_sync_producer() as kafka_producer:
+    options = get_options()
+
+    kafka_request_topic_name = options.kafka_request_topic
+    kafka_response_topic_name = options.kafka_response_topic
+    kafka_consumer_group = options.kafka_consumer_group
+
+    backend = log_backend.make_backend(kafka_server=options.kafka_server,
+                                       zknodes=options.zknodes,
+                                       log_dir=options.log_dir,
+                                       partitions=options.partitions,
+                                       retention_mb=options.log_retention_mb)
+
+    balanced_consumer = backend.consumer(kafka_request_topic_name,
+                                         kafka_consumer_group,
+                                         auto_commit=True)
+
+    # (topic, partition) -> producer, for requests with a reply-to frame
+    reply_producers = {}
+
+    def reply_producer(reply_to):
+        producer = reply_producers.get(reply_to)
+        if producer is None:
+            topic_name, partition_id = reply_to
+            producer = reply_producers[reply_to] = backend.producer(
+                topic_name, sync=True, by_partition=partition_id is not None)
+        return producer
+
+    with backend.producer(kafka_response_topic_name,
+                          sync=True) as kafka_producer:
         for message in balanced_consumer:
             if message is not None:
                 offset_bytes = msgpack.packb(message.offset)
                 print(message.offset, message.value)
-                data = msgpack.unpackb(message.value)
-                data[-1] = data[-1] + b"-Response"
-                bvalue = msgpack.packb(data)
-                kafka_producer.produce(bvalue)
-                print("response: ", bvalue)
-    
+                for value in batching.unpack_records(compression.decode(message.value)):
+                    data = msgpack.unpackb(value)
+                    reply_to = correlation.find_reply_to(data)
+                    data[-1] = data[-1] + b"-Response"
+                    bvalue = msgpack.packb(data)
+                    if reply_to is None:
+                        kafka_producer.produce(bvalue)
+                    elif reply_to[1] is None:
+                        reply_producer(reply_to).produce(bvalue)
+                    else:
+                        reply_producer(reply_to).produce(
+                            bvalue, partition_key=b"%d" % reply_to[1])
+                    print("response: ", bvalue)
 
 
 
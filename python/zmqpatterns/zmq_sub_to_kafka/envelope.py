@@ -0,0 +1,90 @@
+import time
+import struct
+import logging
+import collections
+import msgpack
+
+logger = logging.getLogger(__file__)
+
+# Header frame put in front of every message a ZmqSubscriber forwards.
+#
+# version 1, network byte order:
+#   2s  magic b"ZE"
+#   B   version
+#   B   flags (unused, 0)
+#   Q   wall clock time, nanoseconds since the epoch
+#   Q   sequence number, per subscriber, starting at 1
+#   H   subscriber identity length, then the identity bytes
+#   H   send id length, then the send id bytes
+#
+# The id part never changes for a subscriber, so it is built once.
+
+MAGIC = b"ZE"
+VERSION = 1
+HEADER = struct.Struct("!2sBBQQ")
+LENGTH = struct.Struct("!H")
+
+PREFIX = MAGIC + bytes([VERSION])
+
+Envelope = collections.namedtuple("Envelope", ["version", "time_ns",
+                                               "sequence", "identity",
+                                               "send_id"])
+
+
+def is_envelope(frame):
+    return len(frame) >= HEADER.size + 2 * LENGTH.size and frame[:3] == PREFIX
+
+
+class EnvelopeEncoder(object):
+    def __init__(self, identity, send_id):
+        self.identity = identity
+        self.send_id = send_id
+        self.ids = (LENGTH.pack(len(identity)) + identity +
+                    LENGTH.pack(len(send_id)) + send_id)
+        self.sequence = 0
+
+    def encode(self):
+        self.sequence += 1
+        return HEADER.pack(MAGIC, VERSION, 0, time.time_ns(),
+                           self.sequence) + self.ids
+
+
+class EnvelopeDecoder(object):
+    # keeps one (identity, send_id) pair per distinct id part, so decoding
+    # many messages from the same subscriber does not build new id objects
+    def __init__(self, max_ids=65536):
+        self.max_ids = max_ids
+        self.ids = {}
+
+    def decode(self, frame):
+        magic, version, flags, time_ns, sequence = HEADER.unpack_from(frame)
+        if magic != MAGIC:
+            raise ValueError("not an envelope")
+        if version != VERSION:
+            raise ValueError("unknown envelope version: %s" % version)
+        ids_part = bytes(frame[HEADER.size:])
+        ids = self.ids.get(ids_part)
+        if ids is None:
+            (identity_length,) = LENGTH.unpack_from(ids_part)
+            identity = ids_part[LENGTH.size:LENGTH.size + identity_length]
+            offset = LENGTH.size + identity_length
+            (send_id_length,) = LENGTH.unpack_from(ids_part, offset)
+            offset += LENGTH.size
+            send_id = ids_part[offset:offset + send_id_length]
+            ids = (identity, send_id)
+            if len(self.ids) >= self.max_ids:
+                self.ids.clear()
+            self.ids[ids_part] = ids
+        return Envelope(version, time_ns, sequence, ids[0], ids[1])
+
+    def split(self, frames):
+        # (envelope, payload frames) for frames sent by a ZmqSubscriber,
+        # given without the ROUTER identity. The old three frame header
+        # (identity, send id, msgpack timetuple) decodes as version 0.
+        if frames and is_envelope(frames[0]):
+            return self.decode(frames[0]), frames[1:]
+        if len(frames) < 3:
+            raise ValueError("no subscriber header")
+        timestamp = time.mktime(tuple(msgpack.unpackb(frames[2])))
+        return Envelope(0, int(timestamp * 1e9), None, frames[0],
+                        frames[1]), frames[3:]
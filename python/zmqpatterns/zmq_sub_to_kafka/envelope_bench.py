@@ -0,0 +1,71 @@
+import sys
+import zmq
+import time
+import timeit
+import logging
+import datetime
+import msgpack
+
+try:
+    from . import envelope
+except ImportError:
+    import envelope
+
+logger = logging.getLogger(__file__)
+
+
+def run(count=200000):
+    identity = b"SUB1"
+    send_id = b"0b6e7c2e-3a8f-4d5e-9d5b-1f2e3d4c5b6a"
+    encoder = envelope.EnvelopeEncoder(identity, send_id)
+    decoder = envelope.EnvelopeDecoder()
+
+    def legacy_header():
+        time_value = msgpack.packb(datetime.datetime.now().timetuple())
+        return [identity, send_id, time_value]
+
+    def envelope_header():
+        return [encoder.encode()]
+
+    context = zmq.Context()
+    receiver = context.socket(zmq.ROUTER)
+    receiver.set_hwm(0)
+    receiver.bind("inproc://envelope-bench")
+    sender = context.socket(zmq.DEALER)
+    sender.set_hwm(0)
+    sender.connect("inproc://envelope-bench")
+    frames = [b"topic", b"x" * 64]
+
+    def legacy_send():
+        sender.send_multipart(legacy_header(), flags=zmq.SNDMORE)
+        sender.send_multipart(frames)
+
+    def envelope_send():
+        sender.send_multipart(envelope_header() + frames)
+
+    frame = encoder.encode()
+    results = [
+        ("legacy header", timeit.timeit(legacy_header, number=count)),
+        ("envelope header", timeit.timeit(envelope_header, number=count)),
+        ("envelope decode", timeit.timeit(lambda: decoder.decode(frame),
+                                          number=count)),
+    ]
+    for name, send in (("legacy send", legacy_send),
+                       ("envelope send", envelope_send)):
+        elapsed = timeit.timeit(send, number=count)
+        for n in range(count):
+            receiver.recv_multipart()
+        results.append((name, elapsed))
+
+    for name, elapsed in results:
+        print("%-16s %8.3f us/msg" % (name, elapsed * 1e6 / count))
+    sys.stdout.flush()
+
+    sender.close()
+    receiver.close()
+    context.term()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.WARN)
+    run()
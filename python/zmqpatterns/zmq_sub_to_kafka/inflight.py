@@ -0,0 +1,45 @@
+import logging
+
+logger = logging.getLogger(__file__)
+
+
+class InflightWindow(object):
+    # Fixed capacity ring of messages waiting for a delivery report, keyed by
+    # a sequence number. The window spans from the oldest unacknowledged
+    # message to the newest one, so one stuck message also stops new ones
+    # from being added - that is what bounds memory when Kafka slows down.
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.slots = [None] * capacity
+        self.head = 0  # next sequence number to hand out
+        self.tail = 0  # oldest sequence number not yet acknowledged
+        self.pending = 0
+
+    def __len__(self):
+        return self.pending
+
+    def full(self):
+        return self.head - self.tail >= self.capacity
+
+    def add(self, payload):
+        assert not self.full(), (self.head, self.tail)
+        sequence = self.head
+        self.slots[sequence % self.capacity] = payload
+        self.head += 1
+        self.pending += 1
+        return sequence
+
+    def get(self, sequence):
+        if sequence < self.tail or sequence >= self.head:
+            return None
+        return self.slots[sequence % self.capacity]
+
+    def ack(self, sequence):
+        if self.get(sequence) is None:
+            # duplicate report or a sequence from before a restart
+            return False
+        self.slots[sequence % self.capacity] = None
+        self.pending -= 1
+        while self.tail < self.head and self.slots[self.tail % self.capacity] is None:
+            self.tail += 1
+        return True
@@ -6,7 +6,15 @@ import logging
 import msgpack
 import datetime
 import queue
-import pykafka
+
+try:
+    from . import batching
+    from . import compression
+    from . import log_backend
+except ImportError:
+    import batching
+    import compression
+    import log_backend
 
 logger = logging.getLogger(__file__)
 
@@ -20,11 +28,14 @@ def get_options():
                         help='zookeeper nodes')
     parser.add_argument('--consumer_group',
                         help='consumer group')
+    parser.add_argument('--log_dir',
+                        help='read local partition logs in this directory '
+                        'instead of kafka')
 
     parsed = parser.parse_args()
 
-    if parsed.kafka_server is None:
-        raise Exception("Please specify --kafka_server")
+    if parsed.kafka_server is None and parsed.log_dir is None:
+        raise Exception("Please specify --kafka_server or --log_dir")
 
     return parsed
 
@@ -32,18 +43,17 @@ def get_options():
 def run():
     options = get_options()
 
-    kafka_client = pykafka.KafkaClient(hosts=options.kafka_server)
-    topic = kafka_client.topics[options.kafka_topic.encode("utf8")]
-
-    balanced_consumer = topic.get_balanced_consumer(
-        consumer_group=options.consumer_group.encode("utf8"),
-        auto_commit_enable=True,
-        zookeeper_connect=options.zknodes
-        )
+    backend = log_backend.make_backend(kafka_server=options.kafka_server,
+                                       zknodes=options.zknodes,
+                                       log_dir=options.log_dir)
+    balanced_consumer = backend.consumer(options.kafka_topic,
+                                         options.consumer_group,
+                                         auto_commit=True)
 
     for message in balanced_consumer:
         if message is not None:
-            print(message.offset, message.value)
+            for value in batching.unpack_records(compression.decode(message.value)):
+                print(message.offset, value)
 
 
 
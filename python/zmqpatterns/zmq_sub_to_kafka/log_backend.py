@@ -0,0 +1,668 @@
+import os
+import mmap
+import time
+import zlib
+import glob
+import bisect
+import fcntl
+import queue
+import struct
+import logging
+import threading
+import msgpack
+
+logger = logging.getLogger(__file__)
+
+# Backends give the bridges:
+#   producer(topic, delivery_reports, sync, keyed, by_partition) - a context
+#       manager with produce(value, partition_key=None) returning the
+#       message, and get_delivery_report(block, timeout) returning
+#       (message, exception) for that same message object. keyed places
+#       messages by the hash of their key, by_partition in the partition
+#       whose id the key is in decimal, otherwise they are spread over the
+#       partitions.
+#   consumer(topic, consumer_group, auto_commit, timeout) - iterates
+#       messages (value, partition_key, offset, partition_id), or None
+#       after timeout seconds without one, with commit_offsets(offsets)
+#       taking [(partition_id, last consumed offset)], and stop()
+#   simple_consumer(topic, partitions, timeout) - the same without a
+#       consumer group: it reads the given partitions, all by default,
+#       from the latest offset on and never commits
+#   partition_ids(topic) - the topic's partition ids
+#
+# PyKafkaBackend passes these on to pykafka. LocalLogBackend keeps each
+# partition in memory mapped segment files, for running without a cluster.
+
+
+class PyKafkaConsumer(object):
+    def __init__(self, topic, consumer):
+        self.topic = topic
+        self.consumer = consumer
+
+    def __iter__(self):
+        # pykafka's own iterator ends at consumer_timeout_ms, here that
+        # yields None like LocalConsumer
+        while True:
+            yield self.consumer.consume(block=True)
+
+    def commit_offsets(self, offsets=None):
+        if offsets is None:
+            return self.consumer.commit_offsets()
+        # pykafka commits the offset to read next
+        partitions = self.topic.partitions
+        return self.consumer.commit_offsets(
+            partition_offsets=[(partitions[partition_id], offset + 1)
+                               for partition_id, offset in offsets])
+
+    def stop(self):
+        self.consumer.stop()
+
+
+def partition_by_id(partitions, partition_key):
+    # pykafka partitioner for by_partition producers
+    partition_id = int(partition_key)
+    for partition in partitions:
+        if partition.id == partition_id:
+            return partition
+    raise Exception("No partition %s" % partition_id)
+
+
+class PyKafkaBackend(object):
+    def __init__(self, hosts, zookeeper_connect=None):
+        # only needed for this backend
+        import pykafka
+        self.client = pykafka.KafkaClient(hosts=hosts)
+        self.zookeeper_connect = zookeeper_connect
+
+    def topic(self, topic_name):
+        return self.client.topics[topic_name.encode("utf8")]
+
+    def producer(self, topic_name, delivery_reports=False, sync=False,
+                 keyed=False, by_partition=False):
+        topic = self.topic(topic_name)
+        kwargs = {}
+        if by_partition:
+            kwargs["partitioner"] = partition_by_id
+        elif keyed:
+            import pykafka.partitioners
+            kwargs["partitioner"] = pykafka.partitioners.hashing_partitioner
+        if sync:
+            return topic.get_sync_producer(**kwargs)
+        return topic.get_producer(delivery_reports=delivery_reports, **kwargs)
+
+    def consumer(self, topic_name, consumer_group, auto_commit=True,
+                 timeout=None):
+        topic = self.topic(topic_name)
+        kwargs = dict(consumer_group=consumer_group.encode("utf8"),
+                      auto_commit_enable=auto_commit,
+                      zookeeper_connect=self.zookeeper_connect)
+        if timeout is not None:
+            kwargs["consumer_timeout_ms"] = int(timeout * 1000)
+        return PyKafkaConsumer(topic, topic.get_balanced_consumer(**kwargs))
+
+    def simple_consumer(self, topic_name, partitions=None, timeout=None):
+        from pykafka.common import OffsetType
+        topic = self.topic(topic_name)
+        kwargs = dict(auto_offset_reset=OffsetType.LATEST,
+                      reset_offset_on_start=True)
+        if partitions is not None:
+            kwargs["partitions"] = [topic.partitions[partition_id]
+                                    for partition_id in partitions]
+        if timeout is not None:
+            kwargs["consumer_timeout_ms"] = int(timeout * 1000)
+        return PyKafkaConsumer(topic, topic.get_simple_consumer(**kwargs))
+
+    def partition_ids(self, topic_name):
+        return sorted(self.topic(topic_name).partitions)
+
+    def close(self):
+        pass
+
+
+# Each partition is a directory of segment files named by the offset of
+# their first record. Segment files are made at their full size, by
+# default segment_size, and hold records in network byte order, zero
+# filled after the last one:
+#   I   length of the rest of the record, never 0
+#   Q   offset
+#   H   key length, then the key bytes
+#   *   value
+# The rest is written before the length, so readers - in this or another
+# process - never see half a record. A full segment ends with NEXT_SEGMENT
+# in place of a length, then the Q base offset of the segment that follows.
+#
+# A position is (segment base offset, byte position in the segment). The
+# writer deletes whole segments once every consumer group has committed
+# past them, and the oldest ones beyond retention_bytes even if not.
+
+LENGTH = struct.Struct("!I")
+RECORD = struct.Struct("!QH")
+BASE = struct.Struct("!Q")
+NEXT_SEGMENT = 0xFFFFFFFF
+SEGMENT_PATTERN = "%020d.log"
+
+
+class LocalMessage(object):
+    def __init__(self, value, partition_key, offset, partition_id):
+        self.value = value
+        self.partition_key = partition_key
+        self.offset = offset
+        self.partition_id = partition_id
+
+
+class LogSegment(object):
+    def __init__(self, filename):
+        self.filename = filename
+        self.fd = os.open(filename, os.O_RDWR)
+        self.size = os.fstat(self.fd).st_size
+        self.map = mmap.mmap(self.fd, self.size)
+
+    def flush(self):
+        self.map.flush()
+
+    def close(self):
+        self.map.close()
+        os.close(self.fd)
+
+
+class PartitionLog(object):
+    # not thread safe, LocalTopic serialises access with its condition
+    def __init__(self, directory, segment_size, retention_bytes=None):
+        self.directory = directory
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.segment_size = segment_size
+        self.retention_bytes = retention_bytes
+        # base offset -> LogSegment, mapped as they are used
+        self.segments = {}
+        self.lock_fd = None
+        self.writer = False
+        self.end = None
+        self.next_offset = None
+        # set when the writer started a segment, for LocalTopic to retain
+        self.rolled = False
+
+    def segment_filename(self, base):
+        return os.path.join(self.directory, SEGMENT_PATTERN % base)
+
+    def bases(self):
+        return sorted(int(name[:-4]) for name in os.listdir(self.directory)
+                      if name.endswith(".log"))
+
+    def start(self):
+        # position of the oldest record kept
+        bases = self.bases()
+        return (bases[0] if bases else 0, 0)
+
+    def segment(self, base):
+        # raises FileNotFoundError for a segment deleted or not made yet
+        segment = self.segments.get(base)
+        if segment is None:
+            segment = self.segments[base] = LogSegment(
+                self.segment_filename(base))
+        return segment
+
+    def release(self, base):
+        # unmap a segment, unless the writer is in it
+        if self.writer and base == self.end[0]:
+            return
+        segment = self.segments.pop(base, None)
+        if segment is not None:
+            segment.close()
+
+    def create_segment(self, base, size):
+        # at its full size before it appears, readers never map less
+        segment = self.segments.pop(base, None)
+        if segment is not None:
+            # an empty segment left by a crash, made again bigger
+            segment.close()
+        filename = self.segment_filename(base)
+        with open(filename + ".tmp", "wb") as hFile:
+            hFile.truncate(size)
+        os.replace(filename + ".tmp", filename)
+        return self.segment(base)
+
+    def open_writer(self):
+        # one writing process per partition
+        lock_fd = os.open(os.path.join(self.directory, "writer.lock"),
+                          os.O_RDWR | os.O_CREAT)
+        try:
+            fcntl.flock(lock_fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except (IOError, OSError):
+            os.close(lock_fd)
+            raise Exception("%s is written by another process" % self.directory)
+        self.lock_fd = lock_fd
+        self.end, self.next_offset = self.scan()
+        self.writer = True
+        if not self.bases():
+            self.end = None
+            return
+        # a crash can leave the rest of a record behind the last length,
+        # which a shorter record written there would not cover
+        base, position = self.end
+        segment = self.segment(base)
+        tail = segment.map[position:]
+        if tail.count(0) != len(tail):
+            logger.warn("%s: zeroing a torn record after %d",
+                        segment.filename, position)
+            segment.map[position:] = bytes(len(tail))
+
+    def scan(self):
+        # (position after the last record, offset of the next one), read
+        # from the start of the last segment
+        bases = self.bases()
+        if not bases:
+            return (0, 0), 0
+        position = (bases[-1], 0)
+        next_offset = bases[-1]
+        while True:
+            record = self.read(position)
+            if record is None:
+                return position, next_offset
+            next_offset = record[0] + 1
+            position = record[3]
+
+    def roll(self, needed):
+        # starts the segment for a record of needed bytes
+        size = max(self.segment_size, needed + LENGTH.size + BASE.size)
+        segment = self.create_segment(self.next_offset, size)
+        old_end = self.end
+        self.end = (self.next_offset, 0)
+        if old_end is not None and old_end[0] != self.next_offset:
+            base, position = old_end
+            old = self.segment(base)
+            if position + LENGTH.size + BASE.size <= old.size:
+                BASE.pack_into(old.map, position + LENGTH.size,
+                               self.next_offset)
+                LENGTH.pack_into(old.map, position, NEXT_SEGMENT)
+            old.flush()
+            self.release(base)
+        self.rolled = True
+        return segment
+
+    def append(self, key, value):
+        if not self.writer:
+            self.open_writer()
+        rest = RECORD.size + len(key) + len(value)
+        if self.end is None:
+            segment = self.roll(LENGTH.size + rest)
+        else:
+            segment = self.segment(self.end[0])
+            if (self.end[1] + 2 * LENGTH.size + rest + BASE.size >
+                    segment.size):
+                segment = self.roll(LENGTH.size + rest)
+        base, position = self.end
+        end = position + LENGTH.size + rest
+        start = position + LENGTH.size
+        RECORD.pack_into(segment.map, start, self.next_offset, len(key))
+        start += RECORD.size
+        segment.map[start:start + len(key)] = key
+        start += len(key)
+        segment.map[start:end] = value
+        LENGTH.pack_into(segment.map, position, rest)
+        offset = self.next_offset
+        self.next_offset += 1
+        self.end = (base, end)
+        return offset
+
+    def read(self, position):
+        # (offset, key, value, next position), None past the last record
+        base, position = position
+        while True:
+            try:
+                segment = self.segment(base)
+            except FileNotFoundError:
+                # deleted under a slow reader, or not made yet
+                later = [other for other in self.bases() if other > base]
+                if not later:
+                    return None
+                logger.warn("%s: segment %d is gone, going on from %d",
+                            self.directory, base, later[0])
+                base, position = later[0], 0
+                continue
+            if position + LENGTH.size > segment.size:
+                # filled to the last byte, there was no room for a marker
+                later = [other for other in self.bases() if other > base]
+                if not later:
+                    return None
+                self.release(base)
+                base, position = later[0], 0
+                continue
+            (rest,) = LENGTH.unpack_from(segment.map, position)
+            if rest == 0:
+                return None
+            if rest == NEXT_SEGMENT:
+                (next_base,) = BASE.unpack_from(segment.map,
+                                                position + LENGTH.size)
+                self.release(base)
+                base, position = next_base, 0
+                continue
+            end = position + LENGTH.size + rest
+            offset, key_length = RECORD.unpack_from(segment.map,
+                                                    position + LENGTH.size)
+            start = position + LENGTH.size + RECORD.size
+            key = segment.map[start:start + key_length]
+            value = segment.map[start + key_length:end]
+            return offset, key, value, (base, end)
+
+    def find_next(self, offset, position=None):
+        # position of the record after offset, scanning from position, or
+        # from the start of the segment holding offset
+        if position is None or position[0] > offset:
+            bases = self.bases()
+            index = bisect.bisect_right(bases, offset) - 1
+            position = (bases[max(index, 0)] if bases else 0, 0)
+        while True:
+            record = self.read(position)
+            if record is None:
+                raise Exception("offset %s not in %s" % (offset, self.directory))
+            if record[0] == offset:
+                return record[3]
+            position = record[3]
+
+    def retain(self, committed=None):
+        # deletes the segments wholly at or below committed, the lowest
+        # offset every consumer group has consumed, and the oldest beyond
+        # retention_bytes; never the one being written
+        bases = self.bases()
+        keep = 0
+        if committed is not None:
+            while keep + 1 < len(bases) and bases[keep + 1] <= committed + 1:
+                keep += 1
+        if self.retention_bytes is not None:
+            total = 0
+            for index in range(len(bases) - 1, -1, -1):
+                total += os.path.getsize(self.segment_filename(bases[index]))
+                if total > self.retention_bytes:
+                    keep = max(keep, min(index + 1, len(bases) - 1))
+                    break
+        for base in bases[:keep]:
+            self.release(base)
+            os.remove(self.segment_filename(base))
+            logger.debug("%s: deleted segment %d", self.directory, base)
+
+    def flush(self):
+        if self.end is not None:
+            self.segment(self.end[0]).flush()
+
+    def close(self):
+        for segment in self.segments.values():
+            segment.close()
+        self.segments = {}
+        if self.lock_fd is not None:
+            os.close(self.lock_fd)
+            self.lock_fd = None
+        self.writer = False
+
+
+class LocalTopic(object):
+    def __init__(self, directory, partitions, segment_size,
+                 retention_bytes=None):
+        self.directory = directory
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        for filename in glob.glob(os.path.join(directory, "*.log")):
+            # a partition in one file, from before segments
+            partition_directory = filename[:-4]
+            if not os.path.isdir(partition_directory):
+                os.makedirs(partition_directory)
+            try:
+                os.replace(filename, os.path.join(partition_directory,
+                                                  SEGMENT_PATTERN % 0))
+            except FileNotFoundError:
+                # moved by another process
+                pass
+        existing = len([name for name in os.listdir(directory)
+                        if name.isdigit()])
+        # appends wake consumers in this process; others poll
+        self.condition = threading.Condition()
+        self.logs = [PartitionLog(os.path.join(directory, "%d" % n),
+                                  segment_size, retention_bytes)
+                     for n in range(existing or partitions)]
+        self.counter = 0
+
+    def partition_id(self, partition_id):
+        if not 0 <= partition_id < len(self.logs):
+            raise Exception("No partition %s in %s, which has %d" %
+                            (partition_id, self.directory, len(self.logs)))
+        return partition_id
+
+    def committed_offset(self, partition_id):
+        # the lowest offset every consumer group has committed, None
+        # without groups
+        committed = None
+        for filename in glob.glob(os.path.join(self.directory, "*.offsets")):
+            try:
+                with open(filename, "rb") as hFile:
+                    positions = msgpack.unpackb(hFile.read())
+            except (IOError, OSError, ValueError):
+                continue
+            offset = -1
+            if partition_id < len(positions):
+                offset = positions[partition_id][0]
+            if committed is None or offset < committed:
+                committed = offset
+        return committed
+
+    def append(self, value, partition_key=None, by_partition=False):
+        with self.condition:
+            if by_partition:
+                partition_id = self.partition_id(int(partition_key))
+                key = partition_key
+            elif partition_key is None:
+                partition_id = self.counter % len(self.logs)
+                self.counter += 1
+                key = b""
+            else:
+                partition_id = zlib.crc32(partition_key) % len(self.logs)
+                key = partition_key
+            log = self.logs[partition_id]
+            offset = log.append(key, value)
+            if log.rolled:
+                log.rolled = False
+                log.retain(self.committed_offset(partition_id))
+            self.condition.notify_all()
+        return LocalMessage(value, partition_key, offset, partition_id)
+
+    def close(self):
+        for log in self.logs:
+            log.flush()
+            log.close()
+
+
+class LocalProducer(object):
+    def __init__(self, topic, delivery_reports=False, by_partition=False):
+        self.topic = topic
+        self.by_partition = by_partition
+        self.reports = None
+        if delivery_reports:
+            self.reports = queue.Queue()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.stop()
+
+    def produce(self, value, partition_key=None):
+        # written once this returns, so it is reported delivered at once
+        message = self.topic.append(value, partition_key, self.by_partition)
+        if self.reports is not None:
+            self.reports.put((message, None))
+        return message
+
+    def get_delivery_report(self, block=True, timeout=None):
+        if self.reports is None:
+            raise Exception("Producer made without delivery_reports")
+        return self.reports.get(block, timeout)
+
+    def stop(self):
+        with self.topic.condition:
+            for log in self.topic.logs:
+                if log.writer:
+                    log.flush()
+
+
+def unpack_position(position):
+    # a byte position in the one file of a partition before segments
+    if isinstance(position, int):
+        return (0, position)
+    return tuple(position)
+
+
+class LocalConsumer(object):
+    # one member per consumer group: it reads every partition. Offsets are
+    # kept in <group>.offsets as [last consumed offset, next position] per
+    # partition, replaced atomically. Without a group it reads partitions,
+    # all by default, from their current end and keeps no offsets.
+    def __init__(self, topic, consumer_group, auto_commit=True, timeout=None,
+                 auto_commit_interval=1.0, partitions=None):
+        self.topic = topic
+        self.filename = None
+        if consumer_group is not None:
+            self.filename = os.path.join(topic.directory,
+                                         consumer_group + ".offsets")
+        self.auto_commit = auto_commit and consumer_group is not None
+        self.auto_commit_interval = auto_commit_interval
+        self.timeout = timeout
+        self.partition_ids = list(range(len(topic.logs)))
+        if partitions is not None:
+            self.partition_ids = [topic.partition_id(partition_id)
+                                  for partition_id in partitions]
+        self.positions = [[-1, log.start()] for log in topic.logs]
+        if consumer_group is None:
+            with topic.condition:
+                for partition_id in self.partition_ids:
+                    end, next_offset = topic.logs[partition_id].scan()
+                    self.positions[partition_id] = [next_offset - 1, end]
+        elif os.path.exists(self.filename):
+            with open(self.filename, "rb") as hFile:
+                for n, position in enumerate(msgpack.unpackb(hFile.read())):
+                    self.positions[n] = [position[0],
+                                         unpack_position(position[1])]
+        self.committed = [list(position) for position in self.positions]
+        self.last_commit = time.monotonic()
+        self.next_partition = 0
+
+    def __iter__(self):
+        while True:
+            yield self.consume()
+
+    def poll(self):
+        logs = self.topic.logs
+        partition_ids = self.partition_ids
+        for n in range(len(partition_ids)):
+            index = (self.next_partition + n) % len(partition_ids)
+            partition_id = partition_ids[index]
+            position = self.positions[partition_id]
+            record = logs[partition_id].read(position[1])
+            if record is not None:
+                offset, key, value, end = record
+                position[0] = offset
+                position[1] = end
+                self.next_partition = index + 1
+                return LocalMessage(value, key or None, offset, partition_id)
+        return None
+
+    def consume(self):
+        deadline = None
+        if self.timeout is not None:
+            deadline = time.monotonic() + self.timeout
+        delay = 0.0005
+        while True:
+            with self.topic.condition:
+                message = self.poll()
+                if message is None:
+                    wait = delay
+                    if deadline is not None:
+                        wait = min(wait, deadline - time.monotonic())
+                    if wait > 0:
+                        self.topic.condition.wait(wait)
+                    message = self.poll()
+            if self.auto_commit and (time.monotonic() - self.last_commit >=
+                                     self.auto_commit_interval):
+                self.commit_offsets()
+            if message is not None:
+                return message
+            if deadline is not None and time.monotonic() >= deadline:
+                return None
+            # other processes do not wake us, so back off up to 10ms
+            delay = min(delay * 2, 0.01)
+
+    def commit_offsets(self, offsets=None):
+        if self.filename is None:
+            raise Exception("Cannot commit offsets without a consumer group")
+        self.last_commit = time.monotonic()
+        if offsets is None:
+            self.committed = [list(position) for position in self.positions]
+        else:
+            with self.topic.condition:
+                for partition_id, offset in offsets:
+                    committed = self.committed[partition_id]
+                    start = committed[1] if offset > committed[0] else None
+                    committed[1] = self.topic.logs[partition_id].find_next(
+                        offset, start)
+                    committed[0] = offset
+        with open(self.filename + ".tmp", "wb") as hFile:
+            hFile.write(msgpack.packb(self.committed))
+        os.replace(self.filename + ".tmp", self.filename)
+
+    def stop(self):
+        if self.auto_commit:
+            self.commit_offsets()
+
+
+class LocalLogBackend(object):
+    def __init__(self, directory, partitions=1, segment_size=16 * 1024 * 1024,
+                 retention_bytes=1024 * 1024 * 1024):
+        self.directory = directory
+        self.partitions = partitions
+        self.segment_size = segment_size
+        # per partition, None keeps whatever a consumer group has not had
+        self.retention_bytes = retention_bytes
+        self.topics = {}
+        self.lock = threading.Lock()
+
+    def topic(self, topic_name):
+        with self.lock:
+            topic = self.topics.get(topic_name)
+            if topic is None:
+                topic = self.topics[topic_name] = LocalTopic(
+                    os.path.join(self.directory, topic_name),
+                    self.partitions, self.segment_size, self.retention_bytes)
+            return topic
+
+    def producer(self, topic_name, delivery_reports=False, sync=False,
+                 keyed=False, by_partition=False):
+        # always keyed when there is a key, round robin otherwise
+        return LocalProducer(self.topic(topic_name), delivery_reports,
+                             by_partition)
+
+    def consumer(self, topic_name, consumer_group, auto_commit=True,
+                 timeout=None):
+        return LocalConsumer(self.topic(topic_name), consumer_group,
+                             auto_commit, timeout)
+
+    def simple_consumer(self, topic_name, partitions=None, timeout=None):
+        return LocalConsumer(self.topic(topic_name), None, False, timeout,
+                             partitions=partitions)
+
+    def partition_ids(self, topic_name):
+        return list(range(len(self.topic(topic_name).logs)))
+
+    def close(self):
+        with self.lock:
+            for topic in self.topics.values():
+                topic.close()
+            self.topics = {}
+
+
+def make_backend(kafka_server=None, zknodes=None, log_dir=None, partitions=1,
+                 retention_mb=1024):
+    if log_dir is not None:
+        retention_bytes = None
+        if retention_mb:
+            retention_bytes = retention_mb * 1024 * 1024
+        return LocalLogBackend(log_dir, partitions=partitions,
+                               retention_bytes=retention_bytes)
+    return PyKafkaBackend(kafka_server, zookeeper_connect=zknodes)
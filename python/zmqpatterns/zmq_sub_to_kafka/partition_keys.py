@@ -0,0 +1,70 @@
+import logging
+import importlib
+
+try:
+    from . import envelope
+except ImportError:
+    import envelope
+
+logger = logging.getLogger(__file__)
+
+# Kafka partition keys for from_zmq_to_kafka. A key function gets the
+# frames as its ROUTER received them, identity first, and returns the key
+# bytes or None for no key. Messages with the same key go to the same
+# partition, in order; messages without one are spread over all of them.
+#
+#   identity    the ROUTER identity of the sending socket
+#   subscriber  the subscriber identity in a ZmqSubscriber header
+#   topic       the first frame as published, after any ZmqSubscriber
+#               header
+#   module:name a function imported from a module
+
+KEY_BY = ["none", "identity", "subscriber", "topic"]
+
+
+def identity_key(frames):
+    return frames[0]
+
+
+class TopicKey(object):
+    def __init__(self):
+        self.decoder = envelope.EnvelopeDecoder()
+
+    def __call__(self, frames):
+        try:
+            payload = self.decoder.split(frames[1:])[1]
+        except Exception:
+            # not from a ZmqSubscriber, the first frame is the topic
+            payload = frames[1:]
+        if payload:
+            return payload[0]
+        return None
+
+
+class SubscriberKey(object):
+    def __init__(self):
+        self.decoder = envelope.EnvelopeDecoder()
+
+    def __call__(self, frames):
+        try:
+            return self.decoder.split(frames[1:])[0].identity
+        except Exception:
+            # not from a ZmqSubscriber
+            return None
+
+
+def make_key_function(key_by):
+    if key_by is None or key_by == "none":
+        return None
+    if callable(key_by):
+        return key_by
+    if key_by == "identity":
+        return identity_key
+    if key_by == "subscriber":
+        return SubscriberKey()
+    if key_by == "topic":
+        return TopicKey()
+    if ":" in key_by:
+        module_name, function_name = key_by.split(":", 1)
+        return getattr(importlib.import_module(module_name), function_name)
+    raise Exception("Unknown partition key: %s" % key_by)
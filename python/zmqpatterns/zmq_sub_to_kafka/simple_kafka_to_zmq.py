@@ -7,7 +7,17 @@ import logging
 import msgpack
 import datetime
 import queue
-import pykafka
+import time
+import collections
+
+try:
+    from . import batching
+    from . import compression
+    from . import log_backend
+except ImportError:
+    import batching
+    import compression
+    import log_backend
 
 logger = logging.getLogger(__file__)
 
@@ -17,22 +27,44 @@ def get_options():
                         help='kafka server to connect to')
     parser.add_argument('--kafka_topic',
                         help='kafka topic to consume from')
+    parser.add_argument('--log_dir',
+                        help='read local partition logs in this directory '
+                        'instead of kafka')
+    parser.add_argument('--partitions', type=int, default=1,
+                        help='partitions of each new topic in --log_dir, '
+                        'kafka topics keep their own')
+    parser.add_argument('--log_retention_mb', type=int, default=1024,
+                        help='keep at most this much of each partition in '
+                        '--log_dir, 0 to keep what a consumer group has '
+                        'not committed')
     parser.add_argument('--zknodes',
                         help='zookeeper nodes')
     parser.add_argument('--kafka_consumer_group',
                         help='kafka consumer group')
     parser.add_argument('--zmq_dispatch_address',
                         help='dispatch data to zmq socket on this address')
+    parser.add_argument('--batch_size', type=int,
+                        help='dispatch up to this many messages per batch and '
+                        'commit offsets once the receiver acks them, instead '
+                        'of one message at a time with auto commit')
+    parser.add_argument('--batch_linger_ms', type=float, default=10,
+                        help='wait this long for more messages for a batch')
+    parser.add_argument('--commit_interval', type=float, default=1.0,
+                        help='seconds between commits of acked batches')
+    parser.add_argument('--max_unacked', type=int, default=4,
+                        help='batches sent before waiting for acks')
+    parser.add_argument('--ack_timeout', type=float, default=10.0,
+                        help='seconds before an unacked batch is sent again')
 
     parsed = parser.parse_args()
 
-    if parsed.kafka_server is None:
-        raise Exception("Please specify --kafka_server")
+    if parsed.kafka_server is None and parsed.log_dir is None:
+        raise Exception("Please specify --kafka_server or --log_dir")
     if parsed.kafka_topic is None:
         raise Exception("Please specify --kafka_topic")
     if parsed.kafka_consumer_group is None:
         raise Exception("Please specify --kafka_consumer_group")
-    if parsed.zknodes is None:
+    if parsed.zknodes is None and parsed.log_dir is None:
         raise Exception("Please specify --zknodes")
     if parsed.zmq_dispatch_address is None:
         raise Exception("Please specify --zmq_dispatch_address")
@@ -40,13 +72,150 @@ def get_options():
     return parsed
 
 
+# Batched mode, for at least once delivery. Messages go to the DEALER as
+#   [b"batch", batch id, value, ...]
+# and the receiver answers each batch with
+#   [b"ack", batch id]
+# Offsets are only committed for acked batches, oldest first, so a crash
+# replays whatever was not acked. A batch not acked within ack_timeout is
+# sent again, so receivers may see a batch twice. A batch is sent once it
+# has batch_size values or batch_linger seconds after its first message;
+# the consumer's timeout only wakes the loop up to check.
+
+class Batch(object):
+    def __init__(self, batch_id, frames, offsets):
+        self.batch_id = batch_id
+        self.frames = frames
+        # partition id -> last offset in this batch
+        self.offsets = offsets
+        self.sent = time.monotonic()
+        self.acked = False
+
+
+def dispatch_batches(consumer, dispatch_socket, continue_running=None,
+                     batch_size=100, batch_linger=0.01, commit_interval=1.0,
+                     max_unacked=4, ack_timeout=10.0, stop_timeout=1.0):
+    batches = collections.OrderedDict()
+    # offsets of acked batches not committed yet
+    acked_offsets = {}
+    last_commit = [time.monotonic()]
+    counter = 0
+    messages = iter(consumer)
+    # the batch being filled, and when its first message came
+    values = []
+    offsets = {}
+    started = None
+
+    def receive_acks(timeout):
+        while dispatch_socket.poll(timeout):
+            timeout = 0
+            frames = dispatch_socket.recv_multipart()
+            if len(frames) == 2 and frames[0] == b"ack":
+                batch = batches.get(frames[1])
+                if batch is not None:
+                    batch.acked = True
+        # oldest first, a commit must not skip past an unacked batch
+        while batches:
+            batch = next(iter(batches.values()))
+            if not batch.acked:
+                break
+            del batches[batch.batch_id]
+            acked_offsets.update(batch.offsets)
+
+    def send_batch():
+        batch_id = str(counter).encode("utf8")
+        batch = batches[batch_id] = Batch(
+            batch_id, [b"batch", batch_id] + values, offsets)
+        dispatch_socket.send_multipart(batch.frames)
+
+    def commit(now):
+        last_commit[0] = now
+        if acked_offsets:
+            consumer.commit_offsets(sorted(acked_offsets.items()))
+            acked_offsets.clear()
+
+    while True:
+        receive_acks(100 if len(batches) >= max_unacked else 0)
+
+        now = time.monotonic()
+        if now - last_commit[0] >= commit_interval:
+            commit(now)
+        for batch in batches.values():
+            if now - batch.sent >= ack_timeout:
+                logger.warn("batch %s not acked, sending it again",
+                            batch.batch_id)
+                dispatch_socket.send_multipart(batch.frames)
+                batch.sent = now
+
+        if len(batches) < max_unacked:
+            while len(values) < batch_size:
+                message = next(messages)
+                if message is None:
+                    break
+                if started is None:
+                    started = time.monotonic()
+                offsets[message.partition_id] = message.offset
+                values.extend(batching.unpack_records(
+                    compression.decode(message.value)))
+                if time.monotonic() - started >= batch_linger:
+                    break
+            if values and (len(values) >= batch_size or
+                           time.monotonic() - started >= batch_linger):
+                counter += 1
+                send_batch()
+                values = []
+                offsets = {}
+                started = None
+
+        # also while busy, or stuck waiting for acks
+        if continue_running and not continue_running():
+            break
+
+    if values:
+        counter += 1
+        send_batch()
+    # give the receiver a moment to ack what it has, then commit that
+    deadline = time.monotonic() + stop_timeout
+    while batches and time.monotonic() < deadline:
+        receive_acks(100)
+    commit(time.monotonic())
+    if batches:
+        logger.warn("%s batches not acked, they will be consumed again",
+                    len(batches))
+
+
+def make_consumer(backend, kafka_topic_name, kafka_consumer_group,
+                  batch_size=None, batch_linger=0.01, partitions=None):
+    if batch_size is not None:
+        # wakes dispatch_batches often enough to send a batch that is
+        # not full within a quarter of batch_linger of its due time
+        return backend.consumer(kafka_topic_name, kafka_consumer_group,
+                                auto_commit=False, timeout=batch_linger / 4)
+    if kafka_consumer_group is None:
+        return backend.simple_consumer(kafka_topic_name,
+                                       partitions=partitions, timeout=1.0)
+    return backend.consumer(kafka_topic_name, kafka_consumer_group,
+                            auto_commit=True, timeout=1.0)
+
+
 def from_kafka_to_zmq(kafka_server_hosts, kafka_topic_name,
                       kafka_consumer_group, zknodes,
                       zmq_dispatch_address,
                       continue_running=None,
-                      zmq_context=None):
-    kafka_client = pykafka.KafkaClient(hosts=kafka_server_hosts)
-    topic = kafka_client.topics[kafka_topic_name.encode("utf8")]
+                      zmq_context=None, backend=None,
+                      batch_size=None, batch_linger=0.01,
+                      commit_interval=1.0, max_unacked=4,
+                      ack_timeout=10.0, partitions=None, consumer=None):
+    # batch_size turns on the batched, acked mode above. Without a
+    # kafka_consumer_group, partitions (all by default) are read from the
+    # latest offset on, with no group to balance or commit to. consumer,
+    # from make_consumer, is read instead of one made here, for callers
+    # that must fix the starting offsets before anything is produced.
+    if batch_size is not None and kafka_consumer_group is None:
+        raise Exception("Batched consumption needs a consumer group")
+    if backend is None:
+        backend = log_backend.PyKafkaBackend(kafka_server_hosts,
+                                             zookeeper_connect=zknodes)
 
     context = zmq_context
     if context is None:
@@ -54,16 +223,30 @@ def from_kafka_to_zmq(kafka_server_hosts, kafka_topic_name,
     dispatch_socket = context.socket(zmq.DEALER)
     dispatch_socket.connect(zmq_dispatch_address)
 
-    balanced_consumer = topic.get_balanced_consumer(
-        consumer_group=kafka_consumer_group.encode("utf8"),
-        auto_commit_enable=True,
-        zookeeper_connect=zknodes
-        )
+    balanced_consumer = consumer
+    if balanced_consumer is None:
+        balanced_consumer = make_consumer(backend, kafka_topic_name,
+                                          kafka_consumer_group,
+                                          batch_size=batch_size,
+                                          batch_linger=batch_linger,
+                                          partitions=partitions)
+
+    if batch_size is not None:
+        dispatch_batches(balanced_consumer, dispatch_socket,
+                         continue_running, batch_size=batch_size,
+                         batch_linger=batch_linger,
+                         commit_interval=commit_interval,
+                         max_unacked=max_unacked, ack_timeout=ack_timeout)
+        balanced_consumer.stop()
+        dispatch_socket.close()
+        return
 
     for message in balanced_consumer:
         if message is not None:
             offset_bytes = msgpack.packb(message.offset)
-            dispatch_socket.send_multipart([offset_bytes, message.value])
+            # batched records are split back into the original messages
+            for value in batching.unpack_records(compression.decode(message.value)):
+                dispatch_socket.send_multipart([offset_bytes, value])
         elif continue_running:
             if not continue_running():
                 break
@@ -72,11 +255,23 @@ def from_kafka_to_zmq(kafka_server_hosts, kafka_topic_name,
 def run():
     options = get_options()
 
+    backend = log_backend.make_backend(kafka_server=options.kafka_server,
+                                       zknodes=options.zknodes,
+                                       log_dir=options.log_dir,
+                                       partitions=options.partitions,
+                                       retention_mb=options.log_retention_mb)
+
     from_kafka_to_zmq(kafka_server_hosts=options.kafka_server,
                       kafka_topic_name=options.kafka_topic,
                       kafka_consumer_group=options.kafka_consumer_group,
                       zknodes=options.zknodes,
-                      zmq_dispatch_address=options.zmq_dispatch_address)
+                      zmq_dispatch_address=options.zmq_dispatch_address,
+                      backend=backend,
+                      batch_size=options.batch_size,
+                      batch_linger=options.batch_linger_ms / 1000.0,
+                      commit_interval=options.commit_interval,
+                      max_unacked=options.max_unacked,
+                      ack_timeout=options.ack_timeout)
 
 
 
@@ -7,15 +7,27 @@ import logging
 import msgpack
 import datetime
 import queue
-import pykafka
 import threading
+import signal
 
 try:
     from . import simple_kafka_to_zmq as ktoz
     from . import simple_zmq_to_kafka as ztok
+    from . import log_backend
+    from . import correlation
 except:
     import simple_kafka_to_zmq as ktoz
     import simple_zmq_to_kafka as ztok
+    import log_backend
+    import correlation
+
+try:
+    from .. import reactor
+    from .. import tracing
+except ImportError:
+    sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+    import reactor
+    import tracing
 
 
 logger = logging.getLogger(__file__)
@@ -34,18 +46,43 @@ def get_options():
                         help='kafka consumer group')
     parser.add_argument('--zmq_address',
                         help='receive and dispatch data using a zmq socket on this address')
+    parser.add_argument('--log_dir',
+                        help='use local partition logs in this directory '
+                        'instead of kafka')
+    parser.add_argument('--partitions', type=int, default=1,
+                        help='partitions of each new topic in --log_dir, '
+                        'kafka topics keep their own')
+    parser.add_argument('--log_retention_mb', type=int, default=1024,
+                        help='keep at most this much of each partition in '
+                        '--log_dir, 0 to keep what a consumer group has '
+                        'not committed')
+    parser.add_argument('--request_timeout', type=float, default=30.0,
+                        help='seconds before a request without a response '
+                        'gets a timeout error')
+    parser.add_argument('--max_outstanding', type=int, default=100000,
+                        help='requests waiting for a response before new '
+                        'ones are refused')
+    parser.add_argument('--reply_partition', type=int,
+                        help='read responses only from this partition of '
+                        'the consume topic, which no other bridge uses')
+    parser.add_argument('--reply_topic',
+                        help='read responses from this topic of its own '
+                        'instead of the consume topic')
 
     parsed = parser.parse_args()
 
-    if parsed.kafka_server is None:
-        raise Exception("Please specify --kafka_server")
+    if parsed.kafka_server is None and parsed.log_dir is None:
+        raise Exception("Please specify --kafka_server or --log_dir")
     if parsed.kafka_dispatch_topic is None:
         raise Exception("Please specify --kafka_dispatch_topic")
     if parsed.kafka_consume_topic is None:
         raise Exception("Please specify --kafka_consume_topic")
-    if parsed.kafka_consumer_group is None:
+    # only the balanced consumer needs a group and zookeeper
+    replies_routed = (parsed.reply_partition is not None or
+                      parsed.reply_topic is not None)
+    if parsed.kafka_consumer_group is None and not replies_routed:
         raise Exception("Please specify --kafka_consumer_group")
-    if parsed.zknodes is None:
+    if parsed.zknodes is None and parsed.log_dir is None and not replies_routed:
         raise Exception("Please specify --zknodes")
     if parsed.zmq_address is None:
         raise Exception("Please specify --zmq_address")
@@ -53,6 +90,9 @@ def get_options():
     return parsed
 
 
+RPC_ERROR = b"rpc-error"
+
+
 class ContinueRunning(object):
     def __init__(self):
         self._continue_running = True
@@ -66,7 +106,50 @@ def zmq_to_and_from_kafka(kafka_server_hosts,
                           kafka_consume_topic_name,
                           kafka_consumer_group, zknodes,
                           zmq_address,
-                          continue_running=None):
+                          continue_running=None,
+                          tracer=None,
+                          backend=None,
+                          table=None,
+                          reply_partition=None,
+                          reply_topic=None):
+    # Requests go to Kafka as [identity, request id, frames...] and the
+    # responder sends the same frames back, only changing the last one.
+    # Responses are routed by table, a correlation.CorrelationTable, and
+    # those it does not know are dropped. Requests without a response in
+    # time get [b"rpc-error", b"timeout", first request frame].
+    #
+    # With reply_partition or reply_topic, requests also carry a reply-to
+    # frame after the request id, and responses are read from there, from
+    # the latest offset, without a consumer group to rebalance.
+    reply_to = None
+    partitions = None
+    if reply_topic is not None:
+        kafka_consume_topic_name = reply_topic
+        reply_to = correlation.make_reply_to(reply_topic)
+    elif reply_partition is not None:
+        partitions = [reply_partition]
+        reply_to = correlation.make_reply_to(kafka_consume_topic_name,
+                                             reply_partition)
+    if reply_to is not None:
+        kafka_consumer_group = None
+
+    if table is None:
+        table = correlation.CorrelationTable()
+    if backend is None:
+        backend = log_backend.PyKafkaBackend(kafka_server_hosts,
+                                             zookeeper_connect=zknodes)
+    if reply_partition is not None:
+        partition_ids = backend.partition_ids(kafka_consume_topic_name)
+        if reply_partition not in partition_ids:
+            raise Exception("No partition %s in %s, which has %d" %
+                            (reply_partition, kafka_consume_topic_name,
+                             len(partition_ids)))
+
+    # made before main_socket is bound: a consumer starting at the latest
+    # offset once requests can come in would miss their quick responses
+    reply_consumer = ktoz.make_consumer(backend, kafka_consume_topic_name,
+                                        kafka_consumer_group,
+                                        partitions=partitions)
 
     context = zmq.Context()
     main_socket = context.socket(zmq.ROUTER)
@@ -81,7 +164,9 @@ def zmq_to_and_from_kafka(kafka_server_hosts,
                                kafka_server_hosts=kafka_server_hosts,
                                kafka_topic_name=kafka_dispatch_topic_name,
                                continue_running=continue_running,
-                               zmq_context=context)
+                               zmq_context=context,
+                               tracer=tracer,
+                               backend=backend)
 
     thread1 = threading.Thread(target=run1)
     thread1.setDaemon(True)
@@ -101,32 +186,60 @@ def zmq_to_and_from_kafka(kafka_server_hosts,
                                zknodes=zknodes,
                                zmq_dispatch_address=zmq_consume_address,
                                continue_running=continue_running,
-                               zmq_context=context)
+                               zmq_context=context,
+                               backend=backend,
+                               partitions=partitions,
+                               consumer=reply_consumer)
 
     thread2 = threading.Thread(target=run2)
     thread2.setDaemon(True)
     thread2.start()
 
-    poller = zmq.Poller()
-    poller.register(main_socket, zmq.POLLIN)
-    poller.register(consume_socket, zmq.POLLIN)
+    def handle_main_frames(socket, frames):
+        identity = frames[0]
+        tag = frames[1] if len(frames) > 1 else b""
+        request_id = table.add(identity, tag)
+        if request_id is None:
+            main_socket.send_multipart([identity, RPC_ERROR, b"busy", tag])
+            return
+        if reply_to is None:
+            frames = [identity, request_id] + frames[1:]
+        else:
+            frames = [identity, request_id, reply_to] + frames[1:]
+        dispatch_socket.send_multipart(frames)
+        if tracer is not None:
+            tracer.sample("main-to-dispatch", frames)
 
+    def handle_consume_frames(socket, frames):
+        try:
+            xframes = msgpack.unpackb(frames[-1])
+        except Exception as ex:
+            logger.error("ERROR: %s : %s", ex, frames)
+            return
+        # [dispatch identity, caller identity, request id, frames...]
+        if len(xframes) < 3:
+            return
+        request = table.match(xframes[2])
+        if request is None:
+            return
+        start = 3
+        if len(xframes) > 3 and correlation.is_reply_to(xframes[3]):
+            start = 4
+        main_socket.send_multipart([request.identity] + xframes[start:])
+        if tracer is not None:
+            tracer.sample("consume-to-main", xframes)
+
+    loop = reactor.Reactor()
+    loop.register(main_socket, handle_main_frames)
+    loop.register(consume_socket, handle_consume_frames)
     while continue_running():
-        for socket, event in poller.poll(timeout=1000):
-            frames = socket.recv_multipart()
-            if socket == main_socket:
-                dispatch_socket.send_multipart(frames)
-                logger.debug("main to dispatch: %s", frames)
-            elif socket == consume_socket:
-                logger.debug("consume to main: %s", frames)
-                try:
-                    xframes = msgpack.unpackb(frames[-1])
-                    logger.debug("xframes: %s", xframes)
-                    main_socket.send_multipart(xframes[1:])
-                except Exception as ex:
-                    logger.error("ERROR: %s : %s", ex, frames)
-            else:
-                logger.error("unknown socket: %s - %s", socket, frames)
+        timeout = table.next_deadline()
+        if timeout is None or timeout > 1.0:
+            timeout = 1.0
+        loop.poll_once(timeout * 1000)
+        for request in table.expire():
+            main_socket.send_multipart([request.identity, RPC_ERROR,
+                                        b"timeout", request.tag])
 
 
 
@@ -135,6 +248,24 @@ def run():
 
     continue_running = ContinueRunning()
 
+    table = correlation.CorrelationTable(timeout=options.request_timeout,
+                                         max_outstanding=options.max_outstanding)
+
+    # kill -USR1 <pid> logs the sampled trace records and the round trips
+    tracer = tracing.Tracer()
+
+    def log_dump(signum, frame):
+        tracer.log_dump()
+        table.log_stats()
+
+    signal.signal(signal.SIGUSR1, log_dump)
+
+    backend = log_backend.make_backend(kafka_server=options.kafka_server,
+                                       zknodes=options.zknodes,
+                                       log_dir=options.log_dir,
+                                       partitions=options.partitions,
+                                       retention_mb=options.log_retention_mb)
+
     zmq_to_and_from_kafka(
         kafka_server_hosts=options.kafka_server,
         kafka_dispatch_topic_name=options.kafka_dispatch_topic,
@@ -142,7 +273,12 @@ def run():
         kafka_consumer_group=options.kafka_consumer_group,
         zknodes=options.zknodes,
         zmq_address=options.zmq_address,
-        continue_running=continue_running)
+        continue_running=continue_running,
+        tracer=tracer,
+        backend=backend,
+        table=table,
+        reply_partition=options.reply_partition,
+        reply_topic=options.reply_topic)
 
 
 
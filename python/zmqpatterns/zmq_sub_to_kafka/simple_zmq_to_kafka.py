@@ -5,9 +5,33 @@ import zmq
 import uuid
 import logging
 import msgpack
-import datetime
 import queue
-import pykafka
+import struct
+import signal
+import collections
+
+try:
+    from .. import reactor
+    from .. import tracing
+except ImportError:
+    sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+    import reactor
+    import tracing
+
+try:
+    from . import inflight
+    from . import batching
+    from . import compression
+    from . import spool
+    from . import log_backend
+    from . import partition_keys
+except ImportError:
+    import inflight
+    import batching
+    import compression
+    import spool
+    import log_backend
+    import partition_keys
 
 logger = logging.getLogger(__file__)
 
@@ -17,13 +41,51 @@ def get_options():
                         help='kafka server to connect to')
     parser.add_argument('--kafka_topic',
                         help='kafka topic to publish to')
+    parser.add_argument('--log_dir',
+                        help='write to local partition logs in this directory '
+                        'instead of kafka')
+    parser.add_argument('--partitions', type=int, default=1,
+                        help='partitions of each new topic in --log_dir, '
+                        'kafka topics keep their own')
+    parser.add_argument('--log_retention_mb', type=int, default=1024,
+                        help='keep at most this much of each partition in '
+                        '--log_dir, 0 to keep what a consumer group has '
+                        'not committed')
     parser.add_argument('--zmq_listener_address',
                         help='listen for data via zmq socket on this address')
+    parser.add_argument('--window_size', type=int, default=10000,
+                        help='messages waiting for a kafka delivery report '
+                        'before zmq receiving stops')
+    parser.add_argument('--batch_count', type=int, default=1,
+                        help='pack up to this many zmq messages into one '
+                        'kafka record, 1 disables batching')
+    parser.add_argument('--batch_bytes', type=int, default=65536,
+                        help='flush a batch once it holds this many bytes')
+    parser.add_argument('--batch_linger_ms', type=float, default=5,
+                        help='flush a batch this long after its first message')
+    parser.add_argument('--compression', default="none",
+                        choices=sorted(compression.KNOWN_CODECS),
+                        help='compress kafka record values with this codec, '
+                        'installed: %s' % ", ".join(compression.available()))
+    parser.add_argument('--compression_level', type=int,
+                        help='codec specific compression level')
+    parser.add_argument('--partition_by', default="none",
+                        help='kafka partition key: %s, or module:function '
+                        'taking the received frames; use subscriber behind '
+                        'a shared sink' % ", ".join(partition_keys.KEY_BY))
+    parser.add_argument('--spool_dir',
+                        help='spool messages to disk in this directory first, '
+                        'so they survive kafka outages and restarts')
+    parser.add_argument('--spool_segment_mb', type=int, default=64,
+                        help='size of each spool segment file')
+    parser.add_argument('--spool_sync_ms', type=float, default=100,
+                        help='flush spooled messages and the ack cursor '
+                        'to disk this often')
 
     parsed = parser.parse_args()
 
-    if parsed.kafka_server is None:
-        raise Exception("Please specify --kafka_server")
+    if parsed.kafka_server is None and parsed.log_dir is None:
+        raise Exception("Please specify --kafka_server or --log_dir")
     if parsed.kafka_topic is None:
         raise Exception("Please specify --kafka_topic")
     if parsed.zmq_listener_address is None:
@@ -32,34 +94,66 @@ def get_options():
     return parsed
 
 
-def commit(kafka_producer, mcollected):
+def drain_delivery_reports(kafka_producer, window, sequences, timeout=None):
+    # waits up to timeout seconds for the first report when given.
+    # sequences maps each produced message to its sequence in the window.
+    block = timeout is not None
+    reports = 0
     while True:
         try:
-            msg, exc = kafka_producer.get_delivery_report(block=False)
-            bframes, index = mcollected[msg.partition_key]
-            collected = mcollected["LIST"]
-            if exc is not None:
-                logger.warn("Failed to deliver msg %s: %s", msg.partition_key, repr(exc))
-                kafka_producer.produce(bframes, partition_key=msg.partition_key)
-            else:
-                collected = mcollected["LIST"]
-                if collected[index]:
-                    assert collected[index][0] == msg.partition_key, (collected[index], msg)
-                collected[index] = None
-                del mcollected[msg.partition_key]
-                logger.warn("%s - %s", msg.partition_key, len(mcollected))
-                if len(mcollected) == 1:
-                    mcollected["LIST"] = []
-                    logger.warn("Zeroed")
+            msg, exc = kafka_producer.get_delivery_report(block=block,
+                                                          timeout=timeout)
         except queue.Empty:
             break
+        block = False
+        reports += 1
+        sequence = sequences.pop(msg, None)
+        if sequence is None:
+            continue
+        if exc is not None:
+            logger.warn("Failed to deliver msg %s: %s", sequence, repr(exc))
+            bframes = window.get(sequence)
+            if bframes is not None:
+                retry = kafka_producer.produce(bframes,
+                                               partition_key=msg.partition_key)
+                sequences[retry] = sequence
+        else:
+            window.ack(sequence)
+    return reports
+
+
+# spooled records carry their partition key, a 0 length for none
+SPOOL_KEY_LENGTH = struct.Struct("!H")
+
+
+def spool_record(bframes, partition_key):
+    if partition_key is None:
+        return SPOOL_KEY_LENGTH.pack(0) + bframes
+    return SPOOL_KEY_LENGTH.pack(len(partition_key)) + partition_key + bframes
+
+
+def unspool_record(value):
+    # (record value, partition key)
+    (length,) = SPOOL_KEY_LENGTH.unpack_from(value)
+    start = SPOOL_KEY_LENGTH.size
+    if length == 0:
+        return value[start:], None
+    return value[start + length:], value[start:start + length]
 
 
 def from_zmq_to_kafka(zmq_listener_address, kafka_server_hosts,
                       kafka_topic_name, continue_running=None,
-                      zmq_context=None):
-    kafka_client = pykafka.KafkaClient(hosts=kafka_server_hosts)
-    topic = kafka_client.topics[kafka_topic_name.encode("utf8")]
+                      zmq_context=None, tracer=None, window_size=10000,
+                      batcher=None, codec=None, spool=None,
+                      backend=None, partition_key=None):
+    # batcher is a batching.KeyedBatcher, or a Batcher with its settings,
+    # partition_key a key function from partition_keys or None to spread
+    # messages over all partitions
+    if backend is None:
+        backend = log_backend.PyKafkaBackend(kafka_server_hosts)
+    if isinstance(batcher, batching.Batcher):
+        batcher = batching.KeyedBatcher(batcher.max_count, batcher.max_bytes,
+                                        batcher.linger)
 
     context = zmq_context
     if context is None:
@@ -67,60 +161,168 @@ def from_zmq_to_kafka(zmq_listener_address, kafka_server_hosts,
     recv_socket = context.socket(zmq.ROUTER)
     recv_socket.bind(zmq_listener_address)
 
-    poller = zmq.Poller()
-    poller.register(recv_socket, zmq.POLLIN)
+    loop = reactor.Reactor()
+    window = inflight.InflightWindow(window_size)
+    # the partition key no longer says which message a delivery report is
+    # for, so the window sequence is kept by produced message
+    sequences = {}
+    # spool position after each message in the window, by sequence
+    positions = [None] * window_size
+    acked = [0]
+    # the rest of a sink batch that arrived with the window full
+    overflow = collections.deque()
 
-    with topic.get_producer(delivery_reports=True) as kafka_producer:
-        last_updated = datetime.datetime.now()
-        mcollected = {}
-        mcollected["LIST"] = []
-        counter = 0
-        while True:
-            collected = mcollected["LIST"]
-            recved = False
-            for socket, option in poller.poll(timeout=1000):
-                recved = True
-                frames = socket.recv_multipart()
-                bframes = msgpack.packb(frames)
+    with backend.producer(kafka_topic_name, delivery_reports=True,
+                          keyed=partition_key is not None) as kafka_producer:
 
-                partition_key = str(counter).encode("utf8")
-                kafka_producer.produce(bframes, partition_key=partition_key)
-                counter += 1
+        def produce(bframes, key):
+            sequence = window.add(bframes)
+            message = kafka_producer.produce(bframes, partition_key=key)
+            sequences[message] = sequence
+            return sequence
 
-                collected.append((partition_key, bframes))
-                mcollected[partition_key] = (bframes, len(collected) - 1)
+        def forward(bframes, key):
+            # after batching, so a whole batch is compressed in one go
+            bframes = compression.encode(bframes, codec)
+            if spool is not None:
+                # never blocks on kafka, the producer stage below reads
+                # it back out
+                spool.append(spool_record(bframes, key))
+                return
 
-                print(partition_key, frames)
+            if window.full():
+                overflow.append((bframes, key))
+                return
+            produce(bframes, key)
+            if window.full():
+                # stop reading, the backlog then builds up against the zmq
+                # high water marks instead of in this process
+                loop.unregister(recv_socket)
 
+        def produce_from_spool():
+            while not window.full():
+                record = spool.read()
+                if record is None:
+                    break
+                value, position = record
+                sequence = produce(*unspool_record(value))
+                positions[sequence % window_size] = position
 
-                if len(mcollected) > 1000:
-                    commit(kafka_producer, mcollected)
-                    pass
+        def ack_spool():
+            # everything before the window tail has been delivered
+            if window.tail != acked[0]:
+                acked[0] = window.tail
+                spool.ack(positions[(window.tail - 1) % window_size])
 
-                if len(mcollected) > 10:
-                    current_timestamp = datetime.datetime.now()
-                    delta = current_timestamp - last_updated
-                    if delta.total_seconds() > 5:
-                        commit(kafka_producer, mcollected)
-                        last_updated = current_timestamp
-                        pass
+        def add(bframes, key):
+            if batcher is None:
+                forward(bframes, key)
+            elif batcher.add(bframes, key):
+                forward(*batcher.flush(key))
 
+        def handle_frames(socket, frames):
+            if tracer is not None:
+                tracer.sample("zmq-to-kafka", frames)
+            if len(frames) == 3 and frames[1] == batching.SINK_BATCH:
+                handle_sink_batch(frames[2])
+                return
 
-            if not recved:
-                if len(mcollected) > 0:
-                    commit(kafka_producer, mcollected)
-                pass
+            key = None
+            if partition_key is not None:
+                key = partition_key(frames)
+            add(msgpack.packb(frames), key)
+
+        def handle_sink_batch(value):
+            # already packed by a sink_pool.SinkPool
+            if batcher is None and partition_key is None:
+                forward(value, None)
+                return
+            for bframes in batching.unpack_records(value):
+                key = None
+                if partition_key is not None:
+                    key = partition_key(msgpack.unpackb(bframes))
+                add(bframes, key)
+
+        loop.register(recv_socket, handle_frames)
 
+        while True:
+            if spool is None and window.full():
+                recved = 0
+                drain_delivery_reports(kafka_producer, window, sequences,
+                                       timeout=1.0)
+            else:
+                # delivery reports do not wake the poller, so only sleep
+                # for long when nothing is waiting for one
+                timeout = 10 if len(window) else 1000
+                if batcher is not None and len(batcher):
+                    timeout = min(timeout, batcher.remaining() * 1000)
+                if spool is not None and spool.readable() and not window.full():
+                    timeout = 0
+                recved = loop.poll_once(timeout)
+                drain_delivery_reports(kafka_producer, window, sequences)
+
+            if spool is None:
+                while overflow and not window.full():
+                    produce(*overflow.popleft())
+                # the reports may have made room in either branch
+                if not window.full() and not loop.registered(recv_socket):
+                    loop.register(recv_socket, handle_frames)
+
+            while batcher is not None and batcher.expired() and (
+                    spool is not None or not window.full()):
+                forward(*batcher.flush_oldest())
+
+            if spool is not None:
+                ack_spool()
+                produce_from_spool()
+
+            if not recved:
                 if continue_running:
                     if not continue_running():
                         break
 
+    if spool is not None:
+        ack_spool()
+        spool.sync()
+
 def run():
     options = get_options()
 
+    # kill -USR1 <pid> logs the sampled trace records
+    tracer = tracing.Tracer()
+    signal.signal(signal.SIGUSR1, lambda signum, frame: tracer.log_dump())
+
+    codec = compression.get_codec(options.compression,
+                                  options.compression_level)
+
+    batcher = None
+    if options.batch_count > 1:
+        batcher = batching.KeyedBatcher(max_count=options.batch_count,
+                                        max_bytes=options.batch_bytes,
+                                        linger=options.batch_linger_ms / 1000.0)
+
+    message_spool = None
+    if options.spool_dir is not None:
+        message_spool = spool.Spool(options.spool_dir,
+                                    segment_size=options.spool_segment_mb * 1024 * 1024,
+                                    sync_interval=options.spool_sync_ms / 1000.0)
+
+    backend = log_backend.make_backend(kafka_server=options.kafka_server,
+                                       log_dir=options.log_dir,
+                                       partitions=options.partitions,
+                                       retention_mb=options.log_retention_mb)
+
     from_zmq_to_kafka(zmq_listener_address=options.zmq_listener_address,
                       kafka_server_hosts=options.kafka_server,
-                      kafka_topic_name=options.kafka_topic)
+                      kafka_topic_name=options.kafka_topic,
+                      tracer=tracer,
+                      window_size=options.window_size,
+                      batcher=batcher,
+                      codec=codec,
+                      spool=message_spool,
+                      backend=backend,
+                      partition_key=partition_keys.make_key_function(
+                          options.partition_by))
 
 
 
@@ -0,0 +1,136 @@
+import sys
+import os
+import zmq
+import logging
+import msgpack
+
+try:
+    from .. import metrics
+except ImportError:
+    sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+    import metrics
+
+try:
+    from . import batching
+except ImportError:
+    import batching
+
+logger = logging.getLogger(__file__)
+
+# One sink per controller process instead of a DEALER per subscriber.
+# Subscribers PUSH their messages to the fan-in PULL over inproc. The sink
+# packs them into batches and sends each batch over one of a few DEALERs
+# to kafka_zmq_address as
+#   [batching.SINK_BATCH, batch]
+# where the batch is a Kafka record value as batching.Batcher makes it,
+# its messages packed as [SINK_IDENTITY] + frames in place of the ROUTER
+# identity from_zmq_to_kafka would have added.
+#
+# Every DEALER has a small high water mark and is sent to without
+# blocking; when they are all full the sink stops reading the fan-in, so
+# the backlog stays in the subscribers' HWM bounded queues.
+
+SINK_IDENTITY = b"sink-pool"
+
+
+class SinkPool(object):
+    def __init__(self, zmq_context, kafka_zmq_address, connections=2,
+                 batch_count=64, batch_bytes=65536, linger=0.002, hwm=100,
+                 registry=None):
+        self.zmq_context = zmq_context
+        self.kafka_zmq_address = kafka_zmq_address
+        self.address = "inproc://sink-pool-%x" % id(self)
+        self.connections = connections
+        self.batcher = batching.Batcher(max_count=batch_count,
+                                        max_bytes=batch_bytes, linger=linger)
+        self.hwm = hwm
+        # a metrics.Metrics for the sink-* socket counters
+        if registry is None:
+            registry = metrics.Metrics()
+        self.metrics = registry
+        self._continue_running = None
+        self.fan_in = None
+
+    def bind(self):
+        # before any subscriber connects, so inproc connects do not fail
+        self.fan_in = self.zmq_context.socket(zmq.PULL)
+        self.fan_in.set_hwm(self.hwm)
+        self.fan_in.bind(self.address)
+
+    def connect(self):
+        # the subscribers' end, blocks at the high water mark
+        socket = self.zmq_context.socket(zmq.PUSH)
+        socket.set_hwm(self.hwm)
+        socket.connect(self.address)
+        return socket
+
+    def continue_running(self):
+        return self._continue_running
+
+    def request_quit(self):
+        self._continue_running = False
+
+    def run(self):
+        assert self._continue_running is None, (self, self._continue_running)
+        self._continue_running = True
+        if self.fan_in is None:
+            self.bind()
+        fan_in_counters = self.metrics.socket("sink-fan-in")
+
+        outbound = []
+        out_poller = zmq.Poller()
+        for n in range(self.connections):
+            socket = self.zmq_context.socket(zmq.DEALER)
+            socket.set_hwm(self.hwm)
+            socket.connect(self.kafka_zmq_address)
+            outbound.append((socket, self.metrics.socket("sink-%d" % n)))
+            out_poller.register(socket, zmq.POLLOUT)
+
+        batcher = self.batcher
+        pending = None
+        next_connection = 0
+        while self._continue_running:
+            if pending is not None:
+                # round robin over the connections with room for it
+                for n in range(len(outbound)):
+                    socket, counters = outbound[(next_connection + n) % len(outbound)]
+                    try:
+                        socket.send_multipart(pending, zmq.NOBLOCK)
+                    except zmq.Again:
+                        continue
+                    counters.sent(pending)
+                    next_connection += n + 1
+                    pending = None
+                    break
+                else:
+                    out_poller.poll(100)
+                    continue
+
+            timeout = 100
+            if len(batcher):
+                timeout = batcher.remaining() * 1000
+            if self.fan_in.poll(timeout):
+                while not batcher.full():
+                    try:
+                        frames = self.fan_in.recv_multipart(zmq.NOBLOCK)
+                    except zmq.Again:
+                        break
+                    fan_in_counters.received(frames)
+                    batcher.add(msgpack.packb([SINK_IDENTITY] + frames))
+            if len(batcher) and (batcher.full() or batcher.expired()):
+                pending = [batching.SINK_BATCH, batcher.flush()]
+
+        unsent = [pending] if pending is not None else []
+        if len(batcher):
+            unsent.append([batching.SINK_BATCH, batcher.flush()])
+        for frames in unsent:
+            # one last try, the rest is lost with the process anyway
+            try:
+                outbound[0][0].send_multipart(frames, zmq.NOBLOCK)
+            except zmq.Again:
+                logger.warn("sink closed with an unsent batch")
+        for socket, counters in outbound:
+            socket.close(linger=1000)
+        self.fan_in.close(linger=0)
+        self.fan_in = None
+        self._continue_running = None
@@ -0,0 +1,252 @@
+import os
+import mmap
+import time
+import glob
+import zlib
+import struct
+import logging
+
+logger = logging.getLogger(__file__)
+
+# Append only disk spool made of preallocated, memory mapped segment files.
+#
+# Each segment holds records of:
+#   I   length, network byte order, never 0
+#   I   crc32 of the data
+#   *   data
+# and is zero filled after the last record, so a 0 length marks the end of
+# what has been written. A crash can leave a record torn: its data without
+# its header, or with power lost, a header whose data never reached the
+# disk. On opening, the end is the first record whose length or crc does
+# not check out, and everything after it is zeroed again, so a later,
+# shorter record cannot leave the rest of a torn one to be read as records.
+#
+# A position is (segment number, offset). The ack cursor is the position
+# up to which everything was delivered; it is kept in ACK_FILENAME and
+# replaced atomically. Segments wholly before it are deleted. On restart
+# reading starts again from the ack cursor, so delivery is at least once.
+#
+# Every sync_interval the segments written since the last sync are
+# flushed to disk, then the cursor is written and fsynced, so at most
+# that much of what was appended is lost with a power failure or kernel
+# crash. A process crash loses nothing, the kernel has the mapped pages.
+
+RECORD = struct.Struct("!II")
+CURSOR = struct.Struct("!QQ")
+ACK_FILENAME = "ack"
+SEGMENT_PATTERN = "%020d.spool"
+
+
+class Segment(object):
+    def __init__(self, filename, size=None):
+        if size is not None:
+            with open(filename, "wb") as hFile:
+                hFile.truncate(size)
+        self.filename = filename
+        self.fd = os.open(filename, os.O_RDWR)
+        self.size = os.fstat(self.fd).st_size
+        self.map = mmap.mmap(self.fd, self.size)
+
+    def close(self):
+        self.map.close()
+        os.close(self.fd)
+
+
+class Spool(object):
+    def __init__(self, directory, segment_size=64 * 1024 * 1024,
+                 sync_interval=0.1):
+        self.directory = directory
+        self.segment_size = segment_size
+        self.sync_interval = sync_interval
+        self.segments = {}
+        self.last_sync = 0.0
+        # segment numbers written to since the last sync
+        self.dirty = set()
+        # a segment file was created since the last sync
+        self.created = False
+
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+        self.ack_position = self.read_cursor()
+        self.synced_position = self.ack_position
+        numbers = self.segment_numbers()
+        if not numbers:
+            numbers = [self.ack_position[0]]
+            self.segments[numbers[0]] = Segment(self.segment_filename(numbers[0]),
+                                                self.segment_size)
+            self.created = True
+        self.read_position = self.ack_position
+        if self.read_position[0] < numbers[0]:
+            self.read_position = (numbers[0], 0)
+        self.write_position = self.find_end(numbers[-1])
+
+    def segment_filename(self, number):
+        return os.path.join(self.directory, SEGMENT_PATTERN % number)
+
+    def segment_numbers(self):
+        pattern = os.path.join(self.directory, "*.spool")
+        return sorted(int(os.path.basename(filename).split(".")[0])
+                      for filename in glob.glob(pattern))
+
+    def segment(self, number):
+        segment = self.segments.get(number)
+        if segment is None:
+            segment = self.segments[number] = Segment(self.segment_filename(number))
+        return segment
+
+    def release(self, number):
+        # unmap a segment neither the reader nor the writer is in
+        if number in (self.read_position[0], self.write_position[0]):
+            return
+        segment = self.segments.pop(number, None)
+        if segment is not None:
+            if number in self.dirty:
+                segment.map.flush()
+                self.dirty.discard(number)
+            segment.close()
+
+    def record_at(self, segment, offset):
+        # (value, end) of the record at offset, None if there is none or
+        # it was torn
+        if offset + RECORD.size > segment.size:
+            return None
+        length, crc = RECORD.unpack_from(segment.map, offset)
+        end = offset + RECORD.size + length
+        if length == 0 or end > segment.size:
+            return None
+        value = segment.map[offset + RECORD.size:end]
+        if zlib.crc32(value) != crc:
+            return None
+        return value, end
+
+    def find_end(self, number):
+        segment = self.segment(number)
+        offset = 0
+        if number == self.ack_position[0]:
+            offset = self.ack_position[1]
+        while True:
+            record = self.record_at(segment, offset)
+            if record is None:
+                break
+            offset = record[1]
+        tail = segment.map[offset:]
+        if tail.count(0) != len(tail):
+            logger.warn("%s: zeroing a torn record after %d",
+                        segment.filename, offset)
+            segment.map[offset:] = bytes(len(tail))
+            segment.map.flush()
+        return (number, offset)
+
+    def read_cursor(self):
+        try:
+            with open(os.path.join(self.directory, ACK_FILENAME), "rb") as hFile:
+                return CURSOR.unpack(hFile.read(CURSOR.size))
+        except (IOError, OSError, struct.error):
+            numbers = self.segment_numbers()
+            return (numbers[0] if numbers else 0, 0)
+
+    def write_cursor(self, position):
+        filename = os.path.join(self.directory, ACK_FILENAME)
+        with open(filename + ".tmp", "wb") as hFile:
+            hFile.write(CURSOR.pack(*position))
+            hFile.flush()
+            os.fsync(hFile.fileno())
+        os.replace(filename + ".tmp", filename)
+        self.sync_directory()
+
+    def sync_directory(self):
+        fd = os.open(self.directory, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+    def append(self, value):
+        if not value:
+            raise ValueError("cannot spool an empty record")
+        number, offset = self.write_position
+        segment = self.segment(number)
+        end = offset + RECORD.size + len(value)
+        if end > segment.size:
+            # the rest of this segment stays zero, readers skip over it
+            old_number = number
+            number += 1
+            offset = 0
+            end = RECORD.size + len(value)
+            self.segments[number] = segment = Segment(
+                self.segment_filename(number), max(self.segment_size, end))
+            self.created = True
+            self.write_position = (number, 0)
+            self.release(old_number)
+        segment.map[offset + RECORD.size:end] = value
+        RECORD.pack_into(segment.map, offset, len(value), zlib.crc32(value))
+        self.write_position = (number, end)
+        self.dirty.add(number)
+        if time.monotonic() - self.last_sync >= self.sync_interval:
+            self.sync()
+
+    def readable(self):
+        return self.read_position != self.write_position
+
+    def read(self):
+        # (value, position after it), None when everything has been read
+        while self.read_position != self.write_position:
+            number, offset = self.read_position
+            segment = self.segment(number)
+            record = self.record_at(segment, offset)
+            if record is None:
+                if number == self.write_position[0]:
+                    # never past the writer, find_end checked what it found
+                    logger.error("%s: bad record at %d before the end at %d",
+                                 segment.filename, offset,
+                                 self.write_position[1])
+                    self.read_position = self.write_position
+                    return None
+                # end of a segment the writer has moved on from, or a
+                # record torn when it was the last segment
+                if (offset + RECORD.size <= segment.size and
+                        RECORD.unpack_from(segment.map, offset)[0] != 0):
+                    logger.warn("%s: skipping a torn record at %d",
+                                segment.filename, offset)
+                self.read_position = (number + 1, 0)
+                self.release(number)
+                continue
+            value, end = record
+            self.read_position = (number, end)
+            return value, self.read_position
+        return None
+
+    def ack(self, position):
+        self.ack_position = position
+        if time.monotonic() - self.last_sync >= self.sync_interval:
+            self.sync()
+
+    def sync(self):
+        self.last_sync = time.monotonic()
+        # the records first, so the cursor never gets ahead of them
+        for number in self.dirty:
+            segment = self.segments.get(number)
+            if segment is not None:
+                segment.map.flush()
+        self.dirty.clear()
+        if self.created:
+            self.sync_directory()
+            self.created = False
+        if self.ack_position == self.synced_position:
+            return
+        self.write_cursor(self.ack_position)
+        self.synced_position = self.ack_position
+        for number in self.segment_numbers():
+            if number >= self.ack_position[0]:
+                break
+            segment = self.segments.pop(number, None)
+            if segment is not None:
+                segment.close()
+            os.remove(self.segment_filename(number))
+
+    def close(self):
+        self.sync()
+        for segment in self.segments.values():
+            segment.close()
+        self.segments = {}
@@ -0,0 +1,105 @@
+import os
+import logging
+import msgpack
+
+logger = logging.getLogger(__file__)
+
+# The controller's subscriptions, kept on disk so a restarted controller
+# can bring them all back. The journal is a stream of msgpack records
+#   [b"+", name, address]   subscribed
+#   [b"-", name]            unsubscribed
+# appended as they happen. Once it holds compact_ratio times as many
+# records as there are subscriptions it is rewritten with just the live
+# ones, to a temporary file renamed over the journal. A record cut short
+# by a crash is dropped on load.
+
+SUBSCRIBED = b"+"
+UNSUBSCRIBED = b"-"
+
+
+class SubscriptionRegistry(object):
+    def __init__(self, path, sync=False, compact_ratio=2.0, compact_min=1000):
+        self.path = path
+        # fsync every record, not only the compacted journal
+        self.sync = sync
+        self.compact_ratio = compact_ratio
+        self.compact_min = compact_min
+        self.subscriptions = {}
+        self.records = 0
+        self.hFile = None
+
+    def __len__(self):
+        return len(self.subscriptions)
+
+    def load(self):
+        # name -> address, replayed from the journal
+        self.subscriptions = {}
+        self.records = 0
+        good = 0
+        if os.path.exists(self.path):
+            unpacker = msgpack.Unpacker()
+            with open(self.path, "rb") as hFile:
+                unpacker.feed(hFile.read())
+            try:
+                for record in unpacker:
+                    self.replay(record)
+                    self.records += 1
+                    good = unpacker.tell()
+            except Exception as ex:
+                logger.warn("%s: bad record after %d bytes: %s",
+                            self.path, good, ex)
+        self.hFile = open(self.path, "ab")
+        if self.hFile.tell() != good:
+            logger.warn("%s: dropping %d bytes after the last record",
+                        self.path, self.hFile.tell() - good)
+            self.hFile.truncate(good)
+            self.hFile.seek(good)
+        return dict(self.subscriptions)
+
+    def replay(self, record):
+        if record[0] == SUBSCRIBED:
+            self.subscriptions[record[1]] = record[2]
+        elif record[0] == UNSUBSCRIBED:
+            self.subscriptions.pop(record[1], None)
+        else:
+            raise Exception("Unknown record: %s" % (record,))
+
+    def add(self, name, address):
+        self.subscriptions[name] = address
+        self.append([SUBSCRIBED, name, address])
+
+    def remove(self, name):
+        if self.subscriptions.pop(name, None) is not None:
+            self.append([UNSUBSCRIBED, name])
+
+    def append(self, record):
+        if self.hFile is None:
+            self.hFile = open(self.path, "ab")
+        self.hFile.write(msgpack.packb(record))
+        self.hFile.flush()
+        if self.sync:
+            os.fsync(self.hFile.fileno())
+        self.records += 1
+        if self.records > max(self.compact_min,
+                              self.compact_ratio * len(self.subscriptions)):
+            self.compact()
+
+    def compact(self):
+        temp_path = self.path + ".tmp"
+        with open(temp_path, "wb") as hFile:
+            for name, address in self.subscriptions.items():
+                hFile.write(msgpack.packb([SUBSCRIBED, name, address]))
+            hFile.flush()
+            os.fsync(hFile.fileno())
+        if self.hFile is not None:
+            self.hFile.close()
+        os.replace(temp_path, self.path)
+        self.hFile = open(self.path, "ab")
+        logger.debug("%s: compacted %d records to %d", self.path,
+                     self.records, len(self.subscriptions))
+        self.records = len(self.subscriptions)
+
+    def close(self):
+        if self.hFile is not None:
+            self.hFile.close()
+            self.hFile = None
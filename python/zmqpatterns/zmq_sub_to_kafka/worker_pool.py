@@ -0,0 +1,284 @@
+import os
+import zmq
+import time
+import zlib
+import logging
+import tempfile
+import threading
+import multiprocessing
+import msgpack
+
+logger = logging.getLogger(__file__)
+
+# Subscriptions spread over worker processes, each running a
+# ZmqPrimaryController of its own on an ipc address. The pool speaks the
+# same cmd protocol to the workers as clients speak to the controller, with
+# its own request ids, and relays the replies.
+
+
+def run_worker(address, kafka_zmq_address, engine, parent_pid,
+               sink_connections, legacy_header=False):
+    try:
+        from . import zmq_sub_to_kafka
+    except ImportError:
+        import zmq_sub_to_kafka
+
+    logging.basicConfig(level=logging.WARN)
+    context = zmq.Context()
+    controller = zmq_sub_to_kafka.ZmqPrimaryController(
+        context, address, kafka_zmq_address, None, engine=engine,
+        sink_connections=sink_connections, legacy_header=legacy_header)
+
+    def watch_parent():
+        # do not outlive a supervisor that was killed
+        while controller.continue_running() is not False:
+            if os.getppid() != parent_pid:
+                controller.request_quit()
+                break
+            time.sleep(1)
+
+    watcher = threading.Thread(target=watch_parent)
+    watcher.daemon = True
+    watcher.start()
+    controller.run()
+
+
+def merge_trace_dumps(replies):
+    # replies to trace-dump from every worker, as one trace-dump reply
+    seen = recorded = 0
+    records = []
+    for reply in replies:
+        if reply[1:2] != [b"trace-dump"]:
+            continue
+        dump = msgpack.unpackb(reply[2])
+        seen += dump["seen"]
+        recorded += dump["recorded"]
+        records.extend(dump["records"])
+    records.sort(key=lambda record: record[0])
+    return [b"cmd-response", b"trace-dump",
+            msgpack.packb({"seen": seen, "recorded": recorded,
+                           "records": records})]
+
+
+def merge_trace_configs(replies):
+    # the first error, if any worker failed
+    for reply in replies:
+        if reply[1:2] != [b"trace-configured"]:
+            return reply
+    return [b"cmd-response", b"trace-configured"]
+
+
+class Worker(object):
+    def __init__(self, index, address):
+        self.index = index
+        self.address = address
+        self.process = None
+        self.socket = None
+        self.started = 0.0
+        self.last_seen = 0.0
+        self.restarts = 0
+        self.stats = None
+        self.names = set()
+
+    def alive(self):
+        return self.process is not None and self.process.is_alive()
+
+
+class WorkerPool(object):
+    def __init__(self, zmq_context, kafka_zmq_address, size, assign="hash",
+                 engine="loop", health_interval=1.0, health_timeout=10.0,
+                 ipc_dir=None, sink_connections=0, legacy_header=False):
+        self.zmq_context = zmq_context
+        self.kafka_zmq_address = kafka_zmq_address
+        # "hash" keeps a name on the same worker across restarts of the
+        # supervisor, "load" picks the worker with fewest subscriptions
+        self.assign = assign
+        self.engine = engine
+        self.sink_connections = sink_connections
+        self.legacy_header = legacy_header
+        self.health_interval = health_interval
+        self.health_timeout = health_timeout
+        if ipc_dir is None:
+            ipc_dir = tempfile.gettempdir()
+        self.workers = [Worker(n, "ipc://%s/zmq-sub-%d-worker-%d" % (
+                                   ipc_dir, os.getpid(), n))
+                        for n in range(size)]
+        self.assignments = {}
+        self.pending = {}
+        self.counter = 0
+        self.next_poll = 0.0
+        # no fork: the parent's zmq context must not be shared
+        self.multiprocessing = multiprocessing.get_context("spawn")
+
+    def start(self, reactor):
+        for worker in self.workers:
+            worker.socket = self.zmq_context.socket(zmq.DEALER)
+            worker.socket.connect(worker.address)
+            reactor.register(worker.socket, self.handle_worker_frames)
+            self.spawn(worker)
+
+    def spawn(self, worker):
+        worker.process = self.multiprocessing.Process(
+            target=run_worker,
+            args=(worker.address, self.kafka_zmq_address, self.engine,
+                  os.getpid(), self.sink_connections, self.legacy_header))
+        worker.process.daemon = True
+        worker.process.start()
+        worker.started = worker.last_seen = time.monotonic()
+        logger.info("worker %s started, pid %s", worker.index,
+                    worker.process.pid)
+
+    def send(self, worker, frames, on_reply):
+        self.counter += 1
+        request_id = str(self.counter).encode("utf8")
+        self.pending[request_id] = (worker.index, on_reply)
+        worker.socket.send_multipart([request_id, b"cmd"] + frames)
+
+    def handle_worker_frames(self, socket, frames):
+        # [request_id, b"cmd-response", ...]
+        entry = self.pending.pop(frames[0], None)
+        if entry is None:
+            return
+        index, on_reply = entry
+        self.workers[index].last_seen = time.monotonic()
+        on_reply(frames[1:])
+
+    def select(self, name):
+        if self.assign == "load":
+            return min(self.workers, key=lambda worker: len(worker.names))
+        return self.workers[zlib.crc32(name) % len(self.workers)]
+
+    def subscribe(self, name, address, respond):
+        # respond gets the reply frames from b"cmd-response" on
+        if name in self.assignments:
+            respond([b"cmd-response", b"subscribe-error",
+                     b"Name already in use"])
+            return
+        worker = self.select(name)
+        self.assignments[name] = (worker.index, address)
+        worker.names.add(name)
+
+        def on_reply(frames):
+            if frames[1:2] != [b"subscribed"]:
+                self.forget(name)
+            respond(frames)
+
+        self.send(worker, [b"subscribe", name, address], on_reply)
+
+    def unsubscribe(self, name, address, respond):
+        if name not in self.assignments:
+            respond([b"cmd-response", b"unsubscribe-error",
+                     b"Name not in use"])
+            return
+        worker = self.workers[self.assignments[name][0]]
+
+        def on_reply(frames):
+            if frames[1:2] == [b"unsubscribed"]:
+                self.forget(name)
+            respond(frames)
+
+        self.send(worker, [b"unsubscribe", name, address], on_reply)
+
+    def forget(self, name):
+        entry = self.assignments.pop(name, None)
+        if entry is not None:
+            self.workers[entry[0]].names.discard(name)
+
+    def gather(self, frames, respond, merge):
+        # sends frames to every worker, respond gets merge(replies) once
+        # they have all answered or failed
+        replies = []
+        expected = len(self.workers)
+
+        def on_reply(reply):
+            replies.append(reply)
+            if len(replies) == expected:
+                respond(merge(replies))
+
+        for worker in self.workers:
+            self.send(worker, list(frames), on_reply)
+
+    def check(self):
+        # called from the supervisor loop at least once a second
+        now = time.monotonic()
+        for worker in self.workers:
+            if not worker.alive():
+                logger.error("worker %s exited with %s", worker.index,
+                             worker.process.exitcode)
+                self.restart(worker)
+            elif now - worker.last_seen > self.health_timeout:
+                logger.error("worker %s not responding", worker.index)
+                self.restart(worker)
+
+        if now >= self.next_poll:
+            self.next_poll = now + self.health_interval
+            for worker in self.workers:
+                self.send(worker, [b"stats"], self.stats_reply(worker))
+
+    def stats_reply(self, worker):
+        def on_reply(frames):
+            if frames[1:2] == [b"stats"]:
+                worker.stats = msgpack.unpackb(frames[2])
+        return on_reply
+
+    def restart(self, worker):
+        if worker.process.is_alive():
+            worker.process.terminate()
+        worker.process.join(1.0)
+        if worker.process.is_alive():
+            worker.process.kill()
+            worker.process.join()
+        worker.restarts += 1
+        worker.stats = None
+
+        # whatever was in flight to it is not coming back
+        for request_id, entry in list(self.pending.items()):
+            if entry[0] == worker.index:
+                del self.pending[request_id]
+                entry[1]([b"cmd-response", b"error", b"worker restarted"])
+
+        self.spawn(worker)
+        for name in list(worker.names):
+            address = self.assignments[name][1]
+
+            def on_reply(frames, name=name):
+                if frames[1:2] != [b"subscribed"]:
+                    logger.error("restoring %s failed: %s", name, frames)
+
+            self.send(worker, [b"subscribe", name, address], on_reply)
+
+    def stats(self):
+        # the workers' last stats, merged, with their health
+        sockets = {}
+        peers = {}
+        timers = {}
+        workers = []
+        now = time.monotonic()
+        for worker in self.workers:
+            stats = worker.stats or {}
+            prefix = "worker-%d/" % worker.index
+            for name, value in stats.get("sockets", {}).items():
+                sockets[prefix + name] = value
+            for name, value in stats.get("timers", {}).items():
+                timers[prefix + name] = value
+            peers.update(stats.get("peers", {}))
+            workers.append({"index": worker.index,
+                            "pid": worker.process.pid,
+                            "alive": worker.alive(),
+                            "subscriptions": len(worker.names),
+                            "restarts": worker.restarts,
+                            "last_seen": now - worker.last_seen})
+        return {"sockets": sockets, "peers": peers, "timers": timers,
+                "subscriptions": len(self.assignments), "workers": workers}
+
+    def stop(self, timeout=5.0):
+        for worker in self.workers:
+            if worker.alive():
+                worker.socket.send_multipart([b"0", b"cmd", b"quit"])
+        deadline = time.monotonic() + timeout
+        for worker in self.workers:
+            worker.process.join(max(0.0, deadline - time.monotonic()))
+            if worker.process.is_alive():
+                worker.process.terminate()
+                worker.process.join()
+            worker.socket.close(linger=0)
@@ -5,12 +5,21 @@ import zmq
 import uuid
 import logging
 
+try:
+    from . import control_client
+except ImportError:
+    import control_client
+
 logger = logging.getLogger(__file__)
 
 def get_options():
     parser = argparse.ArgumentParser()
     parser.add_argument('--server',
                         help='zmq_sub server to connect to')
+    parser.add_argument('--timeout', type=float, default=10.0,
+                        help='seconds to wait for a reply before sending a request again')
+    parser.add_argument('--retries', type=int, default=3,
+                        help='times a request is sent again before it fails')
 
     subparsers = parser.add_subparsers(dest='main')
     parser_main = subparsers.add_parser('main',
@@ -27,6 +36,10 @@ def get_options():
                                         help='add a remote zmq subscriber address')
     parser_subscribers_add.add_argument('--name',
                                         help='provide a name of the target publisher')
+    parser_subscribers_add.add_argument('--from-file', dest='from_file',
+                                        help="'name address' per line, '-' for stdin")
+    parser_subscribers_add.add_argument('--concurrency', type=int, default=100,
+                                        help='requests in flight with --from-file')
 
 
     parser_subscribers_remove = subparsers_subscribers.add_parser('remove',
@@ -35,6 +48,10 @@ def get_options():
                                            help='add a remote zmq subscriber address')
     parser_subscribers_remove.add_argument('--name',
                                            help='provide a name of the target publisher')
+    parser_subscribers_remove.add_argument('--from-file', dest='from_file',
+                                           help="'name address' per line, '-' for stdin")
+    parser_subscribers_remove.add_argument('--concurrency', type=int, default=100,
+                                           help='requests in flight with --from-file')
 
     if len(sys.argv) < 2:
         sys.argv.append('--help')
@@ -47,6 +64,14 @@ def get_options():
         print("MAIN")
     elif parsed.main == "subscriber":
         address = name = None
+        if parsed.subscribers in ["add", "remove"] and parsed.from_file is not None:
+            cmd = b"subscribe" if parsed.subscribers == "add" else b"unsubscribe"
+            return process_subscribers_from_file(server_address=server_address,
+                                                 cmd=cmd,
+                                                 path=parsed.from_file,
+                                                 concurrency=parsed.concurrency,
+                                                 timeout=parsed.timeout,
+                                                 retries=parsed.retries)
         if parsed.subscribers in ["add", "remove"]:
             address = parsed.address
             name = parsed.name
@@ -75,7 +100,7 @@ class Connection(object):
         self.server_address = server_address
         self.timeout = timeout
 
-        self.zmq_context = zmq.Context()
+        self.zmq_context = zmq.Context.instance()
         self.socket = self.zmq_context.socket(zmq.DEALER)
         self.socket.connect(self.server_address)
 
@@ -150,9 +175,44 @@ def process_subscriber_remove(server_address, address, name):
          address.encode("utf8")])
 
 
+def process_subscribers_from_file(server_address, cmd, path, concurrency,
+                                  timeout, retries):
+    client = control_client.ControlClient(server_address,
+                                          timeout=timeout,
+                                          retries=retries)
+
+    def report(name, address, reply):
+        if reply is None:
+            result = "timeout"
+        else:
+            result = " ".join(frame.decode("utf8", "replace")
+                              for frame in reply[1:])
+        print("%s %s %s" % (name.decode("utf8"), address.decode("utf8"), result))
+        sys.stdout.flush()
+
+    if path == "-":
+        hFile = sys.stdin
+    else:
+        hFile = open(path)
+    try:
+        failures = control_client.run_bulk(client, cmd,
+                                           control_client.read_manifest(hFile),
+                                           concurrency=concurrency,
+                                           report=report)
+    finally:
+        if hFile is not sys.stdin:
+            hFile.close()
+        client.close()
+    if failures:
+        print("%d failed" % failures)
+    return failures
+
+
 def main():
     logging.basicConfig(level=logging.DEBUG)
-    get_options()
+    failures = get_options()
+    if failures:
+        sys.exit(1)
 
 
 if __name__ == "__main__":
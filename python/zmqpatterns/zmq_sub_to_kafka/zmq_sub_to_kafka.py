@@ -1,15 +1,35 @@
 import sys
 import os
 import zmq
-import pykafka
 import uuid
 import argparse
 import logging
 import threading
 import datetime
-import pykafka
+import time
 import msgpack
 
+try:
+    from .. import reactor
+    from .. import tracing
+    from .. import metrics
+except ImportError:
+    sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+    import reactor
+    import tracing
+    import metrics
+
+try:
+    from . import envelope
+    from . import worker_pool
+    from . import sink_pool
+    from . import subscription_registry
+except ImportError:
+    import envelope
+    import worker_pool
+    import sink_pool
+    import subscription_registry
+
 logger = logging.getLogger(__file__)
 
 
@@ -21,13 +41,24 @@ def make_unique_id():
 
 class ZmqSubscriber(object):
     def __init__(self, identity, zmq_context, peer_controller_address,
-                 zmq_subscriber_address, kafka_zmq_address):
+                 zmq_subscriber_address, kafka_zmq_address, tracer=None,
+                 counters=None, legacy_header=False, sink=None):
         self._identity = identity
+        self.tracer = tracer
+        if counters is None:
+            counters = metrics.Counters()
+        self.counters = counters
         self.zmq_context = zmq_context
         self.peer_controller_address = peer_controller_address
         self.zmq_subscriber_address = zmq_subscriber_address
         self.kafka_zmq_address = kafka_zmq_address
         self.kafka_send_id = make_unique_id()
+        # legacy_header sends the old (identity, send id, msgpack timetuple)
+        # frames for consumers that do not decode envelopes yet
+        self.legacy_header = legacy_header
+        self.envelope = envelope.EnvelopeEncoder(identity, self.kafka_send_id)
+        # a sink_pool.SinkPool to push to instead of kafka_zmq_address
+        self.sink = sink
         self._continue_running = None
 
     def identity(self):
@@ -41,30 +72,25 @@ class ZmqSubscriber(object):
         controller_socket = self.zmq_context.socket(zmq.DEALER)
         controller_socket.connect(self.peer_controller_address)
 
-        sub_socket = self.zmq_context.socket(zmq.SUB)
-        sub_socket.setsockopt(zmq.SUBSCRIBE, b"")
-        sub_socket.connect(self.zmq_subscriber_address)
+        sub_socket = self.create_sub_socket()
 
-        kafka_zmq_socket = self.zmq_context.socket(zmq.DEALER)
-        kafka_zmq_socket.connect(self.kafka_zmq_address)
+        kafka_zmq_socket = self.create_kafka_socket()
 
-        poller = zmq.Poller()
-        poller.register(sub_socket, zmq.POLLIN)
-        poller.register(controller_socket, zmq.POLLIN)
+        def handle_sub_frames(socket, frames):
+            self.forward_to_kafka(sub_socket, kafka_zmq_socket, frames)
+
+        def handle_controller_frames(socket, frames):
+            identity = frames[0]
+            self.handle_controller(identity, frames[1:], controller_socket)
+
+        loop = reactor.Reactor()
+        # the payload is only passed on, so keep it as zmq.Frame objects
+        loop.register(sub_socket, handle_sub_frames, copy=False)
+        loop.register(controller_socket, handle_controller_frames)
 
         controller_socket.send_multipart([b"started"])
 
-        while self.continue_running():
-            for socket, option in poller.poll(timeout=1000):
-                frames = socket.recv_multipart()
-                if socket == sub_socket:
-                    self.forward_to_kafka(sub_socket, kafka_zmq_socket, frames)
-                elif socket == controller_socket:
-                    identity = frames[0]
-                    self.handle_controller(identity, frames[1:], controller_socket)
-                else:
-                    logger.warn("Unknown socket: %s %s", socket, frames)
-        pass
+        loop.run(self.continue_running)
 
         self._continue_running = None
 
@@ -76,6 +102,19 @@ class ZmqSubscriber(object):
 
         logger.warn("exit %s", self.identity())
 
+    def create_sub_socket(self):
+        sub_socket = self.zmq_context.socket(zmq.SUB)
+        sub_socket.setsockopt(zmq.SUBSCRIBE, b"")
+        sub_socket.connect(self.zmq_subscriber_address)
+        return sub_socket
+
+    def create_kafka_socket(self):
+        if self.sink is not None:
+            return self.sink.connect()
+        kafka_zmq_socket = self.zmq_context.socket(zmq.DEALER)
+        kafka_zmq_socket.connect(self.kafka_zmq_address)
+        return kafka_zmq_socket
+
     def continue_running(self):
         return self._continue_running
 
@@ -84,12 +123,17 @@ class ZmqSubscriber(object):
 
 
     def forward_to_kafka(self, sub_socket, kafka_zmq_socket, frames):
-        logger.warn("SUB: %s %s", self._identity, frames)
-        time_value = msgpack.packb(datetime.datetime.now().timetuple())
-        header = [self._identity, self.kafka_send_id, time_value]
-        kafka_zmq_socket.send_multipart(header, flags=zmq.SNDMORE)
-        kafka_zmq_socket.send_multipart(frames)
-        pass
+        if self.tracer is not None:
+            self.tracer.sample(self._identity, frames)
+        if self.legacy_header:
+            time_value = msgpack.packb(datetime.datetime.now().timetuple())
+            header = [self._identity, self.kafka_send_id, time_value]
+        else:
+            header = [self.envelope.encode()]
+        message = header + frames
+        kafka_zmq_socket.send_multipart(message, copy=False)
+        self.counters.received(frames)
+        self.counters.sent(message)
 
     def handle_controller(self, identity, frames, controller_socket):
         if len(frames) < 3:
@@ -108,13 +152,53 @@ class ZmqPrimaryController(object):
     def __init__(self, zmq_context,
                  controller_primary_address,
                  kafka_zmq_address,
-                 kafka_connection_details):
+                 kafka_connection_details,
+                 engine="threads",
+                 workers=None,
+                 assign="hash",
+                 sink_connections=0,
+                 registry=None,
+                 legacy_header=False):
         self.zmq_context = zmq_context
         self.controller_primary_address = controller_primary_address
         self.kafka_zmq_address = kafka_zmq_address
         self.kafka_connection_details = kafka_connection_details
         self._continue_running = None
         self._subscriptions = {}
+        # name -> (thread, peer socket) of subscribers asked to quit, the
+        # socket is closed once the thread has exited
+        self._stopping = {}
+        # shared by all subscribers, dumped with the trace-dump command
+        self.tracer = tracing.Tracer()
+        self.metrics = metrics.Metrics()
+        # "threads" runs a ZmqSubscriber thread per subscription, "loop"
+        # polls every SUB socket from this controller's own reactor and
+        # sends to kafka_zmq_address over one shared DEALER, "processes"
+        # hands subscriptions to a pool of worker processes running "loop"
+        self.engine = engine
+        # passed on to every ZmqSubscriber
+        self.legacy_header = legacy_header
+        self.reactor = None
+        self.kafka_zmq_socket = None
+        self.pool = None
+        if engine == "processes":
+            if workers is None:
+                workers = os.cpu_count()
+            self.pool = worker_pool.WorkerPool(
+                zmq_context, kafka_zmq_address, workers, assign=assign,
+                sink_connections=sink_connections,
+                legacy_header=legacy_header)
+        # with sink_connections the subscribers share that many connections
+        # to kafka_zmq_address, through a sink_pool.SinkPool thread
+        self.sink = None
+        if sink_connections and self.pool is None:
+            self.sink = sink_pool.SinkPool(zmq_context, kafka_zmq_address,
+                                           sink_connections,
+                                           registry=self.metrics)
+        # a subscription_registry.SubscriptionRegistry, its subscriptions
+        # are started before the first control request is read and it is
+        # updated on every subscribe and unsubscribe
+        self.registry = registry
 
     def run(self):
         logger.debug("starting primary controller")
@@ -124,21 +208,60 @@ class ZmqPrimaryController(object):
         controller_socket = self.zmq_context.socket(zmq.ROUTER)
         controller_socket.bind(self.controller_primary_address)
 
-        poller = zmq.Poller()
-        poller.register(controller_socket, zmq.POLLIN)
-
-        while self.continue_running():
-            for socket, option in poller.poll(timeout=1000):
-                frames = socket.recv_multipart()
-                logger.warn("%s %s", socket, frames)
-                # all sockets to here are ROUTERS
-                identity = frames[0]
-                frames = frames[1:]
-                if socket == controller_socket:
-                    self.handle_controller(identity, frames, controller_socket, poller)
-                else:
-                    self.handle_subscriber_controller(identity, frames, socket)
-        pass
+        loop = self.reactor = reactor.Reactor()
+        loop.loop_timer = self.metrics.timer("loop")
+        controller_counters = self.metrics.socket("controller")
+
+        sink_thread = None
+        if self.sink is not None:
+            self.sink.bind()
+            sink_thread = threading.Thread(target=self.sink.run)
+            sink_thread.daemon = True
+            sink_thread.start()
+
+        if self.engine == "loop":
+            if self.sink is not None:
+                self.kafka_zmq_socket = self.sink.connect()
+            else:
+                self.kafka_zmq_socket = self.zmq_context.socket(zmq.DEALER)
+                self.kafka_zmq_socket.connect(self.kafka_zmq_address)
+
+        def handle_controller_frames(socket, frames):
+            controller_counters.received(frames)
+            logger.warn("%s %s", socket, frames)
+            # all sockets to here are ROUTERS
+            identity = frames[0]
+            self.handle_controller(identity, frames[1:], controller_socket, loop)
+
+        if self.pool is not None:
+            self.pool.start(loop)
+        if self.registry is not None:
+            self.restore_subscriptions(loop)
+
+        loop.register(controller_socket, handle_controller_frames)
+        if self.pool is None:
+            loop.run(self.continue_running)
+        else:
+            while self.continue_running():
+                loop.poll_once()
+                self.pool.check()
+            self.pool.stop()
+
+        if self.engine == "loop":
+            for name in list(self._subscriptions):
+                self.stop_subscriber(name, None)
+            self.kafka_zmq_socket.close()
+            self.kafka_zmq_socket = None
+        elif self.engine == "threads":
+            for name in list(self._subscriptions):
+                self.stop_subscriber(name, None)
+            self.reap_subscribers(wait_for=list(self._stopping))
+        if sink_thread is not None:
+            self.sink.request_quit()
+            sink_thread.join()
+        if self.registry is not None:
+            self.registry.close()
+        controller_socket.close()
 
         self._continue_running = None
 
@@ -149,7 +272,13 @@ class ZmqPrimaryController(object):
         self._continue_running = False
 
 
-    def handle_subscriber_controller(self, frames, socket, poller):
+    def handle_subscriber_frames(self, socket, frames):
+        logger.warn("%s %s", socket, frames)
+        # all sockets to here are ROUTERS
+        identity = frames[0]
+        self.handle_subscriber_controller(identity, frames[1:], socket)
+
+    def handle_subscriber_controller(self, identity, frames, socket):
         logger.warn("from sub controller: %s", frames)
         if len(frames) < 3:
             return None
@@ -161,14 +290,14 @@ class ZmqPrimaryController(object):
         if msgtype == b"cmd":
             if cmd == b"quit":
                 self.request_quit()
-                logger.debug("quit requested: %s", self.identity())
+                logger.debug("quit requested")
             elif cmd == b"echo-request":
                 socket.send_multipart([identity,
                                        request_id,
                                        b"cmd-response",
                                        b"echo-response"])
 
-    def handle_controller(self, identity, frames, incoming_socket, poller):
+    def handle_controller(self, identity, frames, incoming_socket, loop):
         logger.warn("from primary controller: %s", frames)
         if len(frames) < 3:
             return
@@ -183,22 +312,50 @@ class ZmqPrimaryController(object):
                                               incoming_socket,
                                               request_id, msgtype,
                                               cmd, frames,
-                                              poller)
+                                              loop)
             elif cmd == b"unsubscribe":
                 self.handle_unsubscribe_request(identity,
                                                 incoming_socket,
                                                 request_id, msgtype,
                                                 cmd, frames,
-                                                poller)
+                                                loop)
             elif cmd == b"quit":
                 self.request_quit()
-                logger.debug("quit requested: %s", self.identity())
+                logger.debug("quit requested")
             elif cmd == b"echo-request":
                 incoming_socket.send_multipart(
                     [identity,
                      request_id,
                      b"cmd-response",
                      b"echo-response"])
+            elif self.pool is not None and cmd in (b"trace-dump",
+                                                   b"trace-config"):
+                self.handle_pool_trace_request(identity, incoming_socket,
+                                               request_id, cmd, frames)
+            elif cmd == b"stats":
+                incoming_socket.send_multipart(
+                    [identity,
+                     request_id,
+                     b"cmd-response",
+                     b"stats",
+                     self.stats()])
+            elif cmd == b"trace-dump":
+                incoming_socket.send_multipart(
+                    [identity,
+                     request_id,
+                     b"cmd-response",
+                     b"trace-dump",
+                     self.tracer.pack()])
+            elif cmd == b"trace-config":
+                try:
+                    self.tracer.handle_config(frames[3:])
+                    response = [b"trace-configured"]
+                except Exception as ex:
+                    response = [b"trace-config-error", str(ex).encode("utf8")]
+                incoming_socket.send_multipart(
+                    [identity,
+                     request_id,
+                     b"cmd-response"] + response)
 
         pass
 
@@ -206,12 +363,20 @@ class ZmqPrimaryController(object):
                                  incoming_socket,
                                  request_id,
                                  msgtype, cmd, frames,
-                                 poller):
+                                 loop):
         if len(frames) < 5:
             return None
 
         name = frames[3]
         address = frames[4]
+        if self.pool is not None:
+            self.pool.subscribe(name, address,
+                                self.recorder(name, address,
+                                              self.responder(identity,
+                                                             incoming_socket,
+                                                             request_id)))
+            return None
+
         socket = error = None
         try:
             socket, error = self.start_subscriber(name, address)
@@ -224,24 +389,35 @@ class ZmqPrimaryController(object):
                  b"cmd-response",
                  b"subscribe-error",
                  error.encode("utf8")])
-        elif socket:
+        else:
+            if self.registry is not None:
+                self.registry.add(name, address)
             incoming_socket.send_multipart(
                 [identity, request_id,
                  b"cmd-response",
                  b"subscribed",
                  name])
-            poller.register(socket, zmq.POLLIN)
+            if socket is not None:
+                loop.register(socket, self.handle_subscriber_frames)
 
     def handle_unsubscribe_request(self, identity,
                                    incoming_socket,
                                    request_id,
                                    msgtype, cmd, frames,
-                                   poller):
+                                   loop):
         if len(frames) < 5:
             return None
 
         name = frames[3]
         address = frames[4]
+        if self.pool is not None:
+            self.pool.unsubscribe(name, address,
+                                  self.recorder(name, address,
+                                                self.responder(identity,
+                                                               incoming_socket,
+                                                               request_id)))
+            return None
+
         socket, error = self.stop_subscriber(name, address)
         if error:
             logger.error("%s %s", frames, error)
@@ -250,19 +426,101 @@ class ZmqPrimaryController(object):
                  b"cmd-response",
                  b"unsubscribe-error",
                  error.encode("utf8")])
-        elif socket:
+        else:
+            if self.registry is not None:
+                self.registry.remove(name)
             incoming_socket.send_multipart(
                 [identity, request_id,
                  b"cmd-response",
                  b"unsubscribed",
                  name])
-            poller.unregister(socket)
-
+            if socket is not None:
+                loop.unregister(socket)
+
+
+    def responder(self, identity, incoming_socket, request_id):
+        # the pool's replies go back to the client unchanged
+        def respond(frames):
+            incoming_socket.send_multipart([identity, request_id] + frames)
+        return respond
+
+    def recorder(self, name, address, respond):
+        # respond, after the pool's reply is noted in the registry
+        if self.registry is None:
+            return respond
+
+        def record(frames):
+            if frames[1:2] == [b"subscribed"]:
+                self.registry.add(name, address)
+            elif frames[1:2] == [b"unsubscribed"]:
+                self.registry.remove(name)
+            respond(frames)
+        return record
+
+    def restore_subscriptions(self, loop):
+        # starts every subscription in the registry at once; with a pool
+        # the workers start theirs concurrently and this waits for all of
+        # their replies. Ones that fail are dropped from the registry.
+        subscriptions = self.registry.load()
+        if not subscriptions:
+            return
+        started = time.monotonic()
+        failed = []
+        waiting = [0]
+
+        def on_reply(name, address):
+            def respond(frames):
+                waiting[0] -= 1
+                if frames[1:2] != [b"subscribed"]:
+                    failed.append((name, address, frames[2:]))
+            return respond
+
+        for name, address in subscriptions.items():
+            if self.pool is not None:
+                waiting[0] += 1
+                self.pool.subscribe(name, address, on_reply(name, address))
+                continue
+            socket = error = None
+            try:
+                socket, error = self.start_subscriber(name, address)
+            except Exception as ex:
+                error = str(ex)
+            if error:
+                failed.append((name, address, [error.encode("utf8")]))
+            elif socket is not None:
+                loop.register(socket, self.handle_subscriber_frames)
+
+        while waiting[0] and self.continue_running():
+            loop.poll_once()
+            self.pool.check()
+
+        for name, address, error in failed:
+            logger.error("restoring %s %s: %s", name, address, error)
+            self.registry.remove(name)
+        logger.info("restored %d of %d subscriptions in %.3fs",
+                    len(subscriptions) - len(failed), len(subscriptions),
+                    time.monotonic() - started)
+
+    def handle_pool_trace_request(self, identity, incoming_socket,
+                                  request_id, cmd, frames):
+        respond = self.responder(identity, incoming_socket, request_id)
+        if cmd == b"trace-dump":
+            self.pool.gather([b"trace-dump"], respond,
+                             worker_pool.merge_trace_dumps)
+        else:
+            self.pool.gather(frames[2:], respond,
+                             worker_pool.merge_trace_configs)
 
     def start_subscriber(self, name, address):
+        # (socket for the subscriber's control frames or None, error)
         if name in self._subscriptions:
             return None, "Name already in use"
 
+        if self.engine == "loop":
+            return self.start_loop_subscriber(name, address)
+
+        # the same name's previous thread may still hold its peer address
+        self.reap_subscribers(wait_for=[name])
         peer_address = b"inproc://controller/" + name
         socket = self.zmq_context.socket(zmq.ROUTER)
         socket.bind(peer_address)
@@ -272,7 +530,11 @@ class ZmqPrimaryController(object):
                                    zmq_context=self.zmq_context,
                                    peer_controller_address=peer_address,
                                    zmq_subscriber_address=address,
-                                   kafka_zmq_address=self.kafka_zmq_address)
+                                   kafka_zmq_address=self.kafka_zmq_address,
+                                   tracer=self.tracer,
+                                   counters=self.metrics.peer(name),
+                                   legacy_header=self.legacy_header,
+                                   sink=self.sink)
         thread = threading.Thread(target=subscriber.run)
         self._subscriptions[name] = (thread, subscriber, socket)
         thread.setDaemon(True)
@@ -281,26 +543,97 @@ class ZmqPrimaryController(object):
         return socket, None
 
 
+    def start_loop_subscriber(self, name, address):
+        # the same ZmqSubscriber forwarding, so the envelope is unchanged,
+        # but called from this reactor instead of a thread of its own
+        subscriber = ZmqSubscriber(identity=name,
+                                   zmq_context=self.zmq_context,
+                                   peer_controller_address=None,
+                                   zmq_subscriber_address=address,
+                                   kafka_zmq_address=self.kafka_zmq_address,
+                                   tracer=self.tracer,
+                                   counters=self.metrics.peer(name),
+                                   legacy_header=self.legacy_header,
+                                   sink=self.sink)
+        sub_socket = subscriber.create_sub_socket()
+        kafka_zmq_socket = self.kafka_zmq_socket
+
+        def handle_sub_frames(socket, frames):
+            subscriber.forward_to_kafka(socket, kafka_zmq_socket, frames)
+
+        self.reactor.register(sub_socket, handle_sub_frames, copy=False)
+        self._subscriptions[name] = (None, subscriber, sub_socket)
+        return None, None
+
+    def stats(self):
+        # msgpack {"uptime", "sockets", "peers", "timers", "subscriptions"}
+        stats = self.metrics.as_dict()
+        stats["subscriptions"] = len(self._subscriptions)
+        if self.pool is not None:
+            # plus "workers", the health of each worker process
+            pool_stats = self.pool.stats()
+            for key in ("sockets", "peers", "timers"):
+                stats[key].update(pool_stats[key])
+            stats["subscriptions"] = pool_stats["subscriptions"]
+            stats["workers"] = pool_stats["workers"]
+        return msgpack.packb(stats)
+
     def stop_subscriber(self, name, address):
         if name not in self._subscriptions:
             return None, "Name not in use"
 
         thread, subscriber, socket = self._subscriptions[name]
-        subscriber.request_quit()
         del self._subscriptions[name]
-        return socket, None
+        if thread is None:
+            self.reactor.unregister(socket)
+            socket.close(linger=0)
+            return None, None
+        subscriber.request_quit()
+        self.reactor.unregister(socket)
+        self._stopping[name] = (thread, socket)
+        self.reap_subscribers()
+        return None, None
+
+    def reap_subscribers(self, wait_for=()):
+        # closes the peer sockets of subscriber threads that have exited,
+        # waiting for the threads of the names in wait_for
+        for name, (thread, socket) in list(self._stopping.items()):
+            if name in wait_for:
+                thread.join()
+            if not thread.is_alive():
+                # the close is finished by zmq's reaper, unbind now so the
+                # name can be bound again at once
+                socket.unbind(b"inproc://controller/" + name)
+                socket.close(linger=0)
+                del self._stopping[name]
 
 
 def run_controller(primary_controller_address,
-                   kafka_connection_details):
+                   kafka_connection_details,
+                   engine="threads",
+                   workers=None,
+                   assign="hash",
+                   sink_connections=0,
+                   registry_filename=None,
+                   legacy_header=False):
     zmq_context = zmq.Context()
 
+    registry = None
+    if registry_filename is not None:
+        registry = subscription_registry.SubscriptionRegistry(registry_filename)
+
     kafka_zmq_address = kafka_connection_details # hack
 
     primary_controller = ZmqPrimaryController(zmq_context,
                                               primary_controller_address,
                                               kafka_zmq_address,
-                                              kafka_connection_details)
+                                              kafka_connection_details,
+                                              engine=engine,
+                                              workers=workers,
+                                              assign=assign,
+                                              sink_connections=sink_connections,
+                                              registry=registry,
+                                              legacy_header=legacy_header)
     primary_controller.run()
 
 
@@ -314,6 +647,27 @@ def main():
                         help='configuration filename')
     parser.add_argument('--kafka_address',
                         help='kafka address')
+    parser.add_argument('--engine', default="threads",
+                        choices=["threads", "loop", "processes"],
+                        help='a thread per subscription, one poll loop '
+                        'for all of them, or poll loops in worker processes')
+    parser.add_argument('--workers', type=int,
+                        help='worker processes, defaults to the cpu count')
+    parser.add_argument('--assign', default="hash",
+                        choices=["hash", "load"],
+                        help='worker for a subscription, by hash of its '
+                        'name or fewest subscriptions')
+    parser.add_argument('--sink_connections', type=int, default=0,
+                        help='share this many batching connections to the '
+                        'kafka bridge between all subscriptions, 0 for one '
+                        'each')
+    parser.add_argument('--legacy_header', action='store_true',
+                        help='send the old (identity, send id, msgpack '
+                        'timetuple) header frames instead of an envelope, '
+                        'for consumers that do not decode envelopes yet')
+    parser.add_argument('--registry',
+                        help='journal of the subscriptions, restored from '
+                        'at startup')
 
     parsed = parser.parse_args()
 
@@ -324,7 +678,13 @@ def main():
     kafka_connection_details = kafka_address
 
     run_controller(primary_controller_address,
-                   kafka_connection_details)
+                   kafka_connection_details,
+                   engine=parsed.engine,
+                   workers=parsed.workers,
+                   assign=parsed.assign,
+                   sink_connections=parsed.sink_connections,
+                   registry_filename=parsed.registry,
+                   legacy_header=parsed.legacy_header)
 
 if __name__ == "__main__":
     main()